@@ -1,23 +1,36 @@
-from fastapi import FastAPI, HTTPException, Depends
+import functools
+import json
+import os
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 
-from models import SessionLocal, User, Task, init_db, Project, BoardColumn, BoardCard
+from models import SessionLocal, unit_of_work, User, Task, init_db, Project, BoardColumn, BoardCard
+from executors import db_pool, ai_pool, executor_stats, bot_handler_latency
+from migrations import POSITION_GAP
+from jobs import decomposition_jobs, JobQueueFull
+from user_cache import user_identity_cache
+import services_async
+from events import event_bus
+from outbound import outbound
+from stats import get_task_summary, get_day_summary, get_streak, get_project_summary
 from services import (
     get_or_create_user, add_task_for_user, list_tasks, complete_task,
     sync_user_from_max, get_user_stats, update_user_profile,
-    get_user_by_external_id, get_today_stats, get_user_by_max_id,
+    get_user_by_external_id, get_user_identity, get_today_stats, get_user_by_max_id,
     sync_tasks_between_users, ensure_user_sync,
-    create_project, get_user_projects, create_card, get_project_with_details,
+    create_project, get_user_projects, create_card, get_project_with_details, load_boards,
     update_card_position, delete_card, delete_project,
-    parse_date, validate_date, list_tasks_by_date_range,
-    add_subtask, complete_subtask, list_subtasks,
-    update_task, delete_task, decompose_task, random_motivation,
-    get_task_by_id, get_task_progress, complete_parent_task, ai_enhanced_daily_analysis, analyze_day
+    append_position, move_card, reorder_cards_bulk, reorder_columns_bulk,
+    parse_date, validate_date, list_tasks_page, TASK_FIELDS,
+    get_sync_cursor, get_changes_since,
+    add_subtask, complete_subtask,
+    update_task, delete_task, decompose_task, random_motivation, normalize_user_id,
+    get_task_progress, complete_parent_task, ai_enhanced_daily_analysis, analyze_day
 )
 
 app = FastAPI(title="TaskBot API")
@@ -125,34 +138,130 @@ class CardUpdate(BaseModel):
     column_id: Optional[int] = None
     position: Optional[int] = None
 
+class CardMove(BaseModel):
+    column_id: Optional[int] = None
+    after_id: Optional[int] = None
+    before_id: Optional[int] = None
+
 class ColumnReorderRequest(BaseModel):
     columns: List[Dict[str, Any]]
 
 class CardReorderRequest(BaseModel):
     cards: List[Dict[str, Any]]
 
+TASKS_PAGE_DEFAULT = 100
+TASKS_PAGE_MAX = int(os.getenv('TASKS_PAGE_MAX', '500'))
+EVENT_STREAM_HEARTBEAT_SECONDS = float(os.getenv('EVENT_STREAM_HEARTBEAT_SECONDS', '15'))
+
 def get_db():
-    db = SessionLocal()
+    # Единица работы коммитит при выходе из обработчика, а FastAPI сериализует
+    # возвращенные ORM-объекты уже после этого — атрибуты не должны сбрасываться
+    db = SessionLocal(expire_on_commit=False)
     try:
         yield db
     finally:
         db.close()
 
+def request_session(func):
+    """Декоратор: сервисы, вызванные из обработчика, работают в сессии запроса из get_db."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with unit_of_work(kwargs.get('db')):
+            return func(*args, **kwargs)
+    return wrapper
+
 @app.get("/")
 async def root():
     return {"message": "TaskBot API", "status": "running"}
 
 @app.get("/tasks/list")
-async def get_tasks(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_tasks(external_id: str, limit: Optional[int] = None, cursor: Optional[str] = None, status: Optional[str] = None,
+              date_from: Optional[str] = None, date_to: Optional[str] = None, parent_id: Optional[int] = None,
+              top_level: bool = False, fields: Optional[str] = None, db: Session = Depends(get_db)):
     try:
-        tasks = list_tasks(external_id)
-        return {"tasks": tasks, "count": len(tasks)}
+        # Без limit и cursor — весь список, как до постраничной выдачи
+        if limit is None and cursor:
+            limit = TASKS_PAGE_DEFAULT
+        if limit is not None and not 1 <= limit <= TASKS_PAGE_MAX:
+            raise HTTPException(status_code=400, detail=f"limit должен быть от 1 до {TASKS_PAGE_MAX}")
+
+        requested = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+        unknown = set(requested or ()) - set(TASK_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=422, detail=f"Неизвестные поля: {', '.join(sorted(unknown))}")
+
+        dates = {}
+        for name, value in (("date_from", date_from), ("date_to", date_to)):
+            if value:
+                dates[name] = parse_date(value)
+                if not dates[name]:
+                    raise HTTPException(status_code=400, detail="❌ Неверный формат даты. Используй: дд.мм.гггг или гггг-мм-дд")
+
+        # Курсор синхронизации читается до выборки: все, что изменится позже,
+        # клиент получит через /sync/changes?since=sync_cursor
+        sync_cursor = get_sync_cursor()
+        tasks, next_cursor = list_tasks_page(
+            external_id,
+            limit=limit,
+            cursor=cursor,
+            status=status,
+            parent_id=parent_id,
+            top_level=top_level,
+            fields=requested,
+            **dates
+        )
+        return {"tasks": tasks, "count": len(tasks), "next_cursor": next_cursor, "sync_cursor": sync_cursor}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/sync/changes")
+@db_pool.offload
+@request_session
+def sync_changes(external_id: str, since: int = 0, db: Session = Depends(get_db)):
+    if since < 0:
+        raise HTTPException(status_code=400, detail="since должен быть неотрицательным")
+    try:
+        return get_changes_since(external_id, since)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/events/stream")
+async def events_stream(external_id: str, request: Request):
+    """SSE-поток изменений пользователя: после события клиент забирает данные через /sync/changes"""
+    user = await db_pool.run(get_user_identity, external_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
 
-@app.get("/user/verify-id")  
-async def verify_user_id(external_id: str, entered_id: str, db: Session = Depends(get_db)):
+    subscription = event_bus.subscribe(user.id)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                message = await subscription.get(timeout=EVENT_STREAM_HEARTBEAT_SECONDS)
+                if message is None:
+                    yield ": ping\n\n"
+                else:
+                    yield f"data: {json.dumps(message, default=str)}\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+@app.get("/user/verify-id")
+@db_pool.offload
+@request_session
+def verify_user_id(external_id: str, entered_id: str, db: Session = Depends(get_db)):
     try:
         user = db.query(User).filter_by(external_id=external_id).first()
 
@@ -171,16 +280,17 @@ async def verify_user_id(external_id: str, entered_id: str, db: Session = Depend
 
 
 @app.get("/user/ai-analytics")
-async def get_ai_analytics(external_id: str, db: Session = Depends(get_db)):
+@ai_pool.offload
+@request_session
+def get_ai_analytics(external_id: str, db: Session = Depends(get_db)):
     try:
-        tasks = list_tasks(external_id)
         user = get_or_create_user(external_id)
 
-        ai_analysis = ai_enhanced_daily_analysis(user, tasks, for_react=True)
+        ai_analysis = ai_enhanced_daily_analysis(user, for_react=True)
 
-        today_tasks = [t for t in tasks if t.created_at.date() == datetime.utcnow().date()]
-        total_minutes = sum(t.estimated_minutes for t in today_tasks)
-        completed_minutes = sum(t.estimated_minutes for t in today_tasks if t.status == 'done')
+        today = get_day_summary(user.id)
+        total_minutes = today["total_minutes"]
+        completed_minutes = today["completed_minutes"]
         time_utilization = (completed_minutes / total_minutes * 100) if total_minutes > 0 else 0
 
         response_data = {
@@ -206,15 +316,15 @@ async def get_ai_analytics(external_id: str, db: Session = Depends(get_db)):
     except Exception as e:
         print(f"Error in AI analytics: {e}")
         try:
-            tasks = list_tasks(external_id)
-            today_tasks = [t for t in tasks if t.created_at.date() == datetime.utcnow().date()]
-            completed_today = len([t for t in today_tasks if t.status == 'done'])
-            pending_today = len([t for t in today_tasks if t.status != 'done'])
-            total_today = len(today_tasks)
+            user = get_user_identity(external_id)
+            today = get_day_summary(user.id if user else None)
+            completed_today = today["completed_tasks"]
+            pending_today = today["pending_tasks"]
+            total_today = today["total_tasks"]
             efficiency = (completed_today / total_today * 100) if total_today > 0 else 0
             
-            total_minutes = sum(t.estimated_minutes for t in today_tasks)
-            completed_minutes = sum(t.estimated_minutes for t in today_tasks if t.status == ['done'])
+            total_minutes = today["total_minutes"]
+            completed_minutes = today["completed_minutes"]
             time_utilization = (completed_minutes / total_minutes * 100) if total_minutes > 0 else 0
 
             return {
@@ -244,7 +354,9 @@ async def get_ai_analytics(external_id: str, db: Session = Depends(get_db)):
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tasks/create")
-async def create_task(task_data: TaskCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_task(task_data: TaskCreate, external_id: str, db: Session = Depends(get_db)):
     try:
         task_date = None
         if task_data.task_date:
@@ -284,7 +396,9 @@ async def create_task(task_data: TaskCreate, external_id: str, db: Session = Dep
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tasks/complete")
-async def complete_task_endpoint(request: CompleteTaskRequest, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def complete_task_endpoint(request: CompleteTaskRequest, external_id: str, db: Session = Depends(get_db)):
     try:
         task = complete_task(external_id, request.task_id)
         if not task:
@@ -294,7 +408,9 @@ async def complete_task_endpoint(request: CompleteTaskRequest, external_id: str,
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/tasks/{task_id}")
-async def update_task_endpoint(task_id: int, task_data: TaskUpdate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def update_task_endpoint(task_id: int, task_data: TaskUpdate, external_id: str, db: Session = Depends(get_db)):
     try:
         task_date = None
         if task_data.task_date:
@@ -323,7 +439,9 @@ async def update_task_endpoint(task_id: int, task_data: TaskUpdate, external_id:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/tasks/{task_id}")
-async def delete_task_endpoint(task_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def delete_task_endpoint(task_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
         success = delete_task(external_id, task_id)
         if not success:
@@ -334,23 +452,23 @@ async def delete_task_endpoint(task_id: int, external_id: str, db: Session = Dep
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/tasks/list-by-date")
-async def get_tasks_by_date(external_id: str, date: str, db: Session = Depends(get_db)):
+async def get_tasks_by_date(external_id: str, date: str):
     try:
         target_date = parse_date(date)
         if not target_date:
             raise HTTPException(status_code=400, detail="Неверный формат даты")
             
-        tasks = list_tasks(external_id, target_date)
+        tasks = await services_async.list_tasks(external_id, target_date)
         return {"tasks": tasks, "count": len(tasks), "date": date}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tasks/list-by-date-range")
-async def get_tasks_by_date_range(external_id: str, date_range: DateRangeRequest, db: Session = Depends(get_db)):
+async def get_tasks_by_date_range(external_id: str, date_range: DateRangeRequest):
     try:
         start_date = parse_date(date_range.start_date)
         end_date = parse_date(date_range.end_date)
-        tasks = list_tasks_by_date_range(external_id, start_date, end_date)
+        tasks = await services_async.list_tasks_by_date_range(external_id, start_date, end_date)
         return {
             "tasks": tasks, 
             "count": len(tasks), 
@@ -361,7 +479,9 @@ async def get_tasks_by_date_range(external_id: str, date_range: DateRangeRequest
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tasks/{task_id}/subtasks")
-async def create_subtask_endpoint(task_id: int, subtask_data: SubtaskCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_subtask_endpoint(task_id: int, subtask_data: SubtaskCreate, external_id: str, db: Session = Depends(get_db)):
     try:
         subtask = add_subtask(
             external_id,
@@ -379,7 +499,9 @@ async def create_subtask_endpoint(task_id: int, subtask_data: SubtaskCreate, ext
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/tasks/{task_id}/subtasks/{subtask_id}/complete")
-async def complete_subtask_endpoint(task_id: int, subtask_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def complete_subtask_endpoint(task_id: int, subtask_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
         subtask = complete_subtask(external_id, task_id, subtask_id)
         if not subtask:
@@ -389,22 +511,30 @@ async def complete_subtask_endpoint(task_id: int, subtask_id: int, external_id:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/tasks/{task_id}/subtasks")
-async def get_subtasks_endpoint(task_id: int, external_id: str, db: Session = Depends(get_db)):
+async def get_subtasks_endpoint(task_id: int, external_id: str):
     try:
-        subtasks = list_subtasks(external_id, task_id)
+        user = await services_async.get_user_identity(external_id)
+        parent = await services_async.get_task_by_id(task_id)
+        if not user or not parent or parent.user_id != user.id:
+            raise HTTPException(status_code=404, detail="Parent task not found or access denied")
+
+        subtasks = await services_async.list_subtasks(task_id)
         return {"subtasks": subtasks, "count": len(subtasks)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/analytics")
-async def get_user_analytics(external_id: str, db: Session = Depends(get_db)):
+@ai_pool.offload
+@request_session
+def get_user_analytics(external_id: str, db: Session = Depends(get_db)):
     try:
-        tasks = list_tasks(external_id)
         user = get_or_create_user(external_id)
         
-        analytics = analyze_day(user, tasks)
+        analytics = analyze_day(user)
         
-        ai_analysis = ai_enhanced_daily_analysis(user, tasks, for_react=False)
+        ai_analysis = ai_enhanced_daily_analysis(user, for_react=False)
         
         result = {
             **analytics,
@@ -417,24 +547,24 @@ async def get_user_analytics(external_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/profile")
-async def get_user_profile(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_user_profile(external_id: str, db: Session = Depends(get_db)):
     try:
         user = get_or_create_user(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        tasks = list_tasks(external_id)
-        total_tasks = len(tasks)
-        completed_tasks = len([t for t in tasks if t.status == 'done'])
+        summary = get_task_summary(user.id)
         
         profile_data = {
             "user_id": user.external_id,
             "name": user.name,
             "energy": user.energy,
             "level": user.level,
-            "total_tasks": total_tasks,
-            "completed_tasks": completed_tasks,
-            "completion_rate": round((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0, 1),
+            "total_tasks": summary["total_tasks"],
+            "completed_tasks": summary["completed_tasks"],
+            "completion_rate": summary["completion_rate"],
             "created_at": user.created_at
         }
         
@@ -443,7 +573,9 @@ async def get_user_profile(external_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/user/sync")
-async def sync_user(request: UserSyncRequest, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def sync_user(request: UserSyncRequest, external_id: str, db: Session = Depends(get_db)):
     try:
         user_data = request.dict()
         user = sync_user_from_max(external_id, user_data)
@@ -464,7 +596,9 @@ async def sync_user(request: UserSyncRequest, external_id: str, db: Session = De
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/stats")
-async def get_user_stats_endpoint(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_user_stats_endpoint(external_id: str, db: Session = Depends(get_db)):
     try:
         stats = get_user_stats(external_id)
         if not stats:
@@ -474,7 +608,9 @@ async def get_user_stats_endpoint(external_id: str, db: Session = Depends(get_db
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/user/profile")
-async def update_user_profile_endpoint(request: UserUpdateRequest, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def update_user_profile_endpoint(request: UserUpdateRequest, external_id: str, db: Session = Depends(get_db)):
     try:
         user = update_user_profile(
             external_id,
@@ -499,7 +635,9 @@ async def update_user_profile_endpoint(request: UserUpdateRequest, external_id:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/today-stats")
-async def get_today_stats_endpoint(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_today_stats_endpoint(external_id: str, db: Session = Depends(get_db)):
     try:
         stats = get_today_stats(external_id)
         if not stats:
@@ -516,10 +654,48 @@ async def health_check():
         "service": "TaskBot API"
     }
 
+@app.get("/metrics/executors")
+async def executors_metrics():
+    return executor_stats()
+
+@app.get("/metrics/decomposition-cache")
+async def decomposition_cache_metrics():
+    from services import decomposition_cache
+    if decomposition_cache is None:
+        return {"error": "GigaChat client not available"}
+    return decomposition_cache.stats()
+
+@app.get("/metrics/decompose-jobs")
+async def decompose_jobs_metrics():
+    return decomposition_jobs.stats()
+
+@app.get("/metrics/user-cache")
+async def user_cache_metrics():
+    return user_identity_cache.stats()
+
+@app.get("/metrics/event-bus")
+async def event_bus_metrics():
+    return event_bus.stats()
+
+@app.get("/metrics/bot-outbound")
+async def bot_outbound_metrics():
+    return outbound.stats()
+
+@app.get("/metrics/bot-handlers")
+async def bot_handlers_metrics():
+    return bot_handler_latency.stats()
+
+@app.get("/metrics/gigachat")
+async def gigachat_metrics():
+    try:
+        from gigachat_client import gigachat_client
+        return gigachat_client.get_stats()
+    except ImportError:
+        return {"error": "GigaChat client not available"}
+
 @app.post("/tasks/decompose")
-async def decompose_task_endpoint(task_data: TaskCreate, external_id: str, db: Session = Depends(get_db)):
+async def decompose_task_endpoint(task_data: TaskCreate, external_id: str):
     try:
-        task_date = None
         if task_data.task_date:
             task_date = parse_date(task_data.task_date)
             if not task_date:
@@ -529,22 +705,33 @@ async def decompose_task_endpoint(task_data: TaskCreate, external_id: str, db: S
             if task_date.date() < today:
                 raise HTTPException(status_code=400, detail=f"❌ Дата не может быть раньше сегодняшней ({today.strftime('%d.%m.%Y')})")
 
-        steps = decompose_task(task_data.title, external_id)
-        
-        if not steps:
-            raise HTTPException(status_code=500, detail="Не удалось разложить задачу")
-            
+        job = decomposition_jobs.submit(task_data.title, external_id)
+
         return {
-            "steps": steps,
-            "message": f"Задача разложена на {len(steps)} подзадач"
+            "job_id": job.id,
+            "status": job.status,
+            "message": "Задача поставлена в очередь на разложение"
         }
         
+    except HTTPException:
+        raise
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         print(f"Error decomposing task: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/tasks/decompose/{job_id}")
+async def get_decompose_job(job_id: str, external_id: str):
+    job = decomposition_jobs.get(job_id)
+    if not job or job.user_id != normalize_user_id(external_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
 @app.get("/debug/user/{external_id}")
-async def debug_user(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def debug_user(external_id: str, db: Session = Depends(get_db)):
     try:
         user = get_user_by_external_id(external_id)
         if not user:
@@ -568,7 +755,9 @@ async def debug_user(external_id: str, db: Session = Depends(get_db)):
         return {"error": str(e)}
 
 @app.post("/user/create")
-async def create_user_endpoint(external_id: str, name: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_user_endpoint(external_id: str, name: str, db: Session = Depends(get_db)):
     try:
         user = get_or_create_user(external_id, name)
         return {
@@ -584,7 +773,9 @@ async def create_user_endpoint(external_id: str, name: str, db: Session = Depend
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/user/sync-with-bot")
-async def sync_with_bot(request: SyncRequest, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def sync_with_bot(request: SyncRequest, db: Session = Depends(get_db)):
     try:
         external_id = ensure_user_sync(request.max_user_id, request.username)
         return {
@@ -595,33 +786,37 @@ async def sync_with_bot(request: SyncRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/bot-tasks")
-async def get_bot_tasks(max_user_id: str, db: Session = Depends(get_db)):
+async def get_bot_tasks(max_user_id: str):
     try:
         external_id = f"max_{max_user_id}"
-        tasks = list_tasks(external_id)
+        tasks = await services_async.list_tasks(external_id)
         return {"tasks": tasks}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/sync/users")
-async def sync_users(source_external_id: str, target_external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def sync_users(source_external_id: str, target_external_id: str, db: Session = Depends(get_db)):
     try:
-        success = sync_tasks_between_users(source_external_id, target_external_id)
-        if not success:
+        result = sync_tasks_between_users(source_external_id, target_external_id)
+        if result is None:
             raise HTTPException(status_code=404, detail="Users not found or sync failed")
-        return {"message": "Users synchronized successfully"}
+        return {"message": "Users synchronized successfully", **result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/user/daily-stats")
-async def get_daily_stats(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_daily_stats(external_id: str, db: Session = Depends(get_db)):
     try:
-        today = datetime.utcnow().date()
-        tasks = list_tasks(external_id)
-        
-        today_tasks = [t for t in tasks if t.created_at.date() == today]
-        completed_today = len([t for t in today_tasks if t.status == 'done'])
-        pending_today = len([t for t in today_tasks if t.status != 'done'])
+        user = get_user_identity(external_id)
+        today = get_day_summary(user.id if user else None)
+        completed_today = today["completed_tasks"]
+        pending_today = today["pending_tasks"]
         
         if completed_today == 0 and pending_today == 0:
             analysis = {
@@ -651,21 +846,24 @@ async def get_daily_stats(external_id: str, db: Session = Depends(get_db)):
         return {
             "completed_today": completed_today,
             "pending_today": pending_today,
-            "total_today": len(today_tasks),
+            "total_today": today["total_tasks"],
             "analysis": analysis
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/user/productivity-stats")
-async def get_productivity_stats(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_productivity_stats(external_id: str, db: Session = Depends(get_db)):
     try:
-        tasks = list_tasks(external_id)
-        completed_tasks = [t for t in tasks if t.status == 'done']
-        pending_tasks = [t for t in tasks if t.status != 'done']
+        user = get_user_identity(external_id)
+        summary = get_task_summary(user.id if user else None)
+        total_tasks = summary["total_tasks"]
+        completed_tasks = summary["completed_tasks"]
         
-        total_energy = sum(t.difficulty for t in tasks) if tasks else 1
-        completed_energy = sum(t.difficulty for t in completed_tasks)
+        total_energy = summary["total_difficulty"] if total_tasks else 1
+        completed_energy = summary["completed_difficulty"]
         productivity_score = round((completed_energy / total_energy) * 100) if total_energy > 0 else 0
         
         if productivity_score >= 80:
@@ -684,53 +882,45 @@ async def get_productivity_stats(external_id: str, db: Session = Depends(get_db)
             temperature = 1
             temperature_label = "❄️ Охлажденный"
         
-        completed_dates = [t.created_at.date() for t in completed_tasks]
-        unique_dates = sorted(set(completed_dates), reverse=True)
-        
-        streak = 0
-        today = datetime.utcnow().date()
-        for i, date in enumerate(unique_dates):
-            if (today - date).days == i:
-                streak += 1
-            else:
-                break
+        streak = get_streak(user.id if user else None)
         
         return {
-            "completed_tasks": len(completed_tasks),
-            "pending_tasks": len(pending_tasks),
-            "completion_rate": round((len(completed_tasks) / len(tasks)) * 100) if tasks else 0,
+            "completed_tasks": completed_tasks,
+            "pending_tasks": summary["pending_tasks"],
+            "completion_rate": round((completed_tasks / total_tasks) * 100) if total_tasks else 0,
             "productivity_score": productivity_score,
             "temperature": temperature,
             "temperature_label": temperature_label,
-            "streak": streak,
-            "total_tasks": len(tasks)
+            "streak": streak["current_streak"],
+            "longest_streak": streak["longest_streak"],
+            "total_tasks": total_tasks
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/kanban/projects")
-async def get_projects(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_projects(external_id: str, project_id: Optional[int] = None, fields: Optional[str] = None,
+                 db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        projects = get_user_projects(external_id)
-        
-        result = []
-        for project in projects:
-            project_details = get_project_with_details(project.id, external_id)
-            if project_details:
-                result.append(project_details)
-        
-        return {"projects": result}
+        card_fields = [f.strip() for f in fields.split(',')] if fields else None
+        return {"projects": load_boards(external_id, project_id=project_id, fields=card_fields)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/kanban/projects")
-async def create_project_endpoint(project_data: ProjectCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_project_endpoint(project_data: ProjectCreate, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -741,13 +931,13 @@ async def create_project_endpoint(project_data: ProjectCreate, external_id: str,
             color=project_data.color
         )
         db.add(project)
-        db.commit()
+        db.flush()
         db.refresh(project)
         
         default_columns = [
-            {"title": "📋 Бэклог", "color": "#6b7280", "position": 0},
-            {"title": "🔄 В работе", "color": "#f59e0b", "position": 1},
-            {"title": "✅ Готово", "color": "#10b981", "position": 2}
+            {"title": "📋 Бэклог", "color": "#6b7280", "position": POSITION_GAP},
+            {"title": "🔄 В работе", "color": "#f59e0b", "position": 2 * POSITION_GAP},
+            {"title": "✅ Готово", "color": "#10b981", "position": 3 * POSITION_GAP}
         ]
         
         for col_data in default_columns:
@@ -759,7 +949,7 @@ async def create_project_endpoint(project_data: ProjectCreate, external_id: str,
             )
             db.add(column)
         
-        db.commit()
+        db.flush()
         
         project_details = get_project_with_details(project.id, external_id)
         
@@ -773,9 +963,11 @@ async def create_project_endpoint(project_data: ProjectCreate, external_id: str,
         raise HTTPException(status_code=500, detail=f"Error creating project: {str(e)}")
 
 @app.post("/kanban/projects/{project_id}/columns")
-async def create_column_endpoint(project_id: int, column_data: ColumnCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_column_endpoint(project_id: int, column_data: ColumnCreate, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -783,16 +975,14 @@ async def create_column_endpoint(project_id: int, column_data: ColumnCreate, ext
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
 
-        max_position = db.query(func.max(BoardColumn.position)).filter_by(project_id=project_id).scalar() or 0
-        
         column = BoardColumn(
             project_id=project_id,
             title=column_data.title,
             color=column_data.color,
-            position=max_position + 1
+            position=append_position(BoardColumn, BoardColumn.project_id, project_id)
         )
         db.add(column)
-        db.commit()
+        db.flush()
         db.refresh(column)
         
         return {"column": column, "message": "Column created successfully"}
@@ -801,7 +991,9 @@ async def create_column_endpoint(project_id: int, column_data: ColumnCreate, ext
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/kanban/columns/{column_id}/cards")
-async def create_card_endpoint(column_id: int, card_data: CardCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def create_card_endpoint(column_id: int, card_data: CardCreate, external_id: str, db: Session = Depends(get_db)):
     try:
         card = create_card(
             column_id,
@@ -837,9 +1029,11 @@ async def create_card_endpoint(column_id: int, card_data: CardCreate, external_i
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/kanban/cards/{card_id}")
-async def update_card_endpoint(card_id: int, card_data: CardUpdate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def update_card_endpoint(card_id: int, card_data: CardUpdate, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -870,7 +1064,7 @@ async def update_card_endpoint(card_id: int, card_data: CardUpdate, external_id:
             card.position = card_data.position
         
         card.updated_at = datetime.utcnow()
-        db.commit()
+        db.flush()
         db.refresh(card)
         
         card_response = {
@@ -893,7 +1087,9 @@ async def update_card_endpoint(card_id: int, card_data: CardUpdate, external_id:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/kanban/cards/{card_id}")
-async def delete_card_endpoint(card_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def delete_card_endpoint(card_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
         success = delete_card(card_id, external_id)
         if not success:
@@ -904,7 +1100,9 @@ async def delete_card_endpoint(card_id: int, external_id: str, db: Session = Dep
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/kanban/projects/{project_id}")
-async def delete_project_endpoint(project_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def delete_project_endpoint(project_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
         success = delete_project(project_id, external_id)
         if not success:
@@ -914,66 +1112,67 @@ async def delete_project_endpoint(project_id: int, external_id: str, db: Session
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.put("/kanban/projects/{project_id}/columns/reorder")
-async def reorder_columns(project_id: int, request: ColumnReorderRequest, external_id: str, db: Session = Depends(get_db)):
+@app.put("/kanban/cards/{card_id}/move")
+@db_pool.offload
+@request_session
+def move_card_endpoint(card_id: int, move: CardMove, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        project = db.query(Project).filter_by(id=project_id, user_id=user.id).first()
-        if not project:
-            raise HTTPException(status_code=404, detail="Project not found")
+        card = move_card(card_id, external_id, move.column_id, move.after_id, move.before_id)
+        if not card:
+            raise HTTPException(status_code=404, detail="Card or column not found")
 
-        for col_data in request.columns:
-            column = db.query(BoardColumn).filter_by(id=col_data["id"], project_id=project_id).first()
-            if column:
-                column.position = col_data["position"]
-        
-        db.commit()
+        return {
+            "card": {"id": card.id, "column_id": card.column_id, "position": card.position, "version": card.version},
+            "message": "Card moved successfully"
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.put("/kanban/projects/{project_id}/columns/reorder")
+@db_pool.offload
+@request_session
+def reorder_columns(project_id: int, request: ColumnReorderRequest, external_id: str, db: Session = Depends(get_db)):
+    try:
+        updated = reorder_columns_bulk(project_id, external_id, request.columns)
+        if updated is None:
+            raise HTTPException(status_code=404, detail="Project or columns not found")
         
-        return {"message": "Columns reordered successfully"}
+        return {"message": "Columns reordered successfully", "updated": updated}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/kanban/columns/{column_id}/cards/reorder")
-async def reorder_cards(column_id: int, request: CardReorderRequest, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def reorder_cards(column_id: int, request: CardReorderRequest, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        column = db.query(BoardColumn).join(Project).filter(
-            BoardColumn.id == column_id,
-            Project.user_id == user.id
-        ).first()
-        if not column:
-            raise HTTPException(status_code=404, detail="Column not found")
-        
-        for card_data in request.cards:
-            card = db.query(BoardCard).filter_by(id=card_data["id"]).first()
-            if card:
-                card.position = card_data["position"]
-                if "column_id" in card_data and card_data["column_id"] != column_id:
-                    new_column = db.query(BoardColumn).join(Project).filter(
-                        BoardColumn.id == card_data["column_id"],
-                        Project.user_id == user.id
-                    ).first()
-                    if new_column:
-                        card.column_id = card_data["column_id"]
-        
-        db.commit()
-        
-        return {"message": "Cards reordered successfully"}
+        # Карточки без своего column_id попадают в колонку из пути
+        updated = reorder_cards_bulk(external_id, request.cards, column_id=column_id)
+        if updated is None:
+            raise HTTPException(status_code=404, detail="Cards or columns not found")
+        
+        return {"message": "Cards reordered successfully", "updated": updated}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/kanban/projects/{project_id}")
-async def update_project_endpoint(project_id: int, project_data: ProjectCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def update_project_endpoint(project_id: int, project_data: ProjectCreate, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -989,7 +1188,7 @@ async def update_project_endpoint(project_id: int, project_data: ProjectCreate,
             project.color = project_data.color
         
         project.updated_at = datetime.utcnow()
-        db.commit()
+        db.flush()
         db.refresh(project)
         
         return {"project": project, "message": "Project updated successfully"}
@@ -998,9 +1197,11 @@ async def update_project_endpoint(project_id: int, project_data: ProjectCreate,
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/kanban/columns/{column_id}")
-async def update_column_endpoint(column_id: int, column_data: ColumnCreate, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def update_column_endpoint(column_id: int, column_data: ColumnCreate, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -1016,7 +1217,7 @@ async def update_column_endpoint(column_id: int, column_data: ColumnCreate, exte
         if column_data.color is not None:
             column.color = column_data.color
         
-        db.commit()
+        db.flush()
         db.refresh(column)
         
         return {"column": column, "message": "Column updated successfully"}
@@ -1025,9 +1226,11 @@ async def update_column_endpoint(column_id: int, column_data: ColumnCreate, exte
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/kanban/columns/{column_id}")
-async def delete_column_endpoint(column_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def delete_column_endpoint(column_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -1040,7 +1243,7 @@ async def delete_column_endpoint(column_id: int, external_id: str, db: Session =
         
         db.query(BoardCard).filter_by(column_id=column_id).delete()
         db.delete(column)
-        db.commit()
+        db.flush()
         
         return {"message": "Column deleted successfully"}
     except Exception as e:
@@ -1048,9 +1251,11 @@ async def delete_column_endpoint(column_id: int, external_id: str, db: Session =
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/kanban/projects/{project_id}/stats")
-async def get_project_stats(project_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def get_project_stats(project_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -1058,33 +1263,14 @@ async def get_project_stats(project_id: int, external_id: str, db: Session = Dep
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        cards = db.query(BoardCard).join(BoardColumn).filter(
-            BoardColumn.project_id == project_id
-        ).all()
-        
-        total_cards = len(cards)
-        
-        priority_stats = {
-            1: len([c for c in cards if c.priority == 1]),
-            2: len([c for c in cards if c.priority == 2]),
-            3: len([c for c in cards if c.priority == 3]),
-            4: len([c for c in cards if c.priority == 4]),
-            5: len([c for c in cards if c.priority == 5])
-        }
-        
-        columns = db.query(BoardColumn).filter_by(project_id=project_id).all()
-        column_stats = {}
-        for column in columns:
-            column_cards = db.query(BoardCard).filter_by(column_id=column.id).all()
-            column_stats[column.title] = len(column_cards)
-        
-        total_estimated_minutes = sum(card.estimated_minutes for card in cards)
+        summary = get_project_summary(project_id)
+        total_estimated_minutes = summary["total_estimated_minutes"]
         
         return {
             "project_id": project_id,
-            "total_cards": total_cards,
-            "priority_stats": priority_stats,
-            "column_stats": column_stats,
+            "total_cards": summary["total_cards"],
+            "priority_stats": summary["priority_stats"],
+            "column_stats": summary["column_stats"],
             "total_estimated_minutes": total_estimated_minutes,
             "total_estimated_hours": round(total_estimated_minutes / 60, 1)
         }
@@ -1092,7 +1278,9 @@ async def get_project_stats(project_id: int, external_id: str, db: Session = Dep
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/debug/kanban/columns/{column_id}")
-async def debug_column(column_id: int, external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def debug_column(column_id: int, external_id: str, db: Session = Depends(get_db)):
     try:
         user = get_user_by_external_id(external_id)
         if not user:
@@ -1124,7 +1312,9 @@ async def debug_column(column_id: int, external_id: str, db: Session = Depends(g
         return {"error": str(e)}
 
 @app.get("/debug/kanban/projects")
-async def debug_projects(external_id: str, db: Session = Depends(get_db)):
+@db_pool.offload
+@request_session
+def debug_projects(external_id: str, db: Session = Depends(get_db)):
     try:
         user = get_user_by_external_id(external_id)
         if not user:
@@ -1,110 +1,89 @@
-import threading
+import functools
 import time
-import aiomax
 from aiomax import buttons
 import logging
 import re
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from services import (
-    random_motivation, decompose_task, get_or_create_user,
+    random_motivation, get_or_create_user,
     add_task_for_user, list_tasks, complete_task, parse_date, validate_date,
     add_subtask, complete_subtask, list_subtasks, update_task, delete_task,
-    get_task_by_id, get_task_progress, complete_parent_task, ai_enhanced_daily_analysis, analyze_day
+    get_task_by_id, get_task_progress_bulk, complete_parent_task, ai_enhanced_daily_analysis, analyze_day
 )
-from models import init_db
+from models import SessionLocal, init_db, unit_of_work
+from jobs import decomposition_jobs, JobQueueFull
+import services_async
+from executors import db_pool, ai_pool, bot_handler_latency
+from bot_state import make_state_store
+from reminders import ReminderScheduler
+from outbound import ThrottledBot, lane, REMINDER
 from config import MAX_BOT_TOKEN
 
 logging.basicConfig(level=logging.INFO)
 
+def handler_session(handler):
+    """Декоратор: все вызовы services при обработке одного апдейта идут через одну сессию БД.
+
+    Запросы этой сессии выполняются в db_pool, а не в event loop: сессия открывает
+    соединение только при первом запросе, коммитится и закрывается тоже в пуле,
+    а после коммита не сбрасывает загруженные атрибуты — их чтение в обработчике
+    не идет в базу.
+    Время обработки записывается в bot_handler_latency.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        failed = False
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            with unit_of_work(db, commit=False):
+                result = await handler(*args, **kwargs)
+            await db_pool.run(db.commit)
+            return result
+        except Exception:
+            failed = True
+            raise
+        finally:
+            await db_pool.run(db.close)
+            elapsed = time.perf_counter() - started_at
+            bot_handler_latency.record(handler.__name__, elapsed, failed)
+            if elapsed * 1000 >= bot_handler_latency.slow_ms:
+                logging.warning(f"🐢 Медленный обработчик {handler.__name__}: {elapsed * 1000:.0f} мс")
+    return wrapper
+
 class TaskBot:
     def __init__(self):
         self.token = MAX_BOT_TOKEN
-        self.bot = aiomax.Bot(self.token, default_format="markdown")
-        self.active_chats = {}  
-        self.last_activity = {}  
-        self.pagination_state = {}  
+        self.bot = ThrottledBot(self.token, default_format="markdown")
+        self.state = make_state_store()
+        self.reminders = ReminderScheduler(self.state, self._send_inactivity_notification)
         self.setup_handlers()
-        self.setup_inactivity_checker_sync()
-
-    def setup_inactivity_checker_sync(self):
-        def checker():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
-            async def async_checker():
-                while True:
-                    try:
-                        await asyncio.sleep(300)  # 5 минут
-                        await self._check_inactive_users()
-                    except Exception as e:
-                        logging.error(f"Inactivity checker error: {e}")
-                        await asyncio.sleep(300)
-
-            try:
-                loop.run_until_complete(async_checker())
-            finally:
-                loop.close()
-
-        thread = threading.Thread(target=checker, daemon=True)
-        thread.start()
-
-    async def _check_inactive_users(self, test_mode=False):
-        try:
-            now = datetime.now()
-
-            if test_mode:
-
-                time_threshold = now - timedelta(minutes=1)
-                logging.info("🔍 [TEST] Checking for 1-minute inactivity...")
-            else:
-                time_threshold = now - timedelta(hours=4)
-                logging.info("🔍 Checking for 4-hour inactivity...")
-
-            notified_count = 0
-            users_to_notify = []
-
-            # Собираем пользователей для уведомления
-            for user_id, last_time in self.last_activity.items():
-                if last_time < time_threshold:
-                    users_to_notify.append(user_id)
-
-            # Отправляем уведомления
-            for user_id in users_to_notify:
-                await self._send_inactivity_notification(user_id, test_mode)
-                # Обновляем время, чтобы не спамить
-                self.last_activity[user_id] = now
-                notified_count += 1
-
-            if test_mode:
-                logging.info(f"🔍 [TEST] Notified {notified_count} users")
-            elif notified_count > 0:
-                logging.info(f"📨 Sent inactivity notifications to {notified_count} users")
-
-        except Exception as e:
-            logging.error(f"Error in _check_inactive_users: {e}")
 
     async def _send_inactivity_notification(self, user_id, test_mode=False):
         try:
-            chat_id = self.active_chats.get(user_id)
+            chat_id = await self.state.fetch_chat(user_id)
             if not chat_id:
                 logging.warning(f"Chat ID not found for user {user_id}")
-                return
+                return False
 
             if test_mode:
                 text = "🧪 Тестовое уведомление: система работает!"
             else:
                 text = "⏰ Напоминание: ты неактивен уже 4 часа! Увлёкся задачами и забыл отметить прогресс? Вместе мы сильнее! =)"
 
-            await self.bot.send_message(text, chat_id)
+            with lane(REMINDER):
+                await self.bot.send_message(text, chat_id)
             logging.info(f"📨 Sent inactivity notification to user {user_id}")
+            return True
 
         except Exception as e:
             logging.error(f"Error sending inactivity notification to {user_id}: {e}")
+            return False
 
     def update_user_activity(self, user_id):
-        self.last_activity[user_id] = datetime.now()
+        self.reminders.touch(user_id)
 
     def normalize_user_id(self, user_data):
         user_id = user_data.user_id
@@ -139,10 +118,11 @@ class TaskBot:
         return kb
 
     def get_paginated_task_selector(self, user_id, tasks, action_type='complete'):
-        if user_id not in self.pagination_state:
-            self.pagination_state[user_id] = {'page': 0, 'action': action_type}
+        state = self.state.get_pagination(user_id)
+        if state is None:
+            state = {'page': 0, 'action': action_type}
+            self.state.set_pagination(user_id, state)
 
-        state = self.pagination_state[user_id]
         page = state['page']
 
         active_tasks = [t for t in tasks if t.status != 'done']
@@ -158,7 +138,7 @@ class TaskBot:
 
         if page >= total_pages:
             page = total_pages - 1
-            self.pagination_state[user_id]['page'] = page
+            state['page'] = page
 
         start_idx = page * tasks_per_page
         end_idx = start_idx + tasks_per_page
@@ -166,11 +146,13 @@ class TaskBot:
 
         message = f"📄 **Страница {page + 1}/{total_pages}**\n\n"
 
+        progress_map = get_task_progress_bulk(t.id for t in page_tasks if t.is_parent)
+
         kb = buttons.KeyboardBuilder()
 
         for display_idx, task in enumerate(page_tasks, start=start_idx + 1):
             if task.is_parent:
-                completed, total, _ = get_task_progress(task.id)
+                completed, total, _ = progress_map[task.id]
                 label = f"{display_idx}. 🎯 {task.title[:15]}... ({completed}/{total})"
                 callback_data = f'view_parent_{task.id}'
             else:
@@ -197,7 +179,7 @@ class TaskBot:
 
         for i, task in enumerate(page_tasks, start_idx + 1):
             if task.is_parent:
-                completed, total, progress = get_task_progress(task.id)
+                completed, total, progress = progress_map[task.id]
                 status = f" ({completed}/{total} подзадач)"
             else:
                 status = ""
@@ -230,10 +212,12 @@ class TaskBot:
 
         regular_tasks = [t for t in tasks if not t.parent_id and not t.is_parent and t.status != 'done']
 
+        progress_map = get_task_progress_bulk(t.id for t in tasks if t.is_parent and t.status != 'done')
+
         parent_tasks = []
         for task in tasks:
             if task.is_parent and task.status != 'done':
-                completed, total, progress = get_task_progress(task.id)
+                completed, total, progress = progress_map[task.id]
                 if progress < 100:  
                     parent_tasks.append(task)
 
@@ -246,7 +230,7 @@ class TaskBot:
                 if not task.is_parent:
                     kb.add(buttons.CallbackButton(f'✅ {task.title[:15]}...', f'complete_{task.id}'))
                 else:
-                    completed, total, progress = get_task_progress(task.id)
+                    completed, total, progress = progress_map[task.id]
                     kb.add(buttons.CallbackButton(f'🎯 {task.title[:12]}... ({completed}/{total})', f'view_parent_{task.id}'))
 
         kb.row(buttons.CallbackButton('⬅️ Назад', 'back_main'))
@@ -259,7 +243,8 @@ class TaskBot:
         kb.row(buttons.CallbackButton('⬅️ Назад', 'complete_task'))
         return kb
 
-    def format_task_list(self, tasks):
+    def format_task_list(self, tasks, progress_map=None):
+        """Текст списка задач; без progress_map прогресс родителей читается из БД"""
         if not tasks:
             return "📝 **Список задач пуст.**"
 
@@ -271,9 +256,12 @@ class TaskBot:
         # Объединяем все задачи для сквозной нумерации
         all_tasks = regular_tasks + parent_tasks
 
+        if progress_map is None:
+            progress_map = get_task_progress_bulk(t.id for t in parent_tasks)
+
         for idx, task in enumerate(all_tasks, 1):
             if task.is_parent:
-                completed, total, progress = get_task_progress(task.id)
+                completed, total, progress = progress_map[task.id]
                 if progress == 100:
                     status_icon = "✅"
                 elif progress > 0:
@@ -313,16 +301,21 @@ class TaskBot:
     def setup_handlers(self):
         bot = self.bot
 
+        @bot.on_ready()
+        async def start_reminders():
+            await self.reminders.start()
+
         @bot.on_bot_start()
+        @handler_session
         async def welcome(pd):
             user_id = self.normalize_user_id(pd.user)
             name = pd.user.name
             chat_id = pd.chat_id
             
-            self.active_chats[user_id] = chat_id
+            self.state.set_chat(user_id, chat_id)
             self.update_user_activity(user_id)
 
-            user = get_or_create_user(user_id, name)
+            user = await db_pool.run_in_context(get_or_create_user, user_id, name)
             logging.info(f"🆕 Новый пользователь: {user_id} ({name})")
 
             await pd.send(
@@ -334,15 +327,16 @@ class TaskBot:
             )
 
         @bot.on_command('start')
+        @handler_session
         async def cmd_start(ctx):
             user_id = self.normalize_user_id(ctx.sender)
             name = ctx.sender.name
             chat_id = ctx.recipient.chat_id
             
-            self.active_chats[user_id] = chat_id
+            self.state.set_chat(user_id, chat_id)
             self.update_user_activity(user_id)
 
-            user = get_or_create_user(user_id, name)
+            user = await db_pool.run_in_context(get_or_create_user, user_id, name)
             logging.info(f"🔁 Пользователь перезапустил бота: {user_id} ({name})")
 
             await ctx.reply(
@@ -352,9 +346,10 @@ class TaskBot:
             )
 
         @bot.on_button_callback('add_task')
+        @handler_session
         async def add_task_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
             
             await cb.answer(
@@ -366,13 +361,15 @@ class TaskBot:
             )
 
         @bot.on_button_callback('list_tasks')
+        @handler_session
         async def list_tasks_handler(cb):
             try:
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
-                tasks = list_tasks(user_id)
+                # Только чтение: задачи и прогресс берутся через aiosqlite, без потока db_pool
+                tasks = await services_async.list_tasks(user_id)
                 logging.info(f"📋 Пользователь {user_id} запросил список задач: {len(tasks)} задач")
 
                 if not tasks:
@@ -383,14 +380,15 @@ class TaskBot:
                     )
                     return
                     
-                task_text = self.format_task_list(tasks)
+                progress_map = await services_async.get_task_progress_bulk(t.id for t in tasks if t.is_parent)
+                task_text = self.format_task_list(tasks, progress_map)
                 
                 parent_tasks = [t for t in tasks if t.is_parent and t.status != 'done']
                 if parent_tasks:
                     kb = buttons.KeyboardBuilder()
                     
                     for task in parent_tasks[:4]:
-                        completed, total, _ = get_task_progress(task.id)
+                        completed, total, _ = progress_map[task.id]
                         label = f"🎯 {task.title[:18]} ({completed}/{total})"
                         kb.add(buttons.CallbackButton(label, f'view_parent_{task.id}'))
                     
@@ -411,13 +409,14 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при получении списка задач")
 
         @bot.on_button_callback('complete_task')
+        @handler_session
         async def complete_task_handler(cb):
             try:
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
-                tasks = list_tasks(user_id)
+                tasks = await db_pool.run_in_context(list_tasks, user_id)
                 pending_tasks = [t for t in tasks if t.status != 'done']
                 
                 if not pending_tasks:
@@ -428,7 +427,7 @@ class TaskBot:
                     )
                     return
                 
-                kb, message = self.get_paginated_task_selector(user_id, tasks, 'complete')
+                kb, message = await db_pool.run_in_context(self.get_paginated_task_selector, user_id, tasks, 'complete')
                 
                 full_message = f"✅ **Завершение задач**\n\n{message}"
                     
@@ -443,6 +442,7 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при получении списка задач")
 
         @bot.on_button_callback(lambda data: data.payload.startswith('view_parent_'))
+        @handler_session
         async def view_parent_task_handler(cb):
             try:
                 if not cb.payload.startswith('view_parent_') or len(cb.payload.split('_')) < 3:
@@ -457,15 +457,15 @@ class TaskBot:
                 task_id = int(task_id_str)
                 user_id = self.normalize_user_id(cb.user)
 
-                task = get_task_by_id(task_id)
+                task = await db_pool.run_in_context(get_task_by_id, task_id)
                 if not task:
                     await cb.answer("❌ Задача не найдена")
                     return
 
-                subtasks = list_subtasks(task_id)
+                subtasks = await db_pool.run_in_context(list_subtasks, task_id)
                 response = self.format_subtask_list(subtasks, task.title)
 
-                kb = self.get_parent_task_keyboard(task_id)
+                kb = await db_pool.run_in_context(self.get_parent_task_keyboard, task_id)
 
                 await self.bot.send_message(
                     response,
@@ -478,6 +478,7 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при просмотре задачи")
 
         @bot.on_button_callback(lambda data: data.payload.startswith('complete_'))
+        @handler_session
         async def complete_specific_task(cb):
             try:
                 if cb.payload.startswith('complete_parent_'):
@@ -494,23 +495,23 @@ class TaskBot:
 
                 task_id = int(task_id_str)
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
 
-                task = get_task_by_id(task_id)
+                task = await db_pool.run_in_context(get_task_by_id, task_id)
                 if not task:
                     await cb.answer("❌ Задача не найдена")
                     return
 
-                completed_task = complete_task(user_id, task_id)
+                completed_task = await db_pool.run_in_context(complete_task, user_id, task_id)
 
                 if not completed_task:
                     await cb.answer("❌ Задача не найдена")
                     return
 
                 if task.parent_id:
-                    parent_task = get_task_by_id(task.parent_id)
+                    parent_task = await db_pool.run_in_context(get_task_by_id, task.parent_id)
                     if parent_task:
-                        subtasks = list_subtasks(parent_task.id)
+                        subtasks = await db_pool.run_in_context(list_subtasks, parent_task.id)
                         completed = len([t for t in subtasks if t.status == 'done'])
                         total = len(subtasks)
                         
@@ -520,7 +521,7 @@ class TaskBot:
                         if completed == total:
                             response += "🎉 **Все подзадачи выполнены! Задача завершена автоматически!**"
                         
-                        kb = self.get_parent_task_keyboard(parent_task.id)
+                        kb = await db_pool.run_in_context(self.get_parent_task_keyboard, parent_task.id)
                         
                         await self.bot.send_message(
                             response,
@@ -529,8 +530,8 @@ class TaskBot:
                         )
                         return
 
-                updated_tasks = list_tasks(user_id)
-                task_text = self.format_task_list(updated_tasks)
+                updated_tasks = await db_pool.run_in_context(list_tasks, user_id)
+                task_text = await db_pool.run_in_context(self.format_task_list, updated_tasks)
 
                 await self.bot.send_message(
                     f"✅ **Задача '{completed_task['title']}' завершена!** 🎉\n\n{task_text}",
@@ -545,6 +546,7 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при завершении задачи")
 
         @bot.on_button_callback(lambda data: data.payload.startswith('complete_parent_'))
+        @handler_session
         async def complete_parent_task_handler(cb):
             try:
                 if not cb.payload.startswith('complete_parent_') or len(cb.payload.split('_')) < 3:
@@ -559,14 +561,14 @@ class TaskBot:
                 parent_task_id = int(parent_task_id_str)
                 user_id = self.normalize_user_id(cb.user)
 
-                completed_task = complete_parent_task(parent_task_id)
+                completed_task = await db_pool.run_in_context(complete_parent_task, parent_task_id)
 
                 if not completed_task:
                     await cb.answer("❌ Задача не найдена")
                     return
 
-                updated_tasks = list_tasks(user_id)
-                task_text = self.format_task_list(updated_tasks)
+                updated_tasks = await db_pool.run_in_context(list_tasks, user_id)
+                task_text = await db_pool.run_in_context(self.format_task_list, updated_tasks)
 
                 await self.bot.send_message(
                     f"🎉 **Вся задача завершена!**\n\n"
@@ -582,6 +584,7 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при завершении задачи")
 
         @bot.on_button_callback(lambda data: data.payload.startswith('refresh_parent_'))
+        @handler_session
         async def refresh_parent_task_handler(cb):
             try:
                 if not cb.payload.startswith('refresh_parent_') or len(cb.payload.split('_')) < 3:
@@ -594,19 +597,19 @@ class TaskBot:
                     return
 
                 task_id = int(task_id_str)
-                task = get_task_by_id(task_id)
+                task = await db_pool.run_in_context(get_task_by_id, task_id)
 
                 if not task or not task.is_parent:
                     await cb.answer("❌ Задача не найдена или не является родительской")
                     return
 
-                subtasks = list_subtasks(task_id)
+                subtasks = await db_pool.run_in_context(list_subtasks, task_id)
                 response = self.format_subtask_list(subtasks, task.title)
 
                 await self.bot.send_message(
                     response,
                     cb.message.recipient.chat_id,
-                    keyboard=self.get_parent_task_keyboard(task_id)
+                    keyboard=await db_pool.run_in_context(self.get_parent_task_keyboard, task_id)
                 )
 
             except Exception as e:
@@ -614,10 +617,11 @@ class TaskBot:
                 await cb.answer("❌ Ошибка при обновлении задачи")
 
         @bot.on_button_callback('motivation')
+        @handler_session
         async def motivation_handler(cb):
             try:
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
                 q = random_motivation()
@@ -630,9 +634,10 @@ class TaskBot:
                 await cb.answer("❌ Не могу найти мотивацию...")
 
         @bot.on_button_callback('decompose_task')
+        @handler_session
         async def decompose_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
 
             await cb.answer(
@@ -645,16 +650,16 @@ class TaskBot:
             )
 
         @bot.on_button_callback('analyze_day')
+        @handler_session
         async def analyze_handler(cb):
             try:
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
                 self.update_user_activity(user_id)
 
-                tasks = list_tasks(user_id)
-                user = get_or_create_user(user_id)
+                user = await db_pool.run_in_context(get_or_create_user, user_id)
 
-                res = ai_enhanced_daily_analysis(user, tasks)
+                res = await ai_pool.run_in_context(ai_enhanced_daily_analysis, user)
 
                 await cb.answer(
                     text=res['text'],
@@ -666,9 +671,8 @@ class TaskBot:
             except Exception as e:
                 logging.exception("Error in analyze_handler")
                 try:
-                    tasks = list_tasks(user_id)
-                    user = get_or_create_user(user_id)
-                    res = analyze_day(user, tasks)
+                    user = await db_pool.run_in_context(get_or_create_user, user_id)
+                    res = await db_pool.run_in_context(analyze_day, user)
                     await cb.answer(
                         text=f"📊 **Анализ дня:**\n\n{res['text']}",
                         keyboard=self.get_back_keyboard()
@@ -677,9 +681,10 @@ class TaskBot:
                     await cb.answer("❌ Ошибка при анализе дня")
 
         @bot.on_button_callback('add_study')
+        @handler_session
         async def add_study_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
             
             await cb.answer(
@@ -691,9 +696,10 @@ class TaskBot:
             )
 
         @bot.on_button_callback('add_work')
+        @handler_session
         async def add_work_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
             
             await cb.answer(
@@ -705,9 +711,10 @@ class TaskBot:
             )
 
         @bot.on_button_callback('add_home')
+        @handler_session
         async def add_home_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
             
             await cb.answer(
@@ -719,9 +726,10 @@ class TaskBot:
             )
 
         @bot.on_button_callback('add_personal')
+        @handler_session
         async def add_personal_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
             self.update_user_activity(user_id)
             
             await cb.answer(
@@ -733,12 +741,12 @@ class TaskBot:
             )
 
         @bot.on_button_callback('back_main')
+        @handler_session
         async def back_main_handler(cb):
             user_id = self.normalize_user_id(cb.user)
-            self.active_chats[user_id] = cb.message.recipient.chat_id
+            self.state.set_chat(user_id, cb.message.recipient.chat_id)
 
-            if user_id in self.pagination_state:
-                del self.pagination_state[user_id]
+            self.state.clear_pagination(user_id)
 
             await cb.answer(
                 text="🏠 **Главное меню**",
@@ -746,10 +754,11 @@ class TaskBot:
             )
 
         @bot.on_command('add')
+        @handler_session
         async def cmd_add(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
                 text = ctx.message.body.text or ""
@@ -800,12 +809,12 @@ class TaskBot:
                     return
 
                 if parent_task_id:
-                    task = add_subtask(user_id, parent_task_id, title, est, diff)
+                    task = await db_pool.run_in_context(add_subtask, user_id, parent_task_id, title, est, diff)
                 else:
-                    task = add_task_for_user(user_id, title, estimated_minutes=est, difficulty=diff, task_date=task_date)
+                    task = await db_pool.run_in_context(add_task_for_user, user_id, title, estimated_minutes=est, difficulty=diff, task_date=task_date)
 
-                updated_tasks = list_tasks(user_id)
-                task_text = self.format_task_list(updated_tasks)
+                updated_tasks = await db_pool.run_in_context(list_tasks, user_id)
+                task_text = await db_pool.run_in_context(self.format_task_list, updated_tasks)
 
                 date_info = ""
                 if task_date:
@@ -813,7 +822,7 @@ class TaskBot:
 
                 parent_info = ""
                 if parent_task_id:
-                    parent_task = get_task_by_id(parent_task_id)
+                    parent_task = await db_pool.run_in_context(get_task_by_id, parent_task_id)
                     if parent_task:
                         parent_info = f"\n\n🎯 Подзадача для: '{parent_task.title}'"
 
@@ -849,13 +858,15 @@ class TaskBot:
                 )
 
         @bot.on_command('list_tasks')
+        @handler_session
         async def cmd_list(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
-                tasks = list_tasks(user_id)
+                # Только чтение: задачи и прогресс берутся через aiosqlite, без потока db_pool
+                tasks = await services_async.list_tasks(user_id)
                 logging.info(f"📋 Пользователь {user_id} запросил список задач: {len(tasks)} задач")
                 
                 if not tasks:
@@ -869,14 +880,15 @@ class TaskBot:
                     )
                     return
                     
-                task_text = self.format_task_list(tasks)
+                progress_map = await services_async.get_task_progress_bulk(t.id for t in tasks if t.is_parent)
+                task_text = self.format_task_list(tasks, progress_map)
                 
                 parent_tasks = [t for t in tasks if t.is_parent and t.status != 'done']
                 if parent_tasks:
                     kb = buttons.KeyboardBuilder()
                     
                     for task in parent_tasks[:4]:  
-                        completed, total, _ = get_task_progress(task.id)
+                        completed, total, _ = progress_map[task.id]
                         label = f"🎯 {task.title[:18]} ({completed}/{total})"
                         kb.add(buttons.CallbackButton(label, f'view_parent_{task.id}'))
                     
@@ -897,24 +909,25 @@ class TaskBot:
                 )
 
         @bot.on_command('complete')
+        @handler_session
         async def cmd_complete(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
                 text = ctx.message.body.text or ""
                 arg = text[len("/complete"):].strip()
 
                 if not arg or not arg.isdigit():
-                    tasks = list_tasks(user_id)
-                    kb, message = self.get_paginated_task_selector(user_id, tasks, 'complete')
+                    tasks = await db_pool.run_in_context(list_tasks, user_id)
+                    kb, message = await db_pool.run_in_context(self.get_paginated_task_selector, user_id, tasks, 'complete')
                     full_message = f"✅ **Завершение задач**\n\n{message}"
                     await ctx.reply(full_message, keyboard=kb)
                     return
 
                 # Получаем все задачи для преобразования номера в реальный ID
-                tasks = list_tasks(user_id)
+                tasks = await db_pool.run_in_context(list_tasks, user_id)
                 pending_tasks = [t for t in tasks if t.status != 'done']
                 regular_tasks = [t for t in pending_tasks if not t.parent_id and not t.is_parent]
                 parent_tasks = [t for t in pending_tasks if t.is_parent]
@@ -933,7 +946,7 @@ class TaskBot:
                 selected_task = all_display_tasks[task_index]
                 task_id = selected_task.id
 
-                task = get_task_by_id(task_id)
+                task = await db_pool.run_in_context(get_task_by_id, task_id)
 
                 if not task:
                     await ctx.reply(
@@ -944,15 +957,15 @@ class TaskBot:
                     return
 
                 if task.is_parent:
-                    subtasks = list_subtasks(task_id)
+                    subtasks = await db_pool.run_in_context(list_subtasks, task_id)
                     response = self.format_subtask_list(subtasks, task.title)
 
                     await ctx.reply(
                         text=response,
-                        keyboard=self.get_parent_task_keyboard(task_id)
+                        keyboard=await db_pool.run_in_context(self.get_parent_task_keyboard, task_id)
                     )
                     return
-                completed_task = complete_task(user_id, task_id)
+                completed_task = await db_pool.run_in_context(complete_task, user_id, task_id)
 
                 if not completed_task:
                     await ctx.reply(
@@ -961,8 +974,8 @@ class TaskBot:
                         keyboard=self.get_main_keyboard()
                     )
                 else:
-                    updated_tasks = list_tasks(user_id)
-                    task_text = self.format_task_list(updated_tasks)
+                    updated_tasks = await db_pool.run_in_context(list_tasks, user_id)
+                    task_text = await db_pool.run_in_context(self.format_task_list, updated_tasks)
 
                     await ctx.reply(
                         f"✅ **Задача завершена!**\n\n"
@@ -979,10 +992,11 @@ class TaskBot:
                 )
 
         @bot.on_command('motivation')
+        @handler_session
         async def cmd_motivation(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
                 q = random_motivation()
@@ -998,10 +1012,11 @@ class TaskBot:
                 )
 
         @bot.on_command('decompose')
+        @handler_session
         async def cmd_decompose(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
                 text = ctx.message.body.text or ""
@@ -1016,34 +1031,48 @@ class TaskBot:
                     )
                     return
 
-                hints = []
+                title = arg
 
                 if arg.isdigit():
-                    tasks = list_tasks(user_id)
+                    tasks = await db_pool.run_in_context(list_tasks, user_id)
                     found_task = None
                     for t in tasks:
                         if t.id == int(arg):
                             found_task = t
                             break
 
-                    if found_task:
-                        hints = decompose_task(found_task.title, user_id)
-                        response = f"🔍 **Разложение задачи:**\n'{found_task.title}'\n\n" + "\n".join(
-                            [f"{i + 1}. {step}" for i, step in enumerate(hints)])
-                    else:
+                    if not found_task:
                         await ctx.reply(
                             "❌ Задача с таким ID не найдена",
                             keyboard=self.get_main_keyboard()
                         )
                         return
-                else:
-                    hints = decompose_task(arg, user_id)
-                    response = f"🔍 **Разложение задачи:**\n'{arg}'\n\n" + "\n".join(
-                        [f"{i + 1}. {step}" for i, step in enumerate(hints)])
+                    title = found_task.title
+
+                try:
+                    job = decomposition_jobs.submit(title, user_id)
+                except JobQueueFull as e:
+                    await ctx.reply(f"⏳ {e}", keyboard=self.get_main_keyboard())
+                    return
+
+                progress_message = await ctx.reply(f"⏳ Раскладываю задачу '{title}' на шаги...")
+
+                job = await decomposition_jobs.wait(job)
+                if job.status != 'done':
+                    await progress_message.edit(
+                        "❌ Ошибка при разложении задачи",
+                        keyboard=self.get_main_keyboard()
+                    )
+                    return
 
+                hints = job.steps or []
+                response = f"🔍 **Разложение задачи:**\n'{title}'\n\n" + "\n".join(
+                    [f"{i + 1}. {step}" for i, step in enumerate(hints)])
                 response += f"\n\n✅ **Создано {len(hints)} подзадач!** Проверь список задач."
+                if job.fallback:
+                    response += "\n⚠️ GigaChat не ответил — шаги составлены по шаблону."
 
-                await ctx.reply(response, keyboard=self.get_main_keyboard())
+                await progress_message.edit(response, keyboard=self.get_main_keyboard())
 
             except Exception as e:
                 logging.exception("Error in cmd_decompose")
@@ -1053,16 +1082,16 @@ class TaskBot:
                 )
 
         @bot.on_command('analyze')
+        @handler_session
         async def cmd_analyze(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
-                tasks = list_tasks(user_id)
-                user = get_or_create_user(user_id)
+                user = await db_pool.run_in_context(get_or_create_user, user_id)
 
-                res = ai_enhanced_daily_analysis(user, tasks)
+                res = await ai_pool.run_in_context(ai_enhanced_daily_analysis, user)
 
                 await ctx.reply(
                     res['text'],
@@ -1074,9 +1103,8 @@ class TaskBot:
             except Exception as e:
                 logging.exception("Error in cmd_analyze")
                 try:
-                    tasks = list_tasks(user_id)
-                    user = get_or_create_user(user_id)
-                    res = analyze_day(user, tasks)
+                    user = await db_pool.run_in_context(get_or_create_user, user_id)
+                    res = await db_pool.run_in_context(analyze_day, user)
                     await ctx.reply(
                         f"📊 **Анализ дня:**\n\n{res['text']}",
                         keyboard=self.get_main_keyboard()
@@ -1088,10 +1116,11 @@ class TaskBot:
                     )
 
         @bot.on_message()
+        @handler_session
         async def handle_all_messages(message):
             try:
                 user_id = self.normalize_user_id(message.sender)
-                self.active_chats[user_id] = message.recipient.chat_id
+                self.state.set_chat(user_id, message.recipient.chat_id)
                 self.update_user_activity(user_id)
                 
                 text = message.body.text or ""
@@ -1118,15 +1147,14 @@ class TaskBot:
                 logging.exception("Error in handle_all_messages")
 
         @bot.on_command('test_notification')
+        @handler_session
         async def cmd_test_notification(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
-                self.last_activity[user_id] = datetime.now() - timedelta(minutes=2)
-
-                await self._check_inactive_users(test_mode=True)
+                self.reminders.enqueue(user_id, test_mode=True)
 
                 await ctx.reply(
                     "🧪 Тест запущен! Проверяю систему уведомлений...\n",
@@ -1138,12 +1166,13 @@ class TaskBot:
                 await ctx.reply("❌ Ошибка тестирования")
 
         @bot.on_command('force_notification')
+        @handler_session
         async def cmd_force_notification(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
 
-                await self._send_inactivity_notification(user_id, test_mode=True)
+                self.reminders.enqueue(user_id, test_mode=True)
 
                 await ctx.reply(
                     "✅ Тестовое уведомление отправлено! Проверь сообщения от бота.",
@@ -1155,13 +1184,14 @@ class TaskBot:
                 await ctx.reply("❌ Ошибка отправки уведомления")
 
         @bot.on_command('check_activity')
+        @handler_session
         async def cmd_check_activity(ctx):
             try:
                 user_id = self.normalize_user_id(ctx.sender)
-                self.active_chats[user_id] = ctx.recipient.chat_id
+                self.state.set_chat(user_id, ctx.recipient.chat_id)
                 self.update_user_activity(user_id)
 
-                last_active = self.last_activity.get(user_id)
+                last_active = self.state.get_activity(user_id)
                 if last_active:
                     time_diff = datetime.now() - last_active
                     minutes_diff = int(time_diff.total_seconds() / 60)
@@ -1171,8 +1201,9 @@ class TaskBot:
                         f"📊 **Статус активности:**\n\n"
                         f"🕐 Последняя активность: {last_active.strftime('%H:%M:%S')}\n"
                         f"⏱ Прошло времени: {hours_diff}ч {minutes_diff % 60}м\n"
-                        f"👥 Активных пользователей: {len(self.last_activity)}\n\n"
-                        f"💡 Уведомление придет через 4 часа неактивности",
+                        f"👥 Активных пользователей: {self.state.count()}\n\n"
+                        f"💡 Уведомление придет через 4 часа неактивности"
+                        f" (в {self.reminders.due_for(user_id).strftime('%H:%M')})",
                         keyboard=self.get_main_keyboard()
                     )
                 else:
@@ -1186,22 +1217,24 @@ class TaskBot:
                 await ctx.reply("❌ Ошибка проверки активности")
 
         @bot.on_button_callback(lambda data: data.payload.startswith('page_'))
+        @handler_session
         async def pagination_handler(cb):
             try:
                 user_id = self.normalize_user_id(cb.user)
-                self.active_chats[user_id] = cb.message.recipient.chat_id
+                self.state.set_chat(user_id, cb.message.recipient.chat_id)
                 self.update_user_activity(user_id)
 
                 page_num = int(cb.payload.split('_')[1])
 
-                if user_id in self.pagination_state:
-                    self.pagination_state[user_id]['page'] = page_num
-                    action_type = self.pagination_state[user_id]['action']
+                state = self.state.get_pagination(user_id)
+                if state is not None:
+                    state['page'] = page_num
+                    action_type = state['action']
                 else:
                     action_type = 'complete'
 
-                tasks = list_tasks(user_id)
-                kb, message = self.get_paginated_task_selector(user_id, tasks, action_type)
+                tasks = await db_pool.run_in_context(list_tasks, user_id)
+                kb, message = await db_pool.run_in_context(self.get_paginated_task_selector, user_id, tasks, action_type)
 
                 if action_type == 'complete':
                     full_message = f"✅ **Завершение задач**\n\n{message}"
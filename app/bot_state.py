@@ -0,0 +1,275 @@
+import datetime
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import acquire_session, release_session, BotChatState
+from executors import db_pool
+
+# Состояние бота по пользователю: чат для напоминаний, время последней
+# активности и позиция в постраничном выборе задач. Хранилище ограничено
+# по размеру (LRU) и по времени простоя (TTL), поэтому память не растет
+# с числом всех, кто когда-либо писал боту. Синхронные методы работают
+# только с памятью и вызываются прямо из event loop бота; обращения к базе
+# идут через db_pool.
+
+class UserState:
+    __slots__ = ('chat_id', 'last_activity', 'pagination', 'touched_at')
+
+    def __init__(self, chat_id=None, last_activity=None):
+        self.chat_id = chat_id
+        self.last_activity = last_activity
+        self.pagination = None
+        self.touched_at = time.monotonic()
+
+class MemoryStateStore:
+    """Состояние в памяти: LRU с ограничением размера и времени простоя"""
+
+    def __init__(self, max_users=None, ttl_hours=None):
+        self.max_users = max_users or int(os.getenv('BOT_STATE_MAX_USERS', '10000'))
+        self.ttl = (ttl_hours or float(os.getenv('BOT_STATE_TTL_HOURS', '168'))) * 3600
+        self._records = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def _get(self, user_id, create=False):
+        with self._lock:
+            record = self._records.get(user_id)
+            now = time.monotonic()
+            if record and now - record.touched_at > self.ttl:
+                del self._records[user_id]
+                self._stats['expired'] += 1
+                record = None
+
+            if record:
+                self._stats['hits'] += 1
+            else:
+                self._stats['misses'] += 1
+                if not create:
+                    return None
+                record = self._records[user_id] = UserState()
+                self._evict()
+
+            record.touched_at = now
+            self._records.move_to_end(user_id)
+            return record
+
+    def _evict(self):
+        while len(self._records) > self.max_users:
+            self._records.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get_chat(self, user_id):
+        record = self._get(user_id)
+        return record.chat_id if record else None
+
+    def set_chat(self, user_id, chat_id):
+        self._get(user_id, create=True).chat_id = chat_id
+
+    def get_activity(self, user_id):
+        record = self._get(user_id)
+        return record.last_activity if record else None
+
+    def set_activity(self, user_id, when):
+        self._get(user_id, create=True).last_activity = when
+
+    def get_pagination(self, user_id):
+        record = self._get(user_id)
+        return record.pagination if record else None
+
+    def set_pagination(self, user_id, state):
+        self._get(user_id, create=True).pagination = state
+
+    def clear_pagination(self, user_id):
+        record = self._get(user_id)
+        if record:
+            record.pagination = None
+
+    def known_activity(self):
+        """Время последней активности пользователей с известным чатом: {user_id: datetime}"""
+        with self._lock:
+            return {
+                user_id: record.last_activity for user_id, record in self._records.items()
+                if record.chat_id and record.last_activity
+            }
+
+    async def fetch_chat(self, user_id):
+        """Чат пользователя, в том числе уже вытесненного из памяти"""
+        return self.get_chat(user_id)
+
+    async def fetch_known_activity(self):
+        return self.known_activity()
+
+    def count(self):
+        with self._lock:
+            return len(self._records)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._records)
+            stats['max_users'] = self.max_users
+            stats['approx_bytes'] = sum(
+                sys.getsizeof(user_id) + sys.getsizeof(record) for user_id, record in self._records.items()
+            )
+        stats['backend'] = type(self).__name__
+        return stats
+
+class SqliteStateStore(MemoryStateStore):
+    """Память как кэш поверх таблицы bot_chat_states: чаты и активность переживают перезапуск.
+
+    Запись в базу отложенная: изменения копятся в памяти и одним пакетом
+    уходят в db_pool. Постраничный выбор задач хранится только в памяти,
+    время активности записывается не чаще раза в BOT_STATE_WRITE_INTERVAL секунд.
+    """
+
+    def __init__(self, max_users=None, ttl_hours=None, write_interval=None):
+        super().__init__(max_users, ttl_hours)
+        self.write_interval = datetime.timedelta(
+            seconds=write_interval or float(os.getenv('BOT_STATE_WRITE_INTERVAL', '60'))
+        )
+        self._persisted_activity = {}
+        self._pending = {}
+        self._flush_scheduled = False
+        self._stats.update({'db_reads': 0, 'db_writes': 0})
+        self._writes_since_prune = 0
+
+    def _load(self, user_id):
+        db, session_token = acquire_session()
+        try:
+            row = db.query(BotChatState.chat_id, BotChatState.last_activity).filter(
+                BotChatState.user_id == user_id
+            ).first()
+            with self._lock:
+                self._stats['db_reads'] += 1
+            return row
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения состояния бота: {e}")
+            return None
+        finally:
+            release_session(db, session_token)
+
+    def _evict(self):
+        while len(self._records) > self.max_users:
+            user_id, _ = self._records.popitem(last=False)
+            self._persisted_activity.pop(user_id, None)
+            self._stats['evictions'] += 1
+
+    def _save(self, user_id, **values):
+        with self._lock:
+            self._pending.setdefault(user_id, {}).update(values)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        db_pool.submit(self._flush)
+
+    def _flush(self):
+        # Пока идет запись, новые изменения копятся в _pending и уходят следующим пакетом
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if not pending:
+                    self._flush_scheduled = False
+                    return
+            self._write(pending)
+
+    def _write(self, pending):
+        now = datetime.datetime.utcnow()
+        groups = {}
+        for user_id, values in pending.items():
+            groups.setdefault(tuple(sorted(values)), []).append({'user_id': user_id, 'updated_at': now, **values})
+
+        db, session_token = acquire_session()
+        try:
+            for columns, rows in groups.items():
+                stmt = sqlite_insert(BotChatState.__table__)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['user_id'],
+                    set_={c: stmt.excluded[c] for c in columns + ('updated_at',)}
+                )
+                db.execute(stmt, rows)
+            db.commit()
+
+            with self._lock:
+                self._stats['db_writes'] += len(pending)
+                self._writes_since_prune += len(pending)
+                should_prune = self._writes_since_prune >= 500
+                if should_prune:
+                    self._writes_since_prune = 0
+            if should_prune:
+                self.prune(db)
+        except Exception as e:
+            db.rollback()
+            print(f"⚠️ Ошибка записи состояния бота: {e}")
+        finally:
+            release_session(db, session_token)
+
+    def set_chat(self, user_id, chat_id):
+        record = self._get(user_id, create=True)
+        if record.chat_id != chat_id:
+            record.chat_id = chat_id
+            self._save(user_id, chat_id=chat_id)
+
+    def set_activity(self, user_id, when):
+        record = self._get(user_id, create=True)
+        record.last_activity = when
+
+        persisted = self._persisted_activity.get(user_id)
+        if persisted is None or abs(when - persisted) >= self.write_interval:
+            self._persisted_activity[user_id] = when
+            self._save(user_id, last_activity=when)
+
+    async def fetch_chat(self, user_id):
+        chat_id = self.get_chat(user_id)
+        if chat_id is not None:
+            return chat_id
+
+        row = await db_pool.run(self._load, user_id)
+        if row is None or row.chat_id is None:
+            return None
+
+        with self._lock:
+            record = self._get(user_id, create=True)
+            if record.chat_id is None:
+                record.chat_id = row.chat_id
+            if record.last_activity is None:
+                record.last_activity = row.last_activity
+            self._persisted_activity.setdefault(user_id, row.last_activity)
+            return record.chat_id
+
+    def known_activity(self):
+        db, session_token = acquire_session()
+        try:
+            activity = dict(db.query(BotChatState.user_id, BotChatState.last_activity).filter(
+                BotChatState.chat_id.isnot(None),
+                BotChatState.last_activity.isnot(None)
+            ).all())
+        finally:
+            release_session(db, session_token)
+
+        # В памяти время активности свежее: в базу оно пишется с задержкой
+        activity.update(super().known_activity())
+        return activity
+
+    async def fetch_known_activity(self):
+        return await db_pool.run(self.known_activity)
+
+    def prune(self, db):
+        threshold = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        removed = db.query(BotChatState).filter(
+            BotChatState.updated_at < threshold
+        ).delete(synchronize_session=False)
+        db.commit()
+        return removed
+
+def make_state_store():
+    backend = os.getenv('BOT_STATE_BACKEND', 'sqlite').lower()
+    if backend == 'memory':
+        return MemoryStateStore()
+    return SqliteStateStore()
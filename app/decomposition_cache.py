@@ -0,0 +1,169 @@
+import datetime
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import SessionLocal, DecompositionCacheEntry
+
+class DecompositionCache:
+    """Кэш разложений задач: LRU в памяти поверх таблицы decomposition_cache.
+
+    Читает и пишет в своей короткой сессии: ошибка кэша не откатывает транзакцию
+    вызывающего, а счетчики попаданий не держат ее открытой. ttl_hours=0 отключает кэш.
+    """
+
+    def __init__(self, prompt_version="v1", memory_size=None, max_rows=None, ttl_hours=None):
+        self.prompt_version = prompt_version
+        if memory_size is None:
+            memory_size = int(os.getenv('DECOMPOSE_CACHE_MEMORY_SIZE', '256'))
+        if max_rows is None:
+            max_rows = int(os.getenv('DECOMPOSE_CACHE_MAX_ROWS', '5000'))
+        if ttl_hours is None:
+            ttl_hours = float(os.getenv('DECOMPOSE_CACHE_TTL_HOURS', '720'))
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.ttl = datetime.timedelta(hours=ttl_hours)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self._stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def make_key(self, title: str) -> str:
+        normalized = ' '.join(title.casefold().split())
+        return f"{self.prompt_version}:{normalized}"
+
+    def _is_expired(self, stored_at: datetime.datetime) -> bool:
+        return stored_at < datetime.datetime.utcnow() - self.ttl
+
+    def _remember(self, key, steps, stored_at):
+        with self._lock:
+            self._memory[key] = (steps, stored_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _bump(self, counter, amount=1):
+        with self._lock:
+            self._stats[counter] += amount
+
+    @contextmanager
+    def _session(self):
+        db = SessionLocal()
+        try:
+            yield db
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > datetime.timedelta(0)
+
+    def get(self, title: str) -> Optional[List[str]]:
+        if not self.enabled:
+            return None
+        key = self.make_key(title)
+
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached and not self._is_expired(cached[1]):
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return list(cached[0])
+            if cached:
+                del self._memory[key]
+
+        try:
+            with self._session() as db:
+                entry = db.query(DecompositionCacheEntry).filter_by(key=key).first()
+                if not entry:
+                    self._bump('misses')
+                    return None
+
+                if self._is_expired(entry.created_at):
+                    db.delete(entry)
+                    self._bump('misses')
+                    self._bump('evictions')
+                    return None
+
+                steps = json.loads(entry.steps)
+                stored_at = entry.created_at
+                entry.hits = (entry.hits or 0) + 1
+                entry.last_used_at = datetime.datetime.utcnow()
+
+            self._remember(key, steps, stored_at)
+            self._bump('db_hits')
+            return list(steps)
+        except Exception as e:
+            print(f"⚠️ Ошибка чтения кэша разложений: {e}")
+            self._bump('misses')
+            return None
+
+    def put(self, title: str, steps: List[str]):
+        if not steps or not self.enabled:
+            return
+
+        key = self.make_key(title)
+        now = datetime.datetime.utcnow()
+        self._remember(key, list(steps), now)
+
+        try:
+            with self._session() as db:
+                db.merge(DecompositionCacheEntry(
+                    key=key,
+                    title=title,
+                    steps=json.dumps(steps, ensure_ascii=False),
+                    created_at=now,
+                    last_used_at=now,
+                    hits=0
+                ))
+            self._bump('stores')
+
+            with self._lock:
+                self._writes_since_prune += 1
+                should_prune = self._writes_since_prune >= 50
+                if should_prune:
+                    self._writes_since_prune = 0
+            if should_prune:
+                self.prune()
+        except Exception as e:
+            print(f"⚠️ Ошибка записи кэша разложений: {e}")
+
+    def prune(self):
+        try:
+            with self._session() as db:
+                removed = db.query(DecompositionCacheEntry).filter(
+                    DecompositionCacheEntry.created_at < datetime.datetime.utcnow() - self.ttl
+                ).delete(synchronize_session=False)
+
+                overflow = db.query(DecompositionCacheEntry).count() - self.max_rows
+                if overflow > 0:
+                    stale_keys = db.query(DecompositionCacheEntry.key).order_by(
+                        DecompositionCacheEntry.last_used_at
+                    ).limit(overflow).subquery()
+                    removed += db.query(DecompositionCacheEntry).filter(
+                        DecompositionCacheEntry.key.in_(stale_keys.select())
+                    ).delete(synchronize_session=False)
+
+            self._bump('evictions', removed)
+            return removed
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки кэша разложений: {e}")
+            return 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / lookups * 100, 1) if lookups else 0
+        return stats
@@ -0,0 +1,205 @@
+import asyncio
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import SessionLocal, BusEvent, SYNC_EVENTS_KEY
+
+# Шина изменений: сервисы меняют задачи и карточки через ORM, события модели
+# складывают изменения в сессию, а после коммита они уходят подписчикам
+# (SSE-поток /events/stream). Доставка идет через транспорт:
+#   local  — внутри процесса (API и бот в main.py работают в одном процессе);
+#   sqlite — через таблицу bus_events, чтобы события видели все воркеры uvicorn.
+
+class Subscription:
+    """Очередь событий одного подписчика, привязанная к его event loop"""
+
+    def __init__(self, bus, user_id, max_queue):
+        self.bus = bus
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def _deliver(self, message):
+        if self.queue.full():
+            # Клиент не успевает читать: старые события выбрасываем, а ему
+            # отправляем resync — пусть заберет все через /sync/changes
+            self.dropped += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            message = {'type': 'resync'}
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class LocalTransport:
+    """Доставка в том же процессе"""
+
+    def start(self, bus):
+        self.bus = bus
+
+    def send(self, user_id, message):
+        self.bus.dispatch(user_id, message)
+
+class SqliteTransport:
+    """Доставка через таблицу bus_events: каждый процесс пишет свои события и читает чужие"""
+
+    def __init__(self, poll_interval=None, retention_seconds=None):
+        self.poll_interval = poll_interval or float(os.getenv('EVENT_BUS_POLL_INTERVAL', '0.5'))
+        self.retention = datetime.timedelta(seconds=retention_seconds or int(os.getenv('EVENT_BUS_RETENTION_SECONDS', '300')))
+        self._outbox = deque()
+        self._wakeup = threading.Event()
+        self._last_id = 0
+        self._last_prune = 0.0
+
+    def start(self, bus):
+        self.bus = bus
+        thread = threading.Thread(target=self._loop, name="event-bus-sqlite", daemon=True)
+        thread.start()
+
+    def send(self, user_id, message):
+        # Запись в базу делает поток транспорта, а не коммитящий поток
+        self._outbox.append((user_id, message))
+        self._wakeup.set()
+
+    def _flush_outbox(self, db):
+        rows = []
+        while self._outbox:
+            user_id, message = self._outbox.popleft()
+            rows.append(BusEvent(user_id=user_id, payload=json.dumps(message, default=str)))
+        if rows:
+            db.add_all(rows)
+            db.commit()
+
+    def _poll(self, db):
+        for row in db.query(BusEvent.id, BusEvent.user_id, BusEvent.payload).filter(
+            BusEvent.id > self._last_id
+        ).order_by(BusEvent.id):
+            self._last_id = row.id
+            self.bus.dispatch(row.user_id, json.loads(row.payload))
+
+    def _prune(self, db):
+        if time.monotonic() - self._last_prune < self.retention.total_seconds() / 2:
+            return
+        self._last_prune = time.monotonic()
+        threshold = datetime.datetime.utcnow() - self.retention
+        db.query(BusEvent).filter(BusEvent.created_at < threshold).delete(synchronize_session=False)
+        db.commit()
+
+    def _loop(self):
+        # Подписчики получают только события, записанные после старта транспорта
+        db = SessionLocal()
+        try:
+            self._last_id = db.query(BusEvent.id).order_by(BusEvent.id.desc()).limit(1).scalar() or 0
+        finally:
+            db.close()
+
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+            db = SessionLocal()
+            try:
+                self._flush_outbox(db)
+                self._poll(db)
+                self._prune(db)
+            except Exception as e:
+                db.rollback()
+                print(f"❌ Ошибка шины событий: {e}")
+            finally:
+                db.close()
+
+class EventBus:
+    """Подписки на изменения по пользователю"""
+
+    def __init__(self, transport, max_queue=None):
+        self.transport = transport
+        self.max_queue = max_queue or int(os.getenv('EVENT_BUS_QUEUE_SIZE', '100'))
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self._stats = {'published': 0, 'delivered': 0}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.transport.start(self)
+
+    def publish(self, user_id, message):
+        self._ensure_started()
+        with self._lock:
+            self._stats['published'] += 1
+        self.transport.send(user_id, message)
+
+    def dispatch(self, user_id, message):
+        """Раздать событие подписчикам этого процесса; вызывается из любого потока"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+            self._stats['delivered'] += len(subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, message)
+            except RuntimeError:
+                # event loop подписчика уже закрыт
+                subscription.close()
+
+    def subscribe(self, user_id):
+        """Новая подписка; вызывать из event loop, в котором события будут читаться"""
+        self._ensure_started()
+        subscription = Subscription(self, user_id, self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._subscribers)
+            stats['subscriptions'] = sum(len(s) for s in self._subscribers.values())
+        stats['transport'] = type(self.transport).__name__
+        return stats
+
+def _make_transport():
+    backend = os.getenv('EVENT_BUS_BACKEND', 'local').lower()
+    if backend == 'sqlite':
+        return SqliteTransport()
+    return LocalTransport()
+
+event_bus = EventBus(_make_transport())
+
+@event.listens_for(Session, 'after_commit')
+def _publish_sync_events(session):
+    for user_id, message in session.info.pop(SYNC_EVENTS_KEY, ()):
+        event_bus.publish(user_id, message)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_sync_events(session):
+    session.info.pop(SYNC_EVENTS_KEY, None)
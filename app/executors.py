@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class BoundedExecutor:
+    """Именованный пул потоков для блокирующих вызовов с метриками очереди"""
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._run_total = 0.0
+
+    def _call(self, submitted_at, func, args, kwargs):
+        started_at = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._wait_total += started_at - submitted_at
+
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._run_total += time.perf_counter() - started_at
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+
+        return self._executor.submit(self._call, time.perf_counter(), func, args, kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    async def run_in_context(self, func, *args, **kwargs):
+        """Как run, но func видит contextvars вызывающего — например, сессию unit_of_work."""
+        context = contextvars.copy_context()
+        return await self.run(context.run, func, *args, **kwargs)
+
+    def offload(self, func):
+        """Декоратор: синхронный обработчик выполняется в этом пуле, а не в event loop."""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "max_workers": self.max_workers,
+                "queued": self._queued,
+                "active": self._active,
+                "max_queued": self._max_queued,
+                "completed": self._completed,
+                "failed": self._failed,
+                "avg_wait_ms": round(self._wait_total / finished * 1000, 2) if finished else 0,
+                "avg_run_ms": round(self._run_total / finished * 1000, 2) if finished else 0,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+# Быстрые запросы к базе
+db_pool = BoundedExecutor("db", int(os.getenv('DB_POOL_WORKERS', '8')))
+# Долгие вызовы GigaChat (до 30 с) — отдельный пул, чтобы не блокировать db_pool
+ai_pool = BoundedExecutor("ai", int(os.getenv('AI_POOL_WORKERS', '4')))
+
+# Фоновые задания разложения: ограничивают число одновременных разложений
+decompose_pool = BoundedExecutor("decompose", int(os.getenv('DECOMPOSE_POOL_WORKERS', '2')))
+
+def executor_stats():
+    return {pool.name: pool.stats() for pool in (db_pool, ai_pool, decompose_pool)}
+
+class LatencyTracker:
+    """Число вызовов, ошибки и задержка по имени операции"""
+
+    def __init__(self, slow_ms=None):
+        self.slow_ms = slow_ms or float(os.getenv('SLOW_HANDLER_MS', '1000'))
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, seconds, failed=False):
+        with self._lock:
+            stats = self._stats.setdefault(name, {'calls': 0, 'failed': 0, 'slow': 0, 'total': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            if failed:
+                stats['failed'] += 1
+            if seconds * 1000 >= self.slow_ms:
+                stats['slow'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    'calls': s['calls'],
+                    'failed': s['failed'],
+                    'slow': s['slow'],
+                    'avg_ms': round(s['total'] / s['calls'] * 1000, 2),
+                    'max_ms': round(s['max'] * 1000, 2),
+                }
+                for name, s in sorted(self._stats.items())
+            }
+
+# Время обработки апдейтов бота по обработчикам
+bot_handler_latency = LatencyTracker()
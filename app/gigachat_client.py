@@ -1,6 +1,7 @@
 # gigachat_client.py
 import json
 import sys
+import threading
 import requests
 import logging
 import os
@@ -9,13 +10,25 @@ import time
 from typing import List, Optional
 from dotenv import load_dotenv
 import urllib3
+from requests.adapters import HTTPAdapter
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'app'))
 load_dotenv()
 
+# Одна сессия на процесс: keep-alive к GigaChat, соединений не больше пула
+GIGACHAT_POOL_SIZE = int(os.getenv('GIGACHAT_POOL_SIZE', '10'))
+# За сколько секунд до истечения токена обновлять его в фоне
+GIGACHAT_TOKEN_REFRESH_AHEAD = float(os.getenv('GIGACHAT_TOKEN_REFRESH_AHEAD', '60'))
+
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=GIGACHAT_POOL_SIZE, pool_block=True))
+
 class GigaChatClient:
+    # Меняй при изменении промпта разложения — старые ответы в кэше перестанут совпадать
+    decompose_prompt_version = "v1"
+
     def __init__(self):
         # Authorization key - это уже готовый Base64 ключ для Basic аутентификации
         self.auth_key = os.getenv('GIGACHAT_AUTH_KEY') or os.getenv('GIGACHAT_CLIENT_SECRET')
@@ -24,74 +37,92 @@ class GigaChatClient:
         self.token_expires_at = 0
         self.token_url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
         self.api_url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+        self.model = os.getenv('GIGACHAT_MODEL', 'GigaChat')
+        self.timeout = float(os.getenv('GIGACHAT_TIMEOUT', '30'))
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'failures': 0,
+            'token_retries': 0,
+            'latency_total_ms': 0.0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'total_tokens': 0,
+        }
         
         if not self.auth_key:
             logging.error("❌ GIGACHAT_AUTH_KEY not set in .env")
         else:
             logging.info(f"✅ Authorization key loaded (length: {len(self.auth_key)})")
 
-    def get_access_token(self) -> Optional[str]:
-        try:
-            if not self.auth_key:
-                logging.error("❌ Authorization key is missing")
-                return None
-
-            logging.info("🔄 Requesting new GigaChat access token...")
-            
-            payload = {'scope': 'GIGACHAT_API_PERS'}
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'Accept': 'application/json',
-                'RqUID': str(uuid.uuid4()),
-                'Authorization': f'Basic {self.auth_key}'  # Здесь直接用 auth_key
-            }
-
-            response = requests.post(
-                self.token_url, 
-                headers=headers, 
-                data=payload, 
-                verify=False,  # Для тестов, в продакшене используй verify=True
-                timeout=30
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                self.access_token = result.get('access_token')
-                expires_in = result.get('expires_in', 1800)
-                self.token_expires_at = time.time() + expires_in - 120  # Запас 2 минуты
-                
-                logging.info(f"✅ GigaChat token obtained, expires in {expires_in} seconds")
-                logging.info(f"   Token preview: {self.access_token[:20]}...")
-                return self.access_token
-            else:
-                logging.error(f"❌ GigaChat token error: {response.status_code}")
-                logging.error(f"   Response: {response.text}")
-                return None
-
-        except Exception as e:
-            logging.error(f"❌ GigaChat token request failed: {e}")
-            return None
-
     def is_token_valid(self) -> bool:
         if not self.access_token:
             return False
         return time.time() < self.token_expires_at
 
-    def ensure_valid_token(self) -> bool:
+    def _token_headers(self) -> dict:
+        return {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+            'RqUID': str(uuid.uuid4()),
+            'Authorization': f'Basic {self.auth_key}'
+        }
+
+    def _store_token(self, result: dict) -> str:
+        self.access_token = result.get('access_token')
+        expires_in = result.get('expires_in', 1800)
+        self.token_expires_at = time.time() + expires_in - 120  # Запас 2 минуты
+        logging.info(f"✅ GigaChat token obtained, expires in {expires_in} seconds")
+        self._schedule_refresh(self.token_expires_at - time.time() - GIGACHAT_TOKEN_REFRESH_AHEAD)
+        return self.access_token
+
+    def _schedule_refresh(self, delay: float):
+        """Запланировать фоновое обновление токена, чтобы запросы не ждали его получения"""
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        self._refresh_timer = threading.Timer(max(delay, 1.0), self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        with self._token_lock:
+            if self.get_access_token() is not None:
+                return
+        # Старый токен еще действует — пробуем снова, пока он не истек
         if self.is_token_valid():
-            return True
-        
-        logging.info("🔄 Token expired or invalid, refreshing...")
-        return self.get_access_token() is not None
+            self._schedule_refresh(min(30.0, self.token_expires_at - time.time()))
 
-    def decompose_task(self, task_title: str) -> Optional[List[str]]:
-        """Разложить задачу на подзадачи с помощью GigaChat"""
-        try:
-            if not self.ensure_valid_token():
-                logging.warning("❌ No valid GigaChat token available")
-                return None
+    def _completion_payload(self, prompt: str, model: Optional[str], temperature: float, max_tokens: int) -> dict:
+        return {
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
 
-            prompt = f"""Разложи задачу "{task_title}" на 3-5 конкретных практических шагов для выполнения.
+    def _record_request(self, started_at: float, result: Optional[dict] = None, retried: bool = False):
+        usage = (result or {}).get('usage') or {}
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            self._stats['latency_total_ms'] += (time.perf_counter() - started_at) * 1000
+            if result is None:
+                self._stats['failures'] += 1
+            if retried:
+                self._stats['token_retries'] += 1
+            for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+                self._stats[key] += usage.get(key, 0) or 0
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['avg_latency_ms'] = round(stats['latency_total_ms'] / stats['requests'], 2) if stats['requests'] else 0
+        stats['latency_total_ms'] = round(stats['latency_total_ms'], 2)
+        return stats
+
+    def _decompose_prompt(self, task_title: str) -> str:
+        return f"""Разложи задачу "{task_title}" на 3-5 конкретных практических шагов для выполнения.
 
 ТРЕБОВАНИЯ К ФОРМАТУ:
 - Каждый шаг должен быть кратким и конкретным
@@ -115,58 +146,6 @@ class GigaChatClient:
 
 Теперь разложи: "{task_title}"""
 
-            payload = {
-                "model": "GigaChat",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.3,
-                "max_tokens": 300
-            }
-
-            headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json',
-                'Authorization': f'Bearer {self.access_token}'
-            }
-
-            response = requests.post(
-                self.api_url, 
-                headers=headers, 
-                json=payload, 
-                verify=False,
-                timeout=30
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                steps = self._parse_response(content)
-                
-                if steps:
-                    logging.info(f"✅ GigaChat decomposition successful: {len(steps)} steps")
-                    return steps
-                else:
-                    logging.warning(f"❌ Could not parse GigaChat response")
-                    logging.debug(f"   Response: {content}")
-                    return None
-            elif response.status_code == 401:
-                logging.warning("🔄 Token invalid, retrying with new token...")
-                if self.get_access_token():
-                    headers['Authorization'] = f'Bearer {self.access_token}'
-                    response = requests.post(self.api_url, headers=headers, json=payload, verify=False, timeout=30)
-                    if response.status_code == 200:
-                        result = response.json()
-                        content = result['choices'][0]['message']['content']
-                        return self._parse_response(content)
-                return None
-            else:
-                logging.error(f"❌ GigaChat API error: {response.status_code}")
-                logging.error(f"   Response: {response.text}")
-                return None
-
-        except Exception as e:
-            logging.error(f"❌ GigaChat decomposition failed: {e}")
-            return None
-
     def _parse_response(self, text: str) -> List[str]:
         steps = []
         
@@ -198,5 +177,112 @@ class GigaChatClient:
         
         return steps if len(steps) >= 2 else None
 
+    def get_access_token(self) -> Optional[str]:
+        try:
+            if not self.auth_key:
+                logging.error("❌ Authorization key is missing")
+                return None
+
+            logging.info("🔄 Requesting new GigaChat access token...")
+            
+            payload = {'scope': 'GIGACHAT_API_PERS'}
+
+            response = http_session.post(
+                self.token_url, 
+                headers=self._token_headers(), 
+                data=payload, 
+                verify=False,  # Для тестов, в продакшене используй verify=True
+                timeout=30
+            )
+
+            if response.status_code == 200:
+                return self._store_token(response.json())
+            else:
+                logging.error(f"❌ GigaChat token error: {response.status_code}")
+                logging.error(f"   Response: {response.text}")
+                return None
+
+        except Exception as e:
+            logging.error(f"❌ GigaChat token request failed: {e}")
+            return None
+
+    def ensure_valid_token(self) -> bool:
+        if self.is_token_valid():
+            return True
+        
+        with self._token_lock:
+            # Пока ждали блокировку, токен мог обновить другой поток
+            if self.is_token_valid():
+                return True
+            logging.info("🔄 Token expired or invalid, refreshing...")
+            return self.get_access_token() is not None
+
+    def refresh_rejected_token(self, rejected_token: Optional[str]) -> bool:
+        """Обновить токен после 401; параллельные потоки получают один новый токен"""
+        with self._token_lock:
+            # Токен уже заменил другой поток, получивший тот же 401
+            if self.access_token != rejected_token and self.is_token_valid():
+                return True
+            return self.get_access_token() is not None
+
+    def _post_completion(self, payload: dict, timeout: float):
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {self.access_token}'
+        }
+        return http_session.post(self.api_url, headers=headers, json=payload, verify=False, timeout=timeout)
+
+    def complete(self, prompt: str, model: Optional[str] = None, temperature: float = 0.3,
+                 max_tokens: int = 300, timeout: Optional[float] = None) -> Optional[str]:
+        """Отправить промпт в GigaChat и вернуть текст ответа"""
+        started_at = time.perf_counter()
+        result = None
+        retried = False
+        try:
+            if not self.ensure_valid_token():
+                logging.warning("❌ No valid GigaChat token available")
+                return None
+
+            payload = self._completion_payload(prompt, model, temperature, max_tokens)
+            token = self.access_token
+            response = self._post_completion(payload, timeout or self.timeout)
+
+            if response.status_code == 401:
+                logging.warning("🔄 Token invalid, retrying with new token...")
+                retried = True
+                if not self.refresh_rejected_token(token):
+                    return None
+                response = self._post_completion(payload, timeout or self.timeout)
+
+            if response.status_code != 200:
+                logging.error(f"❌ GigaChat API error: {response.status_code}")
+                logging.error(f"   Response: {response.text}")
+                return None
+
+            result = response.json()
+            return result['choices'][0]['message']['content']
+
+        except Exception as e:
+            logging.error(f"❌ GigaChat request failed: {e}")
+            result = None
+            return None
+        finally:
+            self._record_request(started_at, result, retried)
+
+    def decompose_task(self, task_title: str) -> Optional[List[str]]:
+        """Разложить задачу на подзадачи с помощью GigaChat"""
+        content = self.complete(self._decompose_prompt(task_title), temperature=0.3, max_tokens=300)
+        if not content:
+            return None
+
+        steps = self._parse_response(content)
+        if steps:
+            logging.info(f"✅ GigaChat decomposition successful: {len(steps)} steps")
+        else:
+            logging.warning(f"❌ Could not parse GigaChat response")
+            logging.debug(f"   Response: {content}")
+        return steps
+
 # Глобальный экземпляр
 gigachat_client = GigaChatClient()
\ No newline at end of file
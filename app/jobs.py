@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(__file__))
+
+from executors import decompose_pool
+from models import unit_of_work
+from services import decompose_task, normalize_user_id
+
+class JobQueueFull(Exception):
+    pass
+
+class DecompositionJob:
+    def __init__(self, title, user_id):
+        self.id = uuid.uuid4().hex
+        self.title = title
+        self.user_id = user_id
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.parent_task_id = None
+        self.steps = None
+        self.fallback = False  # шаги составлены по шаблону, GigaChat не ответил
+        self.error = None
+        self.created_at = datetime.datetime.utcnow()
+        self.finished_at = None
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'title': self.title,
+            'status': self.status,
+            'stage': self.stage,
+            'parent_task_id': self.parent_task_id,
+            'steps': self.steps,
+            'fallback': self.fallback,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+class DecompositionJobQueue:
+    """Очередь фоновых разложений задач с ограниченным числом воркеров"""
+
+    def __init__(self, executor, max_pending=None, retention_minutes=None):
+        self.executor = executor
+        self.max_pending = max_pending or int(os.getenv('DECOMPOSE_MAX_PENDING', '100'))
+        self.retention = datetime.timedelta(minutes=retention_minutes or int(os.getenv('DECOMPOSE_JOB_RETENTION_MINUTES', '60')))
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        threshold = datetime.datetime.utcnow() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < threshold]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        job.status = 'running'
+        job.stage = 'started'
+
+        def on_progress(stage, **data):
+            job.stage = stage
+            if 'parent_task_id' in data:
+                job.parent_task_id = data['parent_task_id']
+            if 'steps' in data:
+                job.steps = data['steps']
+            if 'fallback' in data:
+                job.fallback = data['fallback']
+
+        try:
+            with unit_of_work():
+                job.steps = decompose_task(job.title, job.user_id, on_progress=on_progress)
+            job.status = 'done'
+            job.stage = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.parent_task_id = None  # родительская задача откатилась вместе с заданием
+            print(f"💥 Ошибка задания разложения {job.id}: {e}")
+        finally:
+            job.finished_at = datetime.datetime.utcnow()
+        return job
+
+    def submit(self, title, user_id):
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if not j.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull("Слишком много задач в очереди на разложение, попробуй позже")
+
+            job = DecompositionJob(title, normalize_user_id(user_id))
+            self._jobs[job.id] = job
+
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    async def wait(self, job):
+        return await asyncio.wrap_future(job.future)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            'queued': sum(1 for j in jobs if j.status == 'queued'),
+            'running': sum(1 for j in jobs if j.status == 'running'),
+            'done': sum(1 for j in jobs if j.status == 'done'),
+            'failed': sum(1 for j in jobs if j.status == 'failed'),
+            'max_pending': self.max_pending
+        }
+
+decomposition_jobs = DecompositionJobQueue(decompose_pool)
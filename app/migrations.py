@@ -0,0 +1,167 @@
+import datetime
+from sqlalchemy import text
+
+# Пересчет дневного среза задач (таблица daily_user_stats) одним запросом.
+# Используется миграцией 2 и командой `python app/stats.py backfill-daily`.
+def daily_user_stats_sql(condition="user_id IS NOT NULL"):
+    return (
+        "INSERT INTO daily_user_stats (user_id, day, total_tasks, completed_tasks, total_minutes, "
+        "completed_minutes, total_difficulty, completed_difficulty) "
+        "SELECT user_id, date(created_at), COUNT(*), "
+        "SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END), "
+        "COALESCE(SUM(estimated_minutes), 0), "
+        "COALESCE(SUM(CASE WHEN status = 'done' THEN estimated_minutes ELSE 0 END), 0), "
+        "COALESCE(SUM(difficulty), 0), "
+        "COALESCE(SUM(CASE WHEN status = 'done' THEN difficulty ELSE 0 END), 0) "
+        f"FROM tasks WHERE {condition} AND created_at IS NOT NULL "
+        "GROUP BY user_id, date(created_at)"
+    )
+
+REBUILD_DAILY_USER_STATS_SQL = daily_user_stats_sql()
+
+# Пересчет user_streaks по дням выполнения: подряд идущие дни образуют группу
+# с одинаковым julianday(day) - ROW_NUMBER(); текущая серия — последняя группа.
+# Используется миграцией 3 и командой `python app/stats.py recompute-streaks`;
+# condition ограничивает задачи, например одним пользователем при слиянии аккаунтов.
+def user_streaks_sql(condition="user_id IS NOT NULL"):
+    return (
+        "WITH days AS ("
+        "SELECT DISTINCT user_id, date(completed_at) AS day FROM tasks "
+        f"WHERE {condition} AND completed_at IS NOT NULL), "
+        "grouped AS ("
+        "SELECT user_id, day, julianday(day) - ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day) AS grp "
+        "FROM days), "
+        "runs AS ("
+        "SELECT user_id, COUNT(*) AS length, MAX(day) AS last_day FROM grouped GROUP BY user_id, grp) "
+        "INSERT INTO user_streaks (user_id, current_streak, longest_streak, last_active_day) "
+        "SELECT user_id, "
+        "(SELECT r.length FROM runs r WHERE r.user_id = runs.user_id ORDER BY r.last_day DESC LIMIT 1), "
+        "MAX(length), MAX(last_day) "
+        "FROM runs GROUP BY user_id"
+    )
+
+REBUILD_USER_STREAKS_SQL = user_streaks_sql()
+
+# Перенумерация позиций с шагом :gap в порядке (position, id) внутри группы
+# (карточки — по колонке, колонки — по проекту). Используется миграцией 6 и
+# при исчерпании промежутка между соседними позициями. :version — новая версия
+# синхронизации для измененных строк (NULL — оставить прежнюю).
+def rebalance_positions_sql(table, group_column, condition="1 = 1"):
+    return (
+        f"UPDATE {table} SET position = ranked.rn * :gap, version = COALESCE(:version, {table}.version) "
+        f"FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY {group_column} ORDER BY position, id) AS rn "
+        f"FROM {table} WHERE {condition}) AS ranked "
+        f"WHERE {table}.id = ranked.id AND {table}.position IS NOT ranked.rn * :gap "
+        "RETURNING id"
+    )
+
+POSITION_GAP = 1024
+
+# Чем заменяется NULL в task_date/created_at при постраничной выдаче задач:
+# такие задачи идут последними, а курсор всегда содержит дату
+NULL_SORT_DATE = '0001-01-01 00:00:00.000000'
+
+def rebalance_positions(table, group_column):
+    """Шаг миграции: перенумеровать позиции всей таблицы с шагом POSITION_GAP"""
+    def step(conn):
+        conn.execute(text(rebalance_positions_sql(table, group_column)), {"gap": POSITION_GAP, "version": None})
+    return step
+
+def add_column(table, column, ddl):
+    """Шаг миграции: ALTER TABLE ADD COLUMN, если колонки еще нет (новую базу создает create_all)"""
+    def step(conn):
+        columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return step
+
+# Версионированные миграции схемы. create_all() создаёт только недостающие
+# таблицы, поэтому всё, что меняет уже существующие таблицы (индексы, колонки),
+# добавляется сюда отдельным шагом с новым номером версии.
+# Шаг — это SQL-строка или функция, принимающая соединение.
+MIGRATIONS = [
+    (1, "composite indexes for hot task and board queries", [
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_date_created ON tasks (user_id, task_date, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_created ON tasks (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_status_created ON tasks (user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_parent_status ON tasks (parent_id, status)",
+        "CREATE INDEX IF NOT EXISTS ix_projects_user_created ON projects (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_board_columns_project_position ON board_columns (project_id, position)",
+        "CREATE INDEX IF NOT EXISTS ix_board_cards_column_position ON board_cards (column_id, position)",
+        "ANALYZE",
+    ]),
+    (2, "backfill daily_user_stats from existing tasks", [
+        "DELETE FROM daily_user_stats",
+        REBUILD_DAILY_USER_STATS_SQL,
+    ]),
+    # Время выполнения раньше не хранилось: для уже выполненных задач берем created_at.
+    (3, "tasks.completed_at and user_streaks", [
+        add_column("tasks", "completed_at", "DATETIME"),
+        "UPDATE tasks SET completed_at = created_at WHERE status = 'done' AND completed_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_completed ON tasks (user_id, completed_at)",
+        "DELETE FROM user_streaks",
+        REBUILD_USER_STREAKS_SQL,
+    ]),
+    # Существующие строки получают версию 0 и попадают в первую полную выгрузку
+    # (since=0 отдает все строки с version > 0, поэтому клиент без курсора
+    # сначала загружает данные обычными списками, а потом переходит на /sync/changes).
+    (4, "sync versions and tombstones", [
+        add_column("tasks", "updated_at", "DATETIME"),
+        add_column("tasks", "version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("projects", "version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("board_columns", "updated_at", "DATETIME"),
+        add_column("board_columns", "version", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("board_cards", "version", "INTEGER NOT NULL DEFAULT 0"),
+        "UPDATE tasks SET updated_at = COALESCE(completed_at, created_at) WHERE updated_at IS NULL",
+        "UPDATE board_columns SET updated_at = created_at WHERE updated_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_version ON tasks (user_id, version)",
+        "CREATE INDEX IF NOT EXISTS ix_projects_user_version ON projects (user_id, version)",
+        "CREATE INDEX IF NOT EXISTS ix_board_columns_version ON board_columns (version)",
+        "CREATE INDEX IF NOT EXISTS ix_board_cards_version ON board_cards (version)",
+        "INSERT OR IGNORE INTO sync_state (name, value) VALUES ('changes', 0)",
+    ]),
+    (5, "tasks.origin_id and title index for set-based account merge", [
+        add_column("tasks", "origin_id", "INTEGER"),
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_origin ON tasks (user_id, origin_id)",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_title ON tasks (user_id, title)",
+    ]),
+    # Позиции 0, 1, 2, ... превращаются в 1024, 2048, ...: перенос карточки
+    # пишет одну строку с позицией посередине между соседями.
+    (6, "gapped board positions", [
+        rebalance_positions("board_cards", "column_id"),
+        rebalance_positions("board_columns", "project_id"),
+    ]),
+    (7, "null-safe keyset index for task pages", [
+        "CREATE INDEX IF NOT EXISTS ix_tasks_user_page ON tasks (user_id, "
+        f"COALESCE(task_date, '{NULL_SORT_DATE}') DESC, COALESCE(created_at, '{NULL_SORT_DATE}') DESC, id DESC)",
+    ]),
+]
+
+def get_schema_version(conn):
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+
+def run_migrations(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, description TEXT, applied_at DATETIME)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    for version, description, steps in MIGRATIONS:
+        if version in applied:
+            continue
+
+        with engine.begin() as conn:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(text(step))
+
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {"v": version, "d": description, "t": datetime.datetime.utcnow()}
+            )
+
+        print(f"🛠 Применена миграция {version}: {description}")
@@ -1,7 +1,12 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, func
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, backref
+from sqlalchemy import create_engine, case, event, inspect, text, Index, Column, Integer, String, Date, DateTime, Boolean, ForeignKey, Text, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, backref, object_session, Session
 import datetime
 import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from migrations import run_migrations
 
 def get_db_path():
     if os.path.exists('/data'):
@@ -13,11 +18,134 @@ def get_db_path():
 
 DB_PATH = get_db_path()
 SQLITE_URL = f"sqlite:///{DB_PATH}"
+ASYNC_SQLITE_URL = f"sqlite+aiosqlite:///{DB_PATH}"
 
 print(f"🔗 Using database: {DB_PATH}")
 
-engine = create_engine(SQLITE_URL, connect_args={"check_same_thread": False})
+# Профиль SQLite: WAL позволяет потоку API читать, пока бот пишет.
+# Любое значение можно переопределить через переменные окружения.
+SQLITE_PROFILE_ENABLED = os.getenv('SQLITE_PROFILE', 'on').lower() not in ('0', 'off', 'false', 'no')
+
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-65536')),  # отрицательное значение — в KiB
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'wal_autocheckpoint': int(os.getenv('SQLITE_WAL_AUTOCHECKPOINT', '1000')),  # в страницах
+}
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas=None):
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def create_sqlite_engine(url, profile=True, pragmas=None):
+    busy_timeout_ms = (pragmas or SQLITE_PRAGMAS).get('busy_timeout', 5000)
+    sqlite_engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False, "timeout": busy_timeout_ms / 1000}
+    )
+
+    if profile:
+        @event.listens_for(sqlite_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+    return sqlite_engine
+
+def create_async_sqlite_engine(url, profile=True, pragmas=None):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    busy_timeout_ms = (pragmas or SQLITE_PRAGMAS).get('busy_timeout', 5000)
+    async_engine = create_async_engine(url, connect_args={"timeout": busy_timeout_ms / 1000})
+
+    if profile:
+        @event.listens_for(async_engine.sync_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+    return async_engine
+
+def checkpoint_wal(mode="PASSIVE", bind=None):
+    with (bind or engine).connect() as conn:
+        return conn.execute(text(f"PRAGMA wal_checkpoint({mode})")).fetchone()
+
+engine = create_sqlite_engine(SQLITE_URL, profile=SQLITE_PROFILE_ENABLED)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# Единица работы: все вызовы services внутри одного HTTP-запроса или апдейта бота
+# используют одну сессию (одно соединение) вместо новой сессии на каждый вызов.
+_current_session = ContextVar('current_session', default=None)
+
+def acquire_session():
+    db = _current_session.get()
+    if db is not None:
+        return db, None
+    db = SessionLocal()
+    return db, _current_session.set(db)
+
+def release_session(db, token):
+    if token is not None:
+        _current_session.reset(token)
+        db.close()
+
+def finish_write(db, token):
+    """Завершить запись сервиса: внутри единицы работы — только flush (коммитит ее
+    владелец), а сессию, открытую самим сервисом (token не None), — коммитом.
+    """
+    if token is None:
+        db.flush()
+    else:
+        db.commit()
+
+def release_connection():
+    """Вернуть соединение сессии текущей единицы работы в пул перед долгим вызовом без БД.
+
+    Возвращается только соединение без записи: завершение читающей транзакции ничего
+    не фиксирует, и сессия при следующем запросе возьмет соединение заново. Если
+    единица работы уже что-то записала, соединение остается за ней до ее коммита.
+    """
+    db = _current_session.get()
+    if db is None or not db.in_transaction() or db.new or db.dirty or db.deleted:
+        return
+    if db.connection().connection.dbapi_connection.in_transaction:
+        return
+    # В транзакции только чтение; в отличие от rollback коммит при
+    # expire_on_commit=False не сбрасывает загруженные объекты
+    db.commit()
+
+@contextmanager
+def unit_of_work(db=None, commit=True):
+    """Сессия db (или новая) для всех вызовов services внутри блока.
+
+    Сервисы внутри блока не коммитят (finish_write делает только flush) — запись
+    фиксирует владелец единицы работы одним коммитом: при выходе из блока без
+    исключения, либо сам, если commit=False.
+    """
+    if db is None:
+        db, token = acquire_session()
+        try:
+            yield db
+            if commit:
+                db.commit()
+        finally:
+            release_session(db, token)
+        return
+
+    token = _current_session.set(db)
+    try:
+        yield db
+        if commit:
+            db.commit()
+    finally:
+        _current_session.reset(token)
+
 Base = declarative_base()
 
 class User(Base):
@@ -34,6 +162,16 @@ class User(Base):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        Index('ix_tasks_user_date_created', 'user_id', 'task_date', 'created_at'),
+        Index('ix_tasks_user_created', 'user_id', 'created_at'),
+        Index('ix_tasks_user_status_created', 'user_id', 'status', 'created_at'),
+        Index('ix_tasks_parent_status', 'parent_id', 'status'),
+        Index('ix_tasks_user_completed', 'user_id', 'completed_at'),
+        Index('ix_tasks_user_version', 'user_id', 'version'),
+        Index('ix_tasks_user_origin', 'user_id', 'origin_id'),
+        Index('ix_tasks_user_title', 'user_id', 'title'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     title = Column(String, nullable=False)
@@ -43,9 +181,14 @@ class Task(Base):
     estimated_minutes = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     task_date = Column(DateTime, default=datetime.datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    version = Column(Integer, default=0, nullable=False)
 
     parent_id = Column(Integer, ForeignKey("tasks.id"), nullable=True)  
     is_parent = Column(Boolean, default=False)  
+    # Исходная задача, если эта скопирована из другого аккаунта при синхронизации
+    origin_id = Column(Integer, nullable=True)
 
     user = relationship('User', back_populates='tasks')
     subtasks = relationship('Task', 
@@ -63,6 +206,10 @@ class Analytics(Base):
 
 class Project(Base):
     __tablename__ = "projects"
+    __table_args__ = (
+        Index('ix_projects_user_created', 'user_id', 'created_at'),
+        Index('ix_projects_user_version', 'user_id', 'version'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     title = Column(String, nullable=False)
@@ -70,24 +217,35 @@ class Project(Base):
     color = Column(String, default="#3b82f6")
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    version = Column(Integer, default=0, nullable=False)
     
     user = relationship('User', back_populates='projects')
     columns = relationship('BoardColumn', back_populates='project', cascade="all, delete-orphan")
 
 class BoardColumn(Base):
     __tablename__ = "board_columns"
+    __table_args__ = (
+        Index('ix_board_columns_project_position', 'project_id', 'position'),
+        Index('ix_board_columns_version', 'version'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("projects.id"))
     title = Column(String, nullable=False)
     position = Column(Integer, default=0)
     color = Column(String, default="#6b7280")
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    version = Column(Integer, default=0, nullable=False)
     
     project = relationship('Project', back_populates='columns')
     cards = relationship('BoardCard', back_populates='column', cascade="all, delete-orphan")
 
 class BoardCard(Base):
     __tablename__ = "board_cards"
+    __table_args__ = (
+        Index('ix_board_cards_column_position', 'column_id', 'position'),
+        Index('ix_board_cards_version', 'version'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     column_id = Column(Integer, ForeignKey("board_columns.id"))
     title = Column(String, nullable=False)
@@ -100,8 +258,278 @@ class BoardCard(Base):
     priority = Column(Integer, default=1)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    version = Column(Integer, default=0, nullable=False)
     
     column = relationship('BoardColumn', back_populates='cards')
 
+class DecompositionCacheEntry(Base):
+    __tablename__ = "decomposition_cache"
+    key = Column(String, primary_key=True)
+    title = Column(String, nullable=False)
+    steps = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    hits = Column(Integer, default=0)
+
+class BotChatState(Base):
+    """Чат и время последней активности пользователя бота — нужны напоминаниям после перезапуска"""
+    __tablename__ = "bot_chat_states"
+    user_id = Column(String, primary_key=True)
+    chat_id = Column(Integer, nullable=True)
+    last_activity = Column(DateTime, nullable=True, index=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+class DailyUserStats(Base):
+    """Дневной срез задач пользователя по дню создания задачи"""
+    __tablename__ = "daily_user_stats"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    total_tasks = Column(Integer, default=0, nullable=False)
+    completed_tasks = Column(Integer, default=0, nullable=False)
+    total_minutes = Column(Integer, default=0, nullable=False)
+    completed_minutes = Column(Integer, default=0, nullable=False)
+    total_difficulty = Column(Integer, default=0, nullable=False)
+    completed_difficulty = Column(Integer, default=0, nullable=False)
+
+class UserStreak(Base):
+    """Серия дней подряд с выполненными задачами (по completed_at)"""
+    __tablename__ = "user_streaks"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    current_streak = Column(Integer, default=0, nullable=False)
+    longest_streak = Column(Integer, default=0, nullable=False)
+    last_active_day = Column(Date, nullable=True)
+
+# daily_user_stats поддерживается событиями маппера Task: любая вставка,
+# изменение или удаление задачи (включая каскадное) в том же flush
+# добавляет свою дельту через UPSERT, без пересчета по всем задачам.
+DAILY_STATS_COLUMNS = ('total_tasks', 'completed_tasks', 'total_minutes',
+                       'completed_minutes', 'total_difficulty', 'completed_difficulty')
+_DAILY_STATS_SOURCE = ('user_id', 'created_at', 'status', 'estimated_minutes', 'difficulty')
+
+def _task_contribution(user_id, created_at, status, estimated_minutes, difficulty):
+    if user_id is None or created_at is None:
+        return None
+    done = status == 'done'
+    minutes = estimated_minutes or 0
+    difficulty = difficulty or 0
+    return (user_id, created_at.date()), (1, int(done), minutes, minutes if done else 0,
+                                          difficulty, difficulty if done else 0)
+
+def _apply_daily_stats(connection, contribution, sign):
+    if contribution is None:
+        return
+    (user_id, day), values = contribution
+    values = {name: sign * value for name, value in zip(DAILY_STATS_COLUMNS, values)}
+    table = DailyUserStats.__table__
+    stmt = sqlite_insert(table).values(user_id=user_id, day=day, **values)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day'],
+        set_={name: table.c[name] + stmt.excluded[name] for name in DAILY_STATS_COLUMNS}
+    ))
+
+def _previous_value(target, name):
+    history = inspect(target).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(target, name)
+
+# Серия обновляется одним UPSERT при переходе задачи в 'done': день, совпадающий
+# с last_active_day, ничего не меняет, следующий день продлевает серию, иначе она
+# начинается заново. Отмена выполнения серию не уменьшает — для этого есть
+# пересчет `python app/stats.py recompute-streaks`.
+def _record_completion(connection, user_id, day):
+    if user_id is None:
+        return
+    table = UserStreak.__table__
+    yesterday = day - datetime.timedelta(days=1)
+    stmt = sqlite_insert(table).values(user_id=user_id, current_streak=1, longest_streak=1, last_active_day=day)
+    new_streak = case(
+        (table.c.last_active_day >= day, table.c.current_streak),
+        (table.c.last_active_day == yesterday, table.c.current_streak + 1),
+        else_=1
+    )
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={
+            'current_streak': new_streak,
+            'longest_streak': func.max(table.c.longest_streak, new_streak),
+            'last_active_day': func.max(func.coalesce(table.c.last_active_day, day), day)
+        }
+    ))
+
+def _sync_completed_at(target):
+    if target.status == 'done':
+        if target.completed_at is None:
+            target.completed_at = datetime.datetime.utcnow()
+    elif target.completed_at is not None:
+        target.completed_at = None
+
+@event.listens_for(Task, 'before_insert')
+def _completed_at_on_insert(mapper, connection, target):
+    _sync_completed_at(target)
+
+@event.listens_for(Task, 'before_update')
+def _completed_at_on_update(mapper, connection, target):
+    if inspect(target).attrs.status.history.has_changes():
+        _sync_completed_at(target)
+
+@event.listens_for(Task, 'after_insert')
+def _task_after_insert(mapper, connection, target):
+    _apply_daily_stats(connection, _task_contribution(*(getattr(target, n) for n in _DAILY_STATS_SOURCE)), 1)
+    if target.status == 'done':
+        _record_completion(connection, target.user_id, target.completed_at.date())
+
+@event.listens_for(Task, 'after_update')
+def _task_after_update(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.status.history.has_changes() and target.status == 'done' \
+            and _previous_value(target, 'status') != 'done':
+        _record_completion(connection, target.user_id, target.completed_at.date())
+
+    if not any(state.attrs[n].history.has_changes() for n in _DAILY_STATS_SOURCE):
+        return
+    _apply_daily_stats(connection, _task_contribution(*(_previous_value(target, n) for n in _DAILY_STATS_SOURCE)), -1)
+    _apply_daily_stats(connection, _task_contribution(*(getattr(target, n) for n in _DAILY_STATS_SOURCE)), 1)
+
+@event.listens_for(Task, 'after_delete')
+def _task_after_delete(mapper, connection, target):
+    _apply_daily_stats(connection, _task_contribution(*(_previous_value(target, n) for n in _DAILY_STATS_SOURCE)), -1)
+
+def _keep_previous_value(target, value, oldvalue, initiator):
+    pass
+
+# active_history: при изменении незагруженного атрибута старое значение
+# подгружается, иначе after_update не узнает, из какого дня вычесть.
+for _name in _DAILY_STATS_SOURCE:
+    event.listen(getattr(Task, _name), 'set', _keep_previous_value, active_history=True)
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, default=0, nullable=False)
+
+class SyncTombstone(Base):
+    """Запись об удаленной строке, чтобы клиенты синхронизации узнали об удалении"""
+    __tablename__ = "sync_tombstones"
+    __table_args__ = (
+        Index('ix_sync_tombstones_user_version', 'user_id', 'version'),
+    )
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=True)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Версии для синхронизации: каждый flush, меняющий задачи, проекты, колонки или
+# карточки, получает следующее значение счетчика sync_state('changes') и
+# проставляет его всем затронутым строкам. Счетчик увеличивается внутри той же
+# транзакции, а SQLite пропускает только одного писателя за раз, поэтому версии
+# становятся видимыми строго по возрастанию и клиент с курсором N ничего не пропустит.
+SYNC_ENTITIES = {'task': Task, 'project': Project, 'column': BoardColumn, 'card': BoardCard}
+
+# Владелец строки: у колонок и карточек он определяется через проект
+_SYNC_OWNER_SQL = {
+    'column': "SELECT user_id FROM projects WHERE id = :parent_id",
+    'card': "SELECT p.user_id FROM board_columns c JOIN projects p ON p.id = c.project_id WHERE c.id = :parent_id",
+}
+
+# Изменения копятся в session.info и публикуются модулем events после коммита
+SYNC_EVENTS_KEY = 'sync_events'
+
+def _sync_owner(connection, entity, target):
+    if entity == 'task' or entity == 'project':
+        return target.user_id
+    parent_id = target.project_id if entity == 'column' else target.column_id
+    return connection.execute(text(_SYNC_OWNER_SQL[entity]), {"parent_id": parent_id}).scalar()
+
+_NEXT_SYNC_VERSION_SQL = text("UPDATE sync_state SET value = value + 1 WHERE name = 'changes' RETURNING value")
+
+def next_sync_version(connection):
+    """Следующее значение счетчика синхронизации (для массовых изменений в обход ORM).
+
+    Строку счетчика создает миграция; если ее нет (база собрана create_all без
+    миграций), она заводится здесь — версия 0 означает «без изменений» и не выдается.
+    """
+    version = connection.execute(_NEXT_SYNC_VERSION_SQL).scalar()
+    if version is None:
+        connection.execute(text("INSERT OR IGNORE INTO sync_state (name, value) VALUES ('changes', 0)"))
+        version = connection.execute(_NEXT_SYNC_VERSION_SQL).scalar()
+    if not version:
+        raise RuntimeError("Счетчик синхронизации sync_state('changes') недоступен")
+    return version
+
+def _flush_sync_version(connection, target):
+    session = object_session(target)
+    version = session.info.get('sync_version') if session is not None else None
+    if version is None:
+        version = next_sync_version(connection)
+        if session is not None:
+            session.info['sync_version'] = version
+    return version
+
+def record_sync_events(session, user_id, entity, action, ids, version):
+    """Добавить события об изменении строк; для массовых UPDATE в обход ORM"""
+    if session is None or user_id is None:
+        return
+    session.info.setdefault(SYNC_EVENTS_KEY, []).extend((user_id, {
+        'type': f'{entity}.{action}',
+        'entity': entity,
+        'id': entity_id,
+        'version': version
+    }) for entity_id in ids)
+
+def _record_sync_event(target, entity, action, user_id, version):
+    record_sync_events(object_session(target), user_id, entity, action, [target.id], version)
+
+@event.listens_for(Session, 'before_flush')
+def _reset_sync_version(session, flush_context, instances):
+    session.info.pop('sync_version', None)
+
+def _stamp_sync_version(mapper, connection, target):
+    target.version = _flush_sync_version(connection, target)
+
+def _stamp_sync_version_on_update(mapper, connection, target):
+    if object_session(target).is_modified(target, include_collections=False):
+        _stamp_sync_version(mapper, connection, target)
+
+def _make_sync_listeners(entity):
+    def _after_insert(mapper, connection, target):
+        _record_sync_event(target, entity, 'created', _sync_owner(connection, entity, target), target.version)
+
+    def _after_update(mapper, connection, target):
+        # Версию получают только реально измененные строки этого flush
+        if target.version == object_session(target).info.get('sync_version'):
+            _record_sync_event(target, entity, 'updated', _sync_owner(connection, entity, target), target.version)
+
+    def _after_delete(mapper, connection, target):
+        user_id = _sync_owner(connection, entity, target)
+        version = _flush_sync_version(connection, target)
+        connection.execute(SyncTombstone.__table__.insert().values(
+            entity=entity,
+            entity_id=target.id,
+            user_id=user_id,
+            version=version,
+            deleted_at=datetime.datetime.utcnow()
+        ))
+        _record_sync_event(target, entity, 'deleted', user_id, version)
+
+    return _after_insert, _after_update, _after_delete
+
+for _entity, _model in SYNC_ENTITIES.items():
+    _after_insert, _after_update, _after_delete = _make_sync_listeners(_entity)
+    event.listen(_model, 'before_insert', _stamp_sync_version)
+    event.listen(_model, 'before_update', _stamp_sync_version_on_update)
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'after_update', _after_update)
+    event.listen(_model, 'after_delete', _after_delete)
+
+class BusEvent(Base):
+    """Событие для подписчиков из других процессов (EVENT_BUS_BACKEND=sqlite)"""
+    __tablename__ = "bus_events"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
\ No newline at end of file
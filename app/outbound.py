@@ -0,0 +1,261 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+import aiohttp
+import aiomax
+from aiomax import exceptions as max_exceptions
+
+# Исходящие запросы бота к MAX API. Все запросы, кроме GET (сообщения, правки,
+# ответы на кнопки), проходят через одну очередь с приоритетами и двумя ограничителями
+# скорости: общим на бота и отдельным на каждый чат. Интерактивные ответы
+# уходят раньше напоминаний, напоминания — раньше рассылок.
+
+INTERACTIVE, REMINDER, BROADCAST = 0, 1, 2
+LANE_NAMES = {INTERACTIVE: 'interactive', REMINDER: 'reminder', BROADCAST: 'broadcast'}
+
+# Коды ответа MAX API на превышение лимита (HTTP 429)
+RATE_LIMIT_CODES = {'too.many.requests', '429'}
+
+_current_lane = contextvars.ContextVar('outbound_lane', default=INTERACTIVE)
+
+@contextlib.contextmanager
+def lane(priority):
+    """Все отправки внутри блока идут в полосу priority"""
+    token = _current_lane.set(priority)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+def is_retryable(error):
+    """429, 5xx и сетевые ошибки стоит повторить; остальные — нет"""
+    if isinstance(error, (max_exceptions.InternalError, aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, max_exceptions.UnknownErrorException):
+        return (error.text or '').lower() in RATE_LIMIT_CODES
+    # Ответ не в JSON — обычно страница 502/503 от балансировщика
+    return type(error) is Exception and str(error).startswith('Unknown error')
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """Занять токен; вернуть, сколько секунд ждать до его появления"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class OutboundRequest:
+    __slots__ = ('priority', 'seq', 'chat_id', 'call', 'future', 'enqueued_at', 'attempt', 'chat_reserved')
+
+    def __init__(self, priority, seq, chat_id, call, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempt = 0
+        self.chat_reserved = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundDispatcher:
+    """Очередь исходящих запросов с приоритетами, лимитами скорости и повторами.
+
+    Привязывается к event loop, в котором вызван первый submit.
+    """
+
+    def __init__(self, global_rate=None, chat_rate=None, workers=None, max_retries=None, lane_limit=None):
+        global_rate = global_rate or float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+        self.chat_rate = chat_rate or float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+        self.chat_burst = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+        self.workers = workers or int(os.getenv('OUTBOUND_WORKERS', '4'))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+        # Сколько напоминаний или рассылок может ждать в очереди; дальше submit ждет
+        self.lane_limit = lane_limit or int(os.getenv('OUTBOUND_LANE_LIMIT', '500'))
+        self.retry_base = float(os.getenv('OUTBOUND_RETRY_BASE_SECONDS', '0.5'))
+        self.retry_max = float(os.getenv('OUTBOUND_RETRY_MAX_SECONDS', '10'))
+
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = {}
+        self._queue = None
+        self._loop = None
+        self._slots = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._lanes = {
+            name: {'pending': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+            for name in LANE_NAMES.values()
+        }
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        self._slots = {p: asyncio.Semaphore(self.lane_limit) for p in (REMINDER, BROADCAST)}
+        for _ in range(self.workers):
+            loop.create_task(self._worker())
+
+    async def submit(self, call, chat_id=None, priority=None):
+        """Выполнить корутинную функцию call в очереди и вернуть ее результат"""
+        self._ensure_started()
+        priority = _current_lane.get() if priority is None else priority
+        name = LANE_NAMES[priority]
+
+        slot = self._slots.get(priority)
+        if slot is not None:
+            await slot.acquire()
+        try:
+            self._seq += 1
+            request = OutboundRequest(priority, self._seq, chat_id, call, self._loop.create_future())
+            with self._lock:
+                self._lanes[name]['pending'] += 1
+            self._queue.put_nowait(request)
+            return await request.future
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                # Забываем чаты, у которых ведро уже полное: для них это ничего не меняет
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _requeue(self, request):
+        self._queue.put_nowait(request)
+
+    def _finish(self, request, result=None, error=None, cancelled=False):
+        name = LANE_NAMES[request.priority]
+        latency = time.monotonic() - request.enqueued_at
+        with self._lock:
+            lane_stats = self._lanes[name]
+            lane_stats['pending'] -= 1
+            if cancelled or error is not None:
+                lane_stats['failed'] += 1
+            else:
+                lane_stats['sent'] += 1
+                lane_stats['latency_total'] += latency
+                lane_stats['latency_max'] = max(lane_stats['latency_max'], latency)
+
+        if request.future.done():
+            return
+        if cancelled:
+            request.future.cancel()
+        elif error is None:
+            request.future.set_result(result)
+        else:
+            request.future.set_exception(error)
+
+    async def _worker(self):
+        while True:
+            request = await self._queue.get()
+            now = time.monotonic()
+
+            # Чат исчерпал лимит — запрос возвращается в очередь к своему сроку,
+            # а воркер берет следующий, чтобы один чат не задерживал остальные
+            if request.chat_id is not None and not request.chat_reserved:
+                request.chat_reserved = True
+                wait = self._chat_bucket(request.chat_id, now).reserve(now)
+                if wait > 0:
+                    self._loop.call_later(wait, self._requeue, request)
+                    continue
+
+            wait = self._global.reserve(now)
+            try:
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                result = await request.call()
+            except asyncio.CancelledError:
+                self._finish(request, cancelled=True)
+                raise
+            except Exception as e:
+                if request.attempt < self.max_retries and is_retryable(e):
+                    request.attempt += 1
+                    request.chat_reserved = False
+                    # Экспоненциальная пауза со случайным разбросом, чтобы повторы не шли пачкой
+                    delay = min(self.retry_max, self.retry_base * 2 ** request.attempt) * random.uniform(0.5, 1.5)
+                    with self._lock:
+                        self._lanes[LANE_NAMES[request.priority]]['retried'] += 1
+                    # Сервер уже просит притормозить: новые запросы тоже ждут
+                    self._global.tokens = min(self._global.tokens, 0)
+                    logging.warning(f"Outbound request failed ({e!r}), retry {request.attempt} in {delay:.1f}s")
+                    self._loop.call_later(delay, self._requeue, request)
+                    continue
+                self._finish(request, error=e)
+            else:
+                self._finish(request, result)
+
+    def stats(self):
+        with self._lock:
+            lanes = {}
+            for name, lane_stats in self._lanes.items():
+                sent = lane_stats['sent']
+                lanes[name] = {
+                    'pending': lane_stats['pending'],
+                    'sent': sent,
+                    'failed': lane_stats['failed'],
+                    'retried': lane_stats['retried'],
+                    'avg_latency_ms': round(lane_stats['latency_total'] / sent * 1000, 2) if sent else 0,
+                    'max_latency_ms': round(lane_stats['latency_max'] * 1000, 2),
+                }
+        return {
+            'lanes': lanes,
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'tracked_chats': len(self._chats),
+            'global_rate': self._global.rate,
+            'chat_rate': self.chat_rate,
+        }
+
+outbound = OutboundDispatcher()
+
+class ThrottledBot(aiomax.Bot):
+    """aiomax.Bot, у которого все запросы, кроме GET, идут через диспетчер исходящих"""
+
+    def __init__(self, *args, dispatcher=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dispatcher = dispatcher or outbound
+
+    async def _submit(self, method, args, kwargs):
+        params = kwargs.get('params') or {}
+        chat_id = params.get('chat_id') or params.get('user_id')
+        if chat_id is None and 'message_id' in params:
+            # Правки и удаления адресуются по сообщению: лимит — на сообщение
+            chat_id = ('message', params['message_id'])
+        return await self.dispatcher.submit(functools.partial(method, *args, **kwargs), chat_id)
+
+    async def post(self, *args, **kwargs):
+        return await self._submit(super().post, args, kwargs)
+
+    async def put(self, *args, **kwargs):
+        return await self._submit(super().put, args, kwargs)
+
+    async def patch(self, *args, **kwargs):
+        return await self._submit(super().patch, args, kwargs)
+
+    async def delete(self, *args, **kwargs):
+        return await self._submit(super().delete, args, kwargs)
@@ -0,0 +1,156 @@
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+
+# Напоминания о неактивности. Срок напоминания — последняя активность плюс
+# REMINDER_INACTIVITY_HOURS; сроки лежат в куче, и планировщик спит ровно до
+# ближайшего. Обновление активности — одна вставка в кучу, O(log n); старая
+# запись пользователя не удаляется, а пропускается при извлечении.
+# Все методы вызываются из event loop бота.
+
+class ReminderScheduler:
+    """Планировщик напоминаний в event loop бота с очередью отправки"""
+
+    def __init__(self, state, send, interval_hours=None, concurrency=None):
+        self.state = state
+        self.send = send
+        self.interval = timedelta(
+            hours=interval_hours or float(os.getenv('REMINDER_INACTIVITY_HOURS', '4'))
+        )
+        # Скорость отправки ограничивает диспетчер исходящих (outbound.py),
+        # здесь — только число напоминаний в полете
+        self.concurrency = concurrency or int(os.getenv('REMINDER_SEND_CONCURRENCY', '20'))
+        self._heap = []
+        self._due = {}
+        self._wakeup = None
+        self._outbox = None
+        self._tasks = []
+        # Отправки в полете: event loop держит на задачи только слабые ссылки
+        self._in_flight = set()
+        self._stats = {'scheduled': 0, 'sent': 0, 'skipped': 0, 'failed': 0}
+
+    def schedule(self, user_id, last_activity):
+        due = last_activity + self.interval
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+        self._stats['scheduled'] += 1
+
+        # Устаревших записей стало больше, чем живых — перестраиваем кучу
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, user_id) for user_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+        if self._wakeup is not None and self._heap[0] == (due, user_id):
+            self._wakeup.set()
+
+    def touch(self, user_id, when=None):
+        """Пользователь проявил активность: сохранить время и перенести напоминание"""
+        when = when or datetime.now()
+        self.state.set_activity(user_id, when)
+        self.schedule(user_id, when)
+
+    def due_for(self, user_id):
+        return self._due.get(user_id)
+
+    def enqueue(self, user_id, test_mode=False):
+        """Поставить напоминание в очередь отправки вне расписания"""
+        self._outbox.put_nowait((user_id, test_mode))
+
+    async def start(self):
+        """Восстановить сроки из сохраненной активности и запустить планировщик"""
+        self._wakeup = asyncio.Event()
+        self._outbox = asyncio.Queue()
+
+        restored = 0
+        for user_id, last_activity in (await self.state.fetch_known_activity()).items():
+            # Активность, пришедшая до старта, уже запланирована и свежее
+            if user_id not in self._due:
+                self._due[user_id] = last_activity + self.interval
+                restored += 1
+        self._heap = [(due, user_id) for user_id, due in self._due.items()]
+        heapq.heapify(self._heap)
+
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._send_loop()),
+        ]
+        logging.info(f"⏰ Планировщик напоминаний запущен, восстановлено сроков: {restored}")
+
+    def _pop_due(self, now):
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            due, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) == due:
+                del self._due[user_id]
+                ready.append(user_id)
+        return ready
+
+    def _next_due(self):
+        # Устаревшие записи с вершины убираем, чтобы не просыпаться зря
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                next_due = self._next_due()
+                if next_due is None:
+                    await self._wakeup.wait()
+                    continue
+
+                delay = (next_due - datetime.now()).total_seconds()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+
+                for user_id in self._pop_due(datetime.now()):
+                    self._outbox.put_nowait((user_id, False))
+            except Exception as e:
+                logging.error(f"Reminder scheduler error: {e}")
+                await asyncio.sleep(1)
+
+    async def _deliver(self, user_id, test_mode, slots):
+        try:
+            if await self.send(user_id, test_mode):
+                self._stats['sent'] += 1
+                # Следующее напоминание — через тот же интервал, без спама
+                self.touch(user_id)
+            else:
+                self._stats['skipped'] += 1
+        except Exception as e:
+            self._stats['failed'] += 1
+            logging.error(f"Error sending reminder to {user_id}: {e}")
+        finally:
+            slots.release()
+
+    async def _send_loop(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            user_id, test_mode = await self._outbox.get()
+            # Пока напоминание ждало в очереди, пользователь снова стал активен
+            if not test_mode and user_id in self._due:
+                self._stats['skipped'] += 1
+                continue
+
+            await slots.acquire()
+            task = asyncio.create_task(self._deliver(user_id, test_mode, slots))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def stats(self):
+        next_due = self._next_due()
+        return {
+            **self._stats,
+            'pending': len(self._due),
+            'heap_size': len(self._heap),
+            'queued': self._outbox.qsize() if self._outbox else 0,
+            'in_flight': len(self._in_flight),
+            'next_due': next_due.isoformat() if next_due else None,
+        }
@@ -1,15 +1,30 @@
+import base64
+import json
 import logging
 import os
 import random
 import datetime
 import sys
 import re
-from typing import List, Optional, Tuple
-from sqlalchemy import func
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func, case, literal, literal_column, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
 
 sys.path.append(os.path.dirname(__file__))
 
-from models import SessionLocal, User, Task, Analytics, Project, BoardColumn, BoardCard
+from models import (
+    acquire_session, release_session, release_connection, finish_write, User, Task, Analytics, Project, BoardColumn, BoardCard,
+    SyncState, SyncTombstone, next_sync_version, record_sync_events
+)
+from migrations import NULL_SORT_DATE, POSITION_GAP, rebalance_positions_sql
+from user_cache import UserIdentity, user_identity_cache
+from stats import get_task_summary, get_day_summary
+from task_merge import merge_user_tasks
+import events  # noqa: F401 — после коммита рассылает изменения подписчикам /events/stream
+
+# Сколько названий выполненных и невыполненных задач дня попадает в промпт анализа
+AI_ANALYSIS_TITLES_LIMIT = 5
 
 QUOTES = [
     "Все, что человеческий разум способен понять и во что он способен поверить, достижимо. — Наполеон Хилл.",
@@ -186,37 +201,115 @@ def normalize_user_id(user_id):
     
     return user_id
 
+# Запросы чтения строятся здесь и выполняются как синхронной сессией services,
+# так и асинхронной в services_async — семантика у обоих путей общая.
+
+def user_identity_select(external_id):
+    return select(User.id, User.external_id, User.created_at).filter_by(external_id=external_id)
+
+def day_bounds(start_date, end_date=None):
+    """Начало дня start_date и конец дня end_date (по умолчанию того же дня)"""
+    return (datetime.datetime.combine(start_date.date(), datetime.time.min),
+            datetime.datetime.combine((end_date or start_date).date(), datetime.time.max))
+
+def tasks_select(user_id, start=None, end=None):
+    """Задачи пользователя с task_date в [start, end] в порядке списка"""
+    query = select(Task).filter_by(user_id=user_id)
+    if start is not None:
+        query = query.filter(Task.task_date >= start, Task.task_date <= end)
+    return query.order_by(Task.task_date.desc(), Task.created_at.desc())
+
+def subtasks_select(parent_task_id):
+    return select(Task).filter_by(parent_id=parent_task_id).order_by(Task.id)
+
+def task_progress_select(parent_ids):
+    Subtask = aliased(Task)
+    return select(
+        Task.id,
+        Task.status,
+        func.count(Subtask.id),
+        func.coalesce(func.sum(case((Subtask.status == 'done', 1), else_=0)), 0)
+    ).outerjoin(
+        Subtask, Subtask.parent_id == Task.id
+    ).filter(
+        Task.id.in_(parent_ids)
+    ).group_by(Task.id, Task.status)
+
+def task_progress_map(parent_ids, rows):
+    """(выполнено, всего, процент) по каждой родительской задаче из строк task_progress_select"""
+    progress = {pid: (0, 0, 0) for pid in parent_ids}
+    for parent_id, parent_status, total, completed in rows:
+        if parent_status == 'done':
+            total = total or 1
+            progress[parent_id] = (total, total, 100)
+        elif total:
+            progress[parent_id] = (completed, total, int((completed / total) * 100))
+    return progress
+
+def get_user_identity(external_id, create=False, name=None):
+    """id пользователя по external_id через кэш; create=True вставляет пользователя, если его нет.
+
+    Вставку коммитит владелец единицы работы; вне ее — сама функция.
+    """
+    external_id = normalize_user_id(external_id)
+    identity = user_identity_cache.get(external_id)
+    if identity:
+        return identity
+
+    db, session_token = acquire_session()
+
+    try:
+        inserted = False
+        if create:
+            result = db.execute(
+                sqlite_insert(User).values(external_id=external_id, name=name)
+                .on_conflict_do_nothing(index_elements=['external_id'])
+            )
+            inserted = bool(result.rowcount)
+
+        row = db.execute(user_identity_select(external_id)).first()
+        if not row:
+            return None
+
+        identity = UserIdentity(*row)
+        if inserted:
+            user_identity_cache.put_after_commit(db, identity)
+            if session_token is not None:
+                db.commit()
+        else:
+            user_identity_cache.put(identity)
+        return identity
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        release_session(db, session_token)
+
 def get_or_create_user(external_id, name=None):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
-        external_id = normalize_user_id(external_id)
-        
-        user = db.query(User).filter_by(external_id=external_id).first()
-        if not user:
-            user = User(external_id=external_id, name=name)
-            db.add(user)
+        identity = get_user_identity(external_id, create=True, name=name)
+        if session_token is not None:
             db.commit()
-            db.refresh(user)
-        return user
+        return db.get(User, identity.id)
     except Exception as e:
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_user_by_external_id(external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
-        external_id = normalize_user_id(external_id)
-        user = db.query(User).filter_by(external_id=external_id).first()
-        return user
+        identity = get_user_identity(external_id)
+        return db.get(User, identity.id) if identity else None
     except Exception as e:
         print(f"Error getting user: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def parse_date(date_str):
     try:
@@ -263,17 +356,10 @@ def validate_date(date_str):
         return None, f"❌ Ошибка при проверке даты: {str(e)}"
 
 def add_task_for_user(external_id, title, estimated_minutes=0, difficulty=1, task_date=None, parent_id=None, is_parent=False):
-    db = SessionLocal()
+    db, session_token = acquire_session()
 
     try:
-        external_id = normalize_user_id(external_id)
-
-        user = db.query(User).filter_by(external_id=external_id).first()
-        if not user:
-            user = User(external_id=external_id)
-            db.add(user)
-            db.commit()
-            db.refresh(user)
+        user = get_user_identity(external_id, create=True)
 
         if task_date is None:
             task_date = datetime.datetime.utcnow()
@@ -303,7 +389,7 @@ def add_task_for_user(external_id, title, estimated_minutes=0, difficulty=1, tas
             task.status = 'pending'
 
         db.add(task)
-        db.commit()
+        finish_write(db, session_token)
         db.refresh(task)
 
         return task
@@ -312,10 +398,10 @@ def add_task_for_user(external_id, title, estimated_minutes=0, difficulty=1, tas
         print(f"Error in add_task_for_user: {e}")
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def add_subtask(external_id, parent_task_id, title, estimated_minutes=0, difficulty=1):
-    db = SessionLocal()
+    db, session_token = acquire_session()
 
     try:
         parent_task = db.query(Task).filter_by(id=parent_task_id).first()
@@ -341,7 +427,7 @@ def add_subtask(external_id, parent_task_id, title, estimated_minutes=0, difficu
         )
 
         parent_task.is_parent = True
-        db.commit()
+        finish_write(db, session_token)
 
         print(f"✅ Подзадача создана: {subtask.id}")
         return subtask
@@ -351,68 +437,173 @@ def add_subtask(external_id, parent_task_id, title, estimated_minutes=0, difficu
         print(f"💥 Ошибка создания подзадачи: {e}")
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
-def list_tasks(external_id, target_date=None):
-    db = SessionLocal()
+def add_subtasks_bulk(external_id, parent_id, titles, estimated_minutes=0, difficulty=1):
+    titles = [t.strip() for t in titles if t and t.strip()]
+    if not titles:
+        return []
+
+    db, session_token = acquire_session()
 
     try:
-        external_id = normalize_user_id(external_id)
+        parent_task = db.get(Task, parent_id)
+        if not parent_task:
+            raise ValueError("Родительская задача не найдена")
 
-        user = db.query(User).filter_by(external_id=external_id).first()
+        if parent_task.status == 'done':
+            raise ValueError("Нельзя добавлять подзадачи к завершенной задаче")
+
+        if parent_task.parent_id is not None:
+            raise ValueError("Нельзя добавлять подзадачи к другой подзадаче")
+
+        today = datetime.datetime.utcnow().date()
+        if parent_task.task_date.date() < today:
+            raise ValueError(f"Дата не может быть раньше сегодняшней ({today.strftime('%d.%m.%Y')})")
+
+        user = get_user_identity(external_id, create=True)
+
+        status = 'quick' if 0 < estimated_minutes <= 2 else 'pending'
+        subtasks = [
+            Task(
+                user_id=user.id,
+                title=title,
+                estimated_minutes=estimated_minutes,
+                difficulty=difficulty,
+                task_date=parent_task.task_date,
+                parent_id=parent_task.id,
+                is_parent=False,
+                status=status
+            )
+            for title in titles
+        ]
+        db.add_all(subtasks)
+        parent_task.is_parent = True
+        finish_write(db, session_token)
+
+        print(f"✅ Создано {len(subtasks)} подзадач для родителя {parent_id}")
+        return subtasks
+
+    except Exception as e:
+        db.rollback()
+        print(f"💥 Ошибка создания подзадач: {e}")
+        raise e
+    finally:
+        release_session(db, session_token)
+
+def list_tasks(external_id, target_date=None):
+    db, session_token = acquire_session()
+
+    try:
+        user = get_user_identity(external_id)
         if not user:
             return []
 
-        query = db.query(Task).filter_by(user_id=user.id)
+        if isinstance(target_date, str):
+            target_date = parse_date(target_date)
+        bounds = day_bounds(target_date) if target_date else ()
 
-        if target_date:
-            if isinstance(target_date, str):
-                target_date = parse_date(target_date)
-            if target_date:
-                start_of_day = datetime.datetime.combine(target_date.date(), datetime.time.min)
-                end_of_day = datetime.datetime.combine(target_date.date(), datetime.time.max)
-                query = query.filter(Task.task_date >= start_of_day, Task.task_date <= end_of_day)
-
-        tasks = query.order_by(Task.task_date.desc(), Task.created_at.desc()).all()
-        return tasks
+        return db.scalars(tasks_select(user.id, *bounds)).all()
     except Exception as e:
         print(f"Error listing tasks: {e}")
         return []
     finally:
-        db.close()
+        release_session(db, session_token)
 
-def list_tasks_by_date_range(external_id, start_date, end_date):
-    db = SessionLocal()
+TASK_FIELDS = ('id', 'user_id', 'title', 'description', 'difficulty', 'status', 'estimated_minutes',
+               'created_at', 'task_date', 'completed_at', 'parent_id', 'is_parent', 'updated_at', 'version')
 
-    try:
-        external_id = normalize_user_id(external_id)
+def encode_task_cursor(task_date, created_at, task_id):
+    raw = json.dumps([task_date.isoformat(), created_at.isoformat(), task_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
 
-        user = db.query(User).filter_by(external_id=external_id).first()
+def decode_task_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        task_date, created_at, task_id = json.loads(raw)
+        return (datetime.datetime.fromisoformat(task_date),
+                datetime.datetime.fromisoformat(created_at), int(task_id))
+    except (ValueError, TypeError):
+        raise ValueError("Неверный курсор")
+
+def task_sort_keys():
+    """Ключи постраничной выдачи задач; NULL-даты заменены на NULL_SORT_DATE (см. миграцию 7)"""
+    null_date = literal_column(f"'{NULL_SORT_DATE}'")
+    return (func.coalesce(Task.task_date, null_date), func.coalesce(Task.created_at, null_date), Task.id)
+
+def list_tasks_page(external_id, limit=100, cursor=None, status=None, date_from=None, date_to=None,
+                    parent_id=None, top_level=False, fields=None):
+    """Страница задач в порядке (task_date desc, created_at desc, id desc) с курсором на следующую.
+
+    limit=None — все задачи без курсора. status — конкретный статус или 'active' (все, кроме 'done');
+    date_from/date_to — по task_date включительно; fields — какие поля вернуть (id всегда возвращается).
+    """
+    fields = [f for f in TASK_FIELDS if not fields or f in fields or f == 'id']
+
+    db, session_token = acquire_session()
+    try:
+        user = get_user_identity(external_id)
         if not user:
-            return []
+            return [], None
+
+        sort_keys = task_sort_keys()
+        query = db.query(
+            *(getattr(Task, f) for f in fields),
+            sort_keys[0].label('sort_date'), sort_keys[1].label('sort_created')
+        ).filter(Task.user_id == user.id)
+
+        if status == 'active':
+            query = query.filter(Task.status != 'done')
+        elif status:
+            query = query.filter(Task.status == status)
+        if date_from:
+            query = query.filter(Task.task_date >= datetime.datetime.combine(date_from.date(), datetime.time.min))
+        if date_to:
+            query = query.filter(Task.task_date <= datetime.datetime.combine(date_to.date(), datetime.time.max))
+        if parent_id is not None:
+            query = query.filter(Task.parent_id == parent_id)
+        elif top_level:
+            query = query.filter(Task.parent_id.is_(None))
+        if cursor:
+            # Значения курсора типизированы по ключам, чтобы даты сравнивались в формате колонок
+            bounds = (literal(value, key.type) for key, value in zip(sort_keys, decode_task_cursor(cursor)))
+            query = query.filter(tuple_(*sort_keys) < tuple_(*bounds))
+
+        query = query.order_by(*(key.desc() for key in sort_keys))
+        if limit is None:
+            return [{f: getattr(row, f) for f in fields} for row in query.all()], None
+
+        rows = query.limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_task_cursor(last.sort_date, last.sort_created, last.id)
+
+        return [{f: getattr(row, f) for f in fields} for row in rows], next_cursor
+    finally:
+        release_session(db, session_token)
 
-        start_of_day = datetime.datetime.combine(start_date.date(), datetime.time.min)
-        end_of_day = datetime.datetime.combine(end_date.date(), datetime.time.max)
+def list_tasks_by_date_range(external_id, start_date, end_date):
+    db, session_token = acquire_session()
 
-        tasks = db.query(Task).filter_by(user_id=user.id).filter(
-            Task.task_date >= start_of_day,
-            Task.task_date <= end_of_day
-        ).order_by(Task.task_date.desc(), Task.created_at.desc()).all()
+    try:
+        user = get_user_identity(external_id)
+        if not user:
+            return []
 
-        return tasks
+        return db.scalars(tasks_select(user.id, *day_bounds(start_date, end_date))).all()
     except Exception as e:
         print(f"Error listing tasks by date range: {e}")
         return []
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def complete_task(external_id, task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
 
     try:
-        external_id = normalize_user_id(external_id)
-
-        user = db.query(User).filter_by(external_id=external_id).first()
+        user = get_user_identity(external_id)
         if not user:
             return None
 
@@ -421,7 +612,7 @@ def complete_task(external_id, task_id):
             return None
 
         task.status = 'done'
-        db.commit()
+        finish_write(db, session_token)
 
         completed_task_data = {
             'id': task.id,
@@ -437,15 +628,13 @@ def complete_task(external_id, task_id):
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def complete_subtask(external_id, parent_task_id, subtask_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
 
     try:
-        external_id = normalize_user_id(external_id)
-
-        user = db.query(User).filter_by(external_id=external_id).first()
+        user = get_user_identity(external_id)
         if not user:
             return None
 
@@ -459,7 +648,7 @@ def complete_subtask(external_id, parent_task_id, subtask_id):
             return None
 
         subtask.status = 'done'
-        db.commit()
+        finish_write(db, session_token)
 
         return {
             'id': subtask.id,
@@ -471,10 +660,10 @@ def complete_subtask(external_id, parent_task_id, subtask_id):
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def complete_parent_task(parent_task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
         parent = db.query(Task).filter_by(id=parent_task_id).first()
         if not parent:
@@ -486,7 +675,7 @@ def complete_parent_task(parent_task_id):
         for subtask in subtasks:
             subtask.status = 'done'
 
-        db.commit()
+        finish_write(db, session_token)
 
         return {
             'id': parent.id,
@@ -497,48 +686,37 @@ def complete_parent_task(parent_task_id):
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_subtasks(parent_task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        subtasks = db.query(Task).filter_by(parent_id=parent_task_id).order_by(Task.id).all()
-        return subtasks
+        return db.scalars(subtasks_select(parent_task_id)).all()
     except Exception as e:
         print(f"💥 Ошибка получения подзадач: {e}")
         return []
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_task_progress(parent_task_id):
-    db = SessionLocal()
-    try:
-        parent_task = db.query(Task).filter_by(id=parent_task_id).first()
-        if not parent_task:
-            return (0, 0, 0)
-        
-        if parent_task.status == 'done':
-            subtasks = db.query(Task).filter_by(parent_id=parent_task_id).all()
-            total = len(subtasks) if subtasks else 1
-            return (total, total, 100)
-        
-        subtasks = db.query(Task).filter_by(parent_id=parent_task_id).all()
-        if not subtasks:
-            return (0, 0, 0)
+    return get_task_progress_bulk([parent_task_id]).get(parent_task_id, (0, 0, 0))
 
-        completed = len([t for t in subtasks if t.status == 'done'])
-        total = len(subtasks)
-        progress = int((completed / total) * 100) if total > 0 else 0
+def get_task_progress_bulk(parent_ids: Iterable[int]) -> Dict[int, Tuple[int, int, int]]:
+    parent_ids = {pid for pid in parent_ids if pid is not None}
+    if not parent_ids:
+        return {}
 
-        return (completed, total, progress)
+    db, session_token = acquire_session()
+    try:
+        return task_progress_map(parent_ids, db.execute(task_progress_select(parent_ids)).all())
     except Exception as e:
         print(f"💥 Ошибка получения прогресса: {e}")
-        return (0, 0, 0)
+        return {pid: (0, 0, 0) for pid in parent_ids}
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_task_by_id(task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
         task = db.query(Task).filter_by(id=task_id).first()
         return task
@@ -546,25 +724,40 @@ def get_task_by_id(task_id):
         print(f"Error getting task: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def list_subtasks(parent_task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        subtasks = db.query(Task).filter_by(parent_id=parent_task_id).order_by(Task.id).all()
-        return subtasks
+        return db.scalars(subtasks_select(parent_task_id)).all()
     except Exception as e:
         print(f"💥 Ошибка получения подзадач: {e}")
         return []
     finally:
-        db.close()
+        release_session(db, session_token)
 
 
-def ai_enhanced_daily_analysis(user, tasks, for_react=False):
+def today_task_titles(user_id, day, limit=AI_ANALYSIS_TITLES_LIMIT):
+    """Названия выполненных и невыполненных задач, созданных в день day, — не больше limit каждых"""
+    db, session_token = acquire_session()
+    try:
+        start, end = day_bounds(datetime.datetime.combine(day, datetime.time.min))
+        query = select(Task.title).filter(
+            Task.user_id == user_id,
+            Task.created_at >= start,
+            Task.created_at <= end
+        ).order_by(Task.created_at.desc()).limit(limit)
+        completed = db.execute(query.filter(Task.status == 'done')).scalars().all()
+        pending = db.execute(query.filter(Task.status != 'done')).scalars().all()
+        return completed, pending
+    finally:
+        release_session(db, session_token)
+
+def ai_enhanced_daily_analysis(user, for_react=False):
     today = datetime.datetime.utcnow().date()
-    today_tasks = [t for t in tasks if t.created_at.date() == today]
+    day_stats = get_day_summary(user.id, today)
 
-    if not today_tasks:
+    if not day_stats['total_tasks']:
         base_result = {
             'result': 'neutral',
             'text': "📝 Сегодня еще нет задач. Начни с маленького шага!",
@@ -575,20 +768,25 @@ def ai_enhanced_daily_analysis(user, tasks, for_react=False):
             base_result['recommendation'] = "Попробуй добавить быструю задачу на 2 минуты."
         return base_result
 
-    completed_today = [t for t in today_tasks if t.status == 'done']
-    pending_today = [t for t in today_tasks if t.status != 'done']
-    completion_rate = len(completed_today) / len(today_tasks) if today_tasks else 0
+    # Все числа — из строки daily_user_stats; задачи читаются только ради нескольких названий для промпта
+    done = day_stats['completed_tasks']
+    pending = day_stats['pending_tasks']
+    total = day_stats['total_tasks']
+    completion_rate = done / total
 
-    total_minutes = sum(t.estimated_minutes for t in today_tasks)
-    completed_minutes = sum(t.estimated_minutes for t in completed_today)
+    total_minutes = day_stats['total_minutes']
+    completed_minutes = day_stats['completed_minutes']
     time_utilization = (completed_minutes / total_minutes * 100) if total_minutes > 0 else 0
 
     try:
+        completed_titles, pending_titles = today_task_titles(user.id, today)
         ai_analysis = get_ai_daily_insights({
-            'completed_tasks': [t.title for t in completed_today],
-            'pending_tasks': [t.title for t in pending_today],
+            'completed_tasks': completed_titles,
+            'pending_tasks': pending_titles,
+            'completed_count': done,
+            'pending_count': pending,
             'completion_rate': completion_rate,
-            'total_tasks': len(today_tasks),
+            'total_tasks': total,
             'user_level': user.level,
             'total_minutes': total_minutes,
             'completed_minutes': completed_minutes,
@@ -597,20 +795,20 @@ def ai_enhanced_daily_analysis(user, tasks, for_react=False):
 
         if ai_analysis:
             if for_react:
-                return format_ai_analysis_for_react(ai_analysis, completed_today, pending_today, today_tasks, total_minutes, completed_minutes, time_utilization)
+                return format_ai_analysis_for_react(ai_analysis, done, pending, total, total_minutes, completed_minutes, time_utilization)
             else:
-                return format_ai_analysis_for_bot(ai_analysis, completed_today, pending_today, today_tasks)
+                return format_ai_analysis_for_bot(ai_analysis, done, pending, total)
 
     except Exception as e:
         logging.info(f"AI analysis failed, using fallback: {e}")
 
     if for_react:
-        return generate_fallback_analysis_react(completed_today, pending_today, today_tasks, total_minutes, completed_minutes, time_utilization)
+        return generate_fallback_analysis_react(done, pending, total, total_minutes, completed_minutes, time_utilization)
     else:
-        return generate_fallback_analysis_bot(completed_today, pending_today, today_tasks)
+        return generate_fallback_analysis_bot(done, pending, total)
 
-def format_ai_analysis_for_react(ai_analysis, completed, pending, today_tasks, total_minutes, completed_minutes, time_utilization):
-    completion_rate = len(completed) / len(today_tasks) if today_tasks else 0
+def format_ai_analysis_for_react(ai_analysis, done, pending, total, total_minutes, completed_minutes, time_utilization):
+    completion_rate = done / total if total else 0
     
     mood_mapping = {
         'excellent': 'positive',
@@ -636,9 +834,9 @@ def format_ai_analysis_for_react(ai_analysis, completed, pending, today_tasks, t
         'recommendation': ai_analysis.get('recommendation', 'Продолжайте в том же духе!'),
         'emoji': ai_analysis.get('emoji', '📊'),
         'stats': {
-            'done': len(completed),
-            'pending': len(pending),
-            'total': len(today_tasks),
+            'done': done,
+            'pending': pending,
+            'total': total,
             'completion_rate': int(completion_rate * 100)
         },
         'time_stats': {
@@ -655,28 +853,28 @@ def format_ai_analysis_for_react(ai_analysis, completed, pending, today_tasks, t
         }
     }
 
-def generate_fallback_analysis_bot(completed, pending, today_tasks):
-    completion_rate = len(completed) / len(today_tasks) if today_tasks else 0
+def generate_fallback_analysis_bot(done, pending, total):
+    completion_rate = done / total if total else 0
 
     if completion_rate >= 0.8:
         emoji = "🎉"
         mood = "excellent"
-        analysis = f"Отлично! {len(completed)} из {len(today_tasks)} задач выполнено!"
+        analysis = f"Отлично! {done} из {total} задач выполнено!"
         recommendation = "Ты сегодня на высоте! Можешь взяться за что-то сложное!"
     elif completion_rate >= 0.6:
         emoji = "🚀"
         mood = "good"
-        analysis = f"Хороший темп! {len(completed)} из {len(today_tasks)} задач сделано!"
+        analysis = f"Хороший темп! {done} из {total} задач сделано!"
         recommendation = "Почти идеально! Завтра добьешь оставшееся!"
     elif completion_rate >= 0.3:
         emoji = "💪"
         mood = "moderate"
-        analysis = f"Неплохо! {len(completed)} из {len(today_tasks)} задач завершено."
+        analysis = f"Неплохо! {done} из {total} задач завершено."
         recommendation = "Сосредоточься на завершении начатых задач!"
-    elif len(completed) > 0:
+    elif done > 0:
         emoji = "📈"
         mood = "needs_improvement"
-        analysis = f"Есть прогресс! {len(completed)} из {len(today_tasks)} задач выполнено."
+        analysis = f"Есть прогресс! {done} из {total} задач выполнено."
         recommendation = "Начни завтра с самой простой задачи!"
     else:
         emoji = "🎯"
@@ -686,8 +884,8 @@ def generate_fallback_analysis_bot(completed, pending, today_tasks):
 
     text = f"{emoji} **Анализ дня:**\n\n"
     text += f"📊 *{analysis}*\n\n"
-    text += f"✅ Выполнено: {len(completed)} из {len(today_tasks)}\n"
-    text += f"⏳ В процессе: {len(pending)}\n\n"
+    text += f"✅ Выполнено: {done} из {total}\n"
+    text += f"⏳ В процессе: {pending}\n\n"
     text += f"💡 *{recommendation}*"
 
     return {
@@ -695,35 +893,35 @@ def generate_fallback_analysis_bot(completed, pending, today_tasks):
         'text': text,
         'emoji': emoji,
         'stats': {
-            'done': len(completed),
-            'pending': len(pending),
-            'total': len(today_tasks),
+            'done': done,
+            'pending': pending,
+            'total': total,
             'completion_rate': int(completion_rate * 100)
         }
     }
 
-def generate_fallback_analysis_react(completed, pending, today_tasks, total_minutes, completed_minutes, time_utilization):
-    completion_rate = len(completed) / len(today_tasks) if today_tasks else 0
+def generate_fallback_analysis_react(done, pending, total, total_minutes, completed_minutes, time_utilization):
+    completion_rate = done / total if total else 0
 
     if completion_rate >= 0.8:
         emoji = "🎉"
         mood = "excellent"
-        analysis = f"Отлично! {len(completed)} из {len(today_tasks)} задач выполнено!"
+        analysis = f"Отлично! {done} из {total} задач выполнено!"
         recommendation = "Ты сегодня на высоте! Можешь взяться за что-то сложное!"
     elif completion_rate >= 0.6:
         emoji = "🚀"
         mood = "good"
-        analysis = f"Хороший темп! {len(completed)} из {len(today_tasks)} задач сделано!"
+        analysis = f"Хороший темп! {done} из {total} задач сделано!"
         recommendation = "Почти идеально! Завтра добьешь оставшееся!"
     elif completion_rate >= 0.3:
         emoji = "💪"
         mood = "moderate"
-        analysis = f"Неплохо! {len(completed)} из {len(today_tasks)} задач завершено."
+        analysis = f"Неплохо! {done} из {total} задач завершено."
         recommendation = "Сосредоточься на завершении начатых задач!"
-    elif len(completed) > 0:
+    elif done > 0:
         emoji = "📈"
         mood = "needs_improvement"
-        analysis = f"Есть прогресс! {len(completed)} из {len(today_tasks)} задач выполнено."
+        analysis = f"Есть прогресс! {done} из {total} задач выполнено."
         recommendation = "Начни завтра с самой простой задачи!"
     else:
         emoji = "🎯"
@@ -737,9 +935,9 @@ def generate_fallback_analysis_react(completed, pending, today_tasks, total_minu
         'recommendation': recommendation,
         'emoji': emoji,
         'stats': {
-            'done': len(completed),
-            'pending': len(pending),
-            'total': len(today_tasks),
+            'done': done,
+            'pending': pending,
+            'total': total,
             'completion_rate': int(completion_rate * 100)
         },
         'time_stats': {
@@ -764,14 +962,14 @@ def get_ai_daily_insights(daily_data):
         Проанализируй продуктивность пользователя за сегодня и дай краткие инсайты для бота.
 
         ДАННЫЕ:
-        - Выполнено задач: {len(daily_data['completed_tasks'])}
-        - Невыполнено задач: {len(daily_data['pending_tasks'])}  
+        - Выполнено задач: {daily_data['completed_count']}
+        - Невыполнено задач: {daily_data['pending_count']}  
         - Процент выполнения: {daily_data['completion_rate']:.0%}
         - Всего задач сегодня: {daily_data['total_tasks']}
         - Уровень пользователя: {daily_data['user_level']}
 
-        ВЫПОЛНЕННЫЕ ЗАДАЧИ: {', '.join(daily_data['completed_tasks'][:5])}
-        НЕВЫПОЛНЕННЫЕ ЗАДАЧИ: {', '.join(daily_data['pending_tasks'][:5])}
+        ВЫПОЛНЕННЫЕ ЗАДАЧИ: {', '.join(daily_data['completed_tasks'])}
+        НЕВЫПОЛНЕННЫЕ ЗАДАЧИ: {', '.join(daily_data['pending_tasks'])}
 
         Дай краткий анализ в формате:
         ЭМОДЗИ|ОЦЕНКА|КРАТКИЙ_АНАЛИЗ|РЕКОМЕНДАЦИЯ
@@ -785,9 +983,11 @@ def get_ai_daily_insights(daily_data):
         Твой анализ:
         """
 
-        response = gigachat_client._make_gigachat_request(prompt)
+        release_connection()
+        response = gigachat_client.complete(prompt, temperature=0.5, max_tokens=150)
         if response:
-            parts = response.split('|')
+            line = next((l for l in response.splitlines() if l.count('|') == 3), response)
+            parts = line.split('|')
             if len(parts) == 4:
                 return {
                     'emoji': parts[0].strip(),
@@ -802,13 +1002,13 @@ def get_ai_daily_insights(daily_data):
     return None
 
 
-def format_ai_analysis_for_bot(ai_analysis, completed, pending, today_tasks):
-    completion_rate = len(completed) / len(today_tasks) if today_tasks else 0
+def format_ai_analysis_for_bot(ai_analysis, done, pending, total):
+    completion_rate = done / total if total else 0
 
     text = f"{ai_analysis['emoji']} **AI Анализ дня:**\n\n"
     text += f"📊 *{ai_analysis['analysis']}*\n\n"
-    text += f"✅ Выполнено: {len(completed)} из {len(today_tasks)}\n"
-    text += f"⏳ В процессе: {len(pending)}\n\n"
+    text += f"✅ Выполнено: {done} из {total}\n"
+    text += f"⏳ В процессе: {pending}\n\n"
     text += f"💡 *{ai_analysis['recommendation']}*"
 
     return {
@@ -816,9 +1016,9 @@ def format_ai_analysis_for_bot(ai_analysis, completed, pending, today_tasks):
         'text': text,
         'emoji': ai_analysis['emoji'],
         'stats': {
-            'done': len(completed),
-            'pending': len(pending),
-            'total': len(today_tasks),
+            'done': done,
+            'pending': pending,
+            'total': total,
             'completion_rate': int(completion_rate * 100)
         }
     }
@@ -872,29 +1072,29 @@ def generate_fallback_analysis(completed, pending, today_tasks):
     }
 
 
-def analyze_day(user, tasks):
-    today = datetime.datetime.utcnow().date()
-    done = [t for t in tasks if t.status == 'done' and t.created_at.date() == today]
-    pending = [t for t in tasks if t.status != 'done' and t.created_at.date() == today]
-    score = len(done) - len(pending)
+def analyze_day(user):
+    day_stats = get_day_summary(user.id)
+    done = day_stats['completed_tasks']
+    pending = day_stats['pending_tasks']
+    score = done - pending
 
     if score >= 3:
         result = 'success'
-        text = f"🎉 Отлично! Сегодня выполнено {len(done)} задач. Ты просто машина продуктивности!"
+        text = f"🎉 Отлично! Сегодня выполнено {done} задач. Ты просто машина продуктивности!"
     elif score >= 1:
         result = 'success'
-        text = f"✅ Хорошо! Выполнено {len(done)} задач. Продолжай в том же духе!"
+        text = f"✅ Хорошо! Выполнено {done} задач. Продолжай в том же духе!"
     elif score == 0:
         result = 'neutral'
-        text = f"⚖️ Норм. Выполнил {len(done)} задач и откладывал {len(pending)}. Завтра будет лучше!"
+        text = f"⚖️ Норм. Выполнил {done} задач и откладывал {pending}. Завтра будет лучше!"
     else:
         result = 'fail'
-        text = f"💀 Хмм... Выполнено {len(done)} задач, но {len(pending)} не сделано. Не будь нубом — начни с малого!"
+        text = f"💀 Хмм... Выполнено {done} задач, но {pending} не сделано. Не будь нубом — начни с малого!"
 
-    return {'result': result, 'text': text, 'stats': {'done': len(done), 'pending': len(pending), 'score': score}}
+    return {'result': result, 'text': text, 'stats': {'done': done, 'pending': pending, 'score': score}}
 
 def update_user_profile(external_id, name=None, energy=None, level=None):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
         external_id = normalize_user_id(external_id)
@@ -908,7 +1108,7 @@ def update_user_profile(external_id, name=None, energy=None, level=None):
             if level is not None:
                 user.level = level
                 
-            db.commit()
+            finish_write(db, session_token)
             db.refresh(user)
             
         return user
@@ -916,7 +1116,7 @@ def update_user_profile(external_id, name=None, energy=None, level=None):
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def sync_user_from_max(external_id, max_user_data):
     if not max_user_data:
@@ -929,7 +1129,7 @@ def sync_user_from_max(external_id, max_user_data):
     return update_user_profile(external_id, name=name)
 
 def get_user_stats(external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
         external_id = normalize_user_id(external_id)
@@ -938,42 +1138,30 @@ def get_user_stats(external_id):
         if not user:
             return None
             
-        tasks = db.query(Task).filter_by(user_id=user.id).all()
-        total_tasks = len(tasks)
-        completed_tasks = len([t for t in tasks if t.status == 'done'])
-        pending_tasks = len([t for t in tasks if t.status != 'done'])
-        
-        completion_rate = round((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0, 1)
-        
-        difficulty_stats = {
-            'high': len([t for t in tasks if t.difficulty >= 4]),
-            'medium': len([t for t in tasks if t.difficulty == 3]),
-            'low': len([t for t in tasks if t.difficulty <= 2]),
-        }
+        summary = get_task_summary(user.id)
         
         return {
             'user_id': user.external_id,
             'name': user.name,
             'energy': user.energy,
             'level': user.level,
-            'total_tasks': total_tasks,
-            'completed_tasks': completed_tasks,
-            'pending_tasks': pending_tasks,
-            'completion_rate': completion_rate,
-            'difficulty_stats': difficulty_stats
+            'total_tasks': summary['total_tasks'],
+            'completed_tasks': summary['completed_tasks'],
+            'pending_tasks': summary['pending_tasks'],
+            'completion_rate': summary['completion_rate'],
+            'difficulty_stats': summary['difficulty_stats']
         }
     except Exception as e:
         print(f"Error getting user stats: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def delete_task(external_id, task_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
-        external_id = normalize_user_id(external_id)
-        user = db.query(User).filter_by(external_id=external_id).first()
+        user = get_user_identity(external_id)
         
         if not user:
             return False
@@ -983,21 +1171,20 @@ def delete_task(external_id, task_id):
             return False
             
         db.delete(task)
-        db.commit()
+        finish_write(db, session_token)
         return True
     except Exception as e:
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def update_task(external_id, task_id, title=None, description=None, estimated_minutes=None, 
                difficulty=None, status=None, task_date=None):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
-        external_id = normalize_user_id(external_id)
-        user = db.query(User).filter_by(external_id=external_id).first()
+        user = get_user_identity(external_id)
         
         if not user:
             return None
@@ -1024,97 +1211,74 @@ def update_task(external_id, task_id, title=None, description=None, estimated_mi
                     raise ValueError(f"Дата не может быть раньше сегодняшней ({today.strftime('%d.%m.%Y')})")
             task.task_date = task_date
             
-        db.commit()
+        finish_write(db, session_token)
         db.refresh(task)
         return task
     except Exception as e:
         db.rollback()
         raise e
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_today_stats(external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     
     try:
-        external_id = normalize_user_id(external_id)
-        user = db.query(User).filter_by(external_id=external_id).first()
+        user = get_user_identity(external_id)
         
         if not user:
             return None
             
-        today = datetime.datetime.utcnow().date()
-        tasks = db.query(Task).filter_by(user_id=user.id).filter(
-            Task.created_at >= today
-        ).all()
-        
-        completed_today = len([t for t in tasks if t.status == 'done'])
-        pending_today = len([t for t in tasks if t.status != 'done'])
+        day_stats = get_day_summary(user.id)
         
         return {
-            'completed_today': completed_today,
-            'pending_today': pending_today,
-            'total_today': len(tasks)
+            'completed_today': day_stats['completed_tasks'],
+            'pending_today': day_stats['pending_tasks'],
+            'total_today': day_stats['total_tasks']
         }
     except Exception as e:
         print(f"Error getting today stats: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_user_by_max_id(max_user_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
         external_id = f"max_{max_user_id}"
         user = db.query(User).filter_by(external_id=external_id).first()
         return user
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def sync_tasks_between_users(source_user_id, target_user_id):
-    db = SessionLocal()
+    """Скопировать недостающие задачи source -> target; None, если пользователей нет или ошибка"""
+    db, session_token = acquire_session()
     try:
-        source_user = db.query(User).filter_by(external_id=source_user_id).first()
-        target_user = db.query(User).filter_by(external_id=target_user_id).first()
+        source_user = get_user_identity(source_user_id)
+        target_user = get_user_identity(target_user_id)
         
         if not source_user or not target_user:
-            return False
-            
-        source_tasks = db.query(Task).filter_by(user_id=source_user.id).all()
-        
-        for task in source_tasks:
-            existing_task = db.query(Task).filter_by(
-                user_id=target_user.id, 
-                title=task.title,
-                status=task.status
-            ).first()
-            
-            if not existing_task:
-                new_task = Task(
-                    user_id=target_user.id,
-                    title=task.title,
-                    description=task.description,
-                    difficulty=task.difficulty,
-                    status=task.status,
-                    estimated_minutes=task.estimated_minutes,
-                    task_date=task.task_date
-                )
-                db.add(new_task)
-        
-        db.commit()
-        return True
+            return None
+
+        result = merge_user_tasks(db, source_user.id, target_user.id)
+        finish_write(db, session_token)
+        print(f"🔄 Синхронизация {source_user_id} -> {target_user_id}: скопировано {result['copied']}, "
+              f"связано подзадач {result['linked']}, пропущено {result['skipped']}")
+        return result
     except Exception as e:
         db.rollback()
         print(f"Sync error: {e}")
-        return False
+        return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
-def enhanced_daily_analysis(user, tasks):
-    today = datetime.datetime.utcnow().date()
-    today_tasks = [t for t in tasks if t.created_at.date() == today]
+def enhanced_daily_analysis(user):
+    day_stats = get_day_summary(user.id)
+    total = day_stats['total_tasks']
+    completed = day_stats['completed_tasks']
     
-    if not today_tasks:
+    if not total:
         return {
             'result': 'neutral',
             'text': "📝 Сегодня еще нет задач. Начни с маленького шага!",
@@ -1122,33 +1286,30 @@ def enhanced_daily_analysis(user, tasks):
             'emoji': "🤔"
         }
     
-    completed_today = [t for t in today_tasks if t.status == 'done']
-    pending_today = [t for t in today_tasks if t.status != 'done']
-    
-    completion_ratio = len(completed_today) / len(today_tasks) if today_tasks else 0
+    completion_ratio = completed / total
     
-    avg_difficulty = sum(t.difficulty for t in today_tasks) / len(today_tasks)
-    completed_difficulty = sum(t.difficulty for t in completed_today) / len(completed_today) if completed_today else 0
+    avg_difficulty = day_stats['total_difficulty'] / total
+    completed_difficulty = day_stats['completed_difficulty'] / completed if completed else 0
     
     if completion_ratio >= 0.8:
         result = 'success'
         emoji = "🎉"
-        text = f"Отлично! Выполнено {len(completed_today)} из {len(today_tasks)} задач!"
+        text = f"Отлично! Выполнено {completed} из {total} задач!"
         recommendation = "Ты сегодня на высоте! Можешь взяться за что-то сложное."
     elif completion_ratio >= 0.5:
         result = 'success'
         emoji = "👍"
-        text = f"Хорошо! Выполнено {len(completed_today)} из {len(today_tasks)} задач."
+        text = f"Хорошо! Выполнено {completed} из {total} задач."
         recommendation = "Продолжай в том же духе! Ты близок к отличному результату."
     elif completion_ratio > 0:
         result = 'neutral'
         emoji = "💪"
-        text = f"Неплохо, но можно лучше. Выполнено {len(completed_today)} из {len(today_tasks)}."
+        text = f"Неплохо, но можно лучше. Выполнено {completed} из {total}."
         recommendation = "Сосредоточься на одной задаче за раз. Используй Pomodoro таймер!"
     else:
         result = 'fail'
         emoji = "💀"
-        text = f"Эй, нубик! 0 из {len(today_tasks)} задач выполнено. Соберись!"
+        text = f"Эй, нубик! 0 из {total} задач выполнено. Соберись!"
         recommendation = "Начни с самой простой задачи. Даже 2 минуты работы - это прогресс!"
     
     if avg_difficulty > 3 and completion_ratio < 0.5:
@@ -1160,22 +1321,22 @@ def enhanced_daily_analysis(user, tasks):
         'recommendation': recommendation,
         'emoji': emoji,
         'stats': {
-            'completed': len(completed_today),
-            'pending': len(pending_today),
-            'total': len(today_tasks),
+            'completed': completed,
+            'pending': day_stats['pending_tasks'],
+            'total': total,
             'completion_ratio': round(completion_ratio * 100),
             'avg_difficulty': round(avg_difficulty, 1)
         }
     }
 
 def ensure_user_sync(max_user_id, username):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
         max_external_id = f"max_{max_user_id}"
         web_external_id = f"user_{username.lower().replace(' ', '_')}"
         
-        max_user = db.query(User).filter_by(external_id=max_external_id).first()
-        web_user = db.query(User).filter_by(external_id=web_external_id).first()
+        max_user = get_user_identity(max_external_id)
+        web_user = get_user_identity(web_external_id)
         
         if max_user and web_user and max_user.id != web_user.id:
             sync_tasks_between_users(max_external_id, web_external_id)
@@ -1183,52 +1344,56 @@ def ensure_user_sync(max_user_id, username):
             
         return web_external_id
     finally:
-        db.close()
+        release_session(db, session_token)
 
 try:
     from gigachat_client import gigachat_client
+    from decomposition_cache import DecompositionCache
+
+    decomposition_cache = DecompositionCache(prompt_version=gigachat_client.decompose_prompt_version)
     
-    def decompose_task(title: str, user_id: str = None) -> List[str]:
+    def decompose_task(title: str, user_id: str = None, on_progress=None) -> List[str]:
+        """Создать родительскую задачу и подзадачи из шагов GigaChat.
+
+        Шаги запрашиваются до любой записи, поэтому на время ответа GigaChat сессия
+        не держит ни соединение, ни блокировку записи SQLite; задачи фиксирует
+        владелец единицы работы одним коммитом. Ошибки базы пробрасываются вызывающему
+        (задание получит статус 'failed'); шаблонные шаги используются, только если
+        GigaChat не вернул ответ.
+        """
         print(f"🔍 decompose_task вызвана с: '{title}' для пользователя: {user_id}")
+        on_progress = on_progress or (lambda stage, **data: None)
 
-        try:
-            parent_task = add_task_for_user(
-                external_id=user_id,
-                title=title,
-                is_parent=True 
-            )
-            print(f"✅ Создана родительская задача: {parent_task.id} - '{title}'")
-
-            ai_steps = gigachat_client.decompose_task(title)
-
-            if ai_steps:
-                print(f"✅ GigaChat вернул шаги: {ai_steps}")
-
-                created_subtasks = []
-                for step in ai_steps:
-                    subtask = add_subtask(
-                        external_id=user_id,
-                        parent_task_id=parent_task.id,
-                        title=step
-                    )
-                    created_subtasks.append(subtask)
-                    print(f"✅ Создана подзадача: {subtask.id} - '{step}'")
+        steps = decomposition_cache.get(title)
+        if steps:
+            print(f"⚡ Разложение найдено в кэше: '{title}'")
+        else:
+            # Ответ GigaChat ждем до 30 секунд — соединение на это время возвращаем в пул
+            release_connection()
+            steps = gigachat_client.decompose_task(title)
+            if steps:
+                decomposition_cache.put(title, steps)
+
+        fallback = not steps
+        if fallback:
+            print("❌ GigaChat не вернул шаги, используем fallback")
+            steps = decompose_task_fallback(title)
+        else:
+            print(f"✅ GigaChat вернул шаги: {steps}")
+        on_progress('steps_received', steps=steps, fallback=fallback)
 
-                print(f"✅ Автоматически создано {len(created_subtasks)} подзадач")
-                return ai_steps
+        parent_task = add_task_for_user(
+            external_id=user_id,
+            title=title,
+            is_parent=True 
+        )
+        print(f"✅ Создана родительская задача: {parent_task.id} - '{title}'")
+        on_progress('parent_created', parent_task_id=parent_task.id)
 
-            else:
-                print("❌ GigaChat не вернул шаги, используем fallback")
-                fallback_steps = decompose_task_fallback(title)
-                if user_id and fallback_steps:
-                    for step in fallback_steps:
-                        add_subtask(user_id, parent_task.id, step)
-                return fallback_steps
-
-        except Exception as e:
-            print(f"💥 Ошибка в decompose_task: {e}")
-            logging.error(f"Decomposition failed: {e}")
-            return decompose_task_fallback(title)
+        if steps:
+            created_subtasks = add_subtasks_bulk(user_id, parent_task.id, steps)
+            print(f"✅ Автоматически создано {len(created_subtasks)} подзадач")
+        return steps
 
     def decompose_task_fallback(title: str) -> List[str]:
         hints = []
@@ -1253,9 +1418,13 @@ try:
 
 except ImportError:
     print("⚠️ GigaChat client not available")
+
+    decomposition_cache = None
     
-    def decompose_task(title: str, user_id: str = None) -> List[str]:
+    def decompose_task(title: str, user_id: str = None, on_progress=None) -> List[str]:
+        on_progress = on_progress or (lambda stage, **data: None)
         fallback_steps = decompose_task_fallback(title)
+        on_progress('steps_received', steps=fallback_steps, fallback=True)
         
         if user_id:
             parent_task = add_task_for_user(
@@ -1264,9 +1433,9 @@ except ImportError:
                 is_parent=True
             )
             print(f"✅ Создана родительская задача: {parent_task.id} - '{title}'")
+            on_progress('parent_created', parent_task_id=parent_task.id)
             
-            for step in fallback_steps:
-                add_subtask(user_id, parent_task.id, step)
+            add_subtasks_bulk(user_id, parent_task.id, fallback_steps)
             print(f"✅ Создано {len(fallback_steps)} подзадач из fallback")
         
         return fallback_steps
@@ -1293,9 +1462,9 @@ except ImportError:
         return hints
 
 def create_project(external_id, title, description=None, color="#3b82f6"):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return None
         
@@ -1306,13 +1475,13 @@ def create_project(external_id, title, description=None, color="#3b82f6"):
             color=color
         )
         db.add(project)
-        db.commit()
+        db.flush()
         db.refresh(project)
         
         default_columns = [
-            {"title": "📋 Бэклог", "color": "#6b7280", "position": 0},
-            {"title": "🔄 В работе", "color": "#f59e0b", "position": 1},
-            {"title": "✅ Готово", "color": "#10b981", "position": 2}
+            {"title": "📋 Бэклог", "color": "#6b7280", "position": POSITION_GAP},
+            {"title": "🔄 В работе", "color": "#f59e0b", "position": 2 * POSITION_GAP},
+            {"title": "✅ Готово", "color": "#10b981", "position": 3 * POSITION_GAP}
         ]
         
         for col_data in default_columns:
@@ -1324,7 +1493,7 @@ def create_project(external_id, title, description=None, color="#3b82f6"):
             )
             db.add(column)
         
-        db.commit()
+        finish_write(db, session_token)
         return project
         
     except Exception as e:
@@ -1332,12 +1501,12 @@ def create_project(external_id, title, description=None, color="#3b82f6"):
         print(f"Error creating project: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def get_user_projects(external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return []
         
@@ -1347,13 +1516,31 @@ def get_user_projects(external_id):
         print(f"Error getting user projects: {e}")
         return []
     finally:
-        db.close()
+        release_session(db, session_token)
+
+def append_position(model, group_column, group_id):
+    """Позиция после последнего элемента группы — подзапрос внутри того же INSERT"""
+    return select(
+        func.coalesce(func.max(model.position), 0) + POSITION_GAP
+    ).where(group_column == group_id).scalar_subquery()
+
+def position_between(low, high):
+    """Целая позиция между соседями (None — соседа нет); None, если промежуток исчерпан"""
+    if low is None and high is None:
+        return POSITION_GAP
+    if low is None:
+        return high - POSITION_GAP
+    if high is None:
+        return low + POSITION_GAP
+    if high - low < 2:
+        return None
+    return (low + high) // 2
 
 def create_card(column_id, external_id, title, description=None, color="#ffffff", tags=None, 
                 due_date=None, estimated_minutes=0, priority=1):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return None
         
@@ -1364,9 +1551,6 @@ def create_card(column_id, external_id, title, description=None, color="#ffffff"
         if not column:
             return None
         
-        max_position_result = db.query(func.max(BoardCard.position)).filter_by(column_id=column_id).first()
-        max_position = max_position_result[0] if max_position_result[0] is not None else 0
-        
         tags_str = None
         if tags:
             tags_str = ','.join(tags)
@@ -1380,10 +1564,10 @@ def create_card(column_id, external_id, title, description=None, color="#ffffff"
             due_date=due_date,
             estimated_minutes=estimated_minutes,
             priority=priority,
-            position=max_position + 1
+            position=append_position(BoardCard, BoardCard.column_id, column_id)
         )
         db.add(card)
-        db.commit()
+        finish_write(db, session_token)
         db.refresh(card)
         
         return card
@@ -1393,25 +1577,42 @@ def create_card(column_id, external_id, title, description=None, color="#ffffff"
         print(f"Error creating card: {e}")
         return None
     finally:
-        db.close()
+        release_session(db, session_token)
 
-def get_project_with_details(project_id, external_id):
-    db = SessionLocal()
+BOARD_CARD_FIELDS = ('id', 'title', 'description', 'color', 'tags', 'due_date',
+                     'estimated_minutes', 'priority', 'position', 'created_at', 'updated_at', 'version')
+
+def load_boards(external_id, project_id=None, fields=None):
+    """Проекты пользователя с колонками и карточками за три запроса.
+
+    fields — какие поля карточек вернуть (по умолчанию все из BOARD_CARD_FIELDS).
+    """
+    card_fields = [f for f in BOARD_CARD_FIELDS if not fields or f in fields or f == 'id']
+
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
-            return None
-        
-        project = db.query(Project).filter_by(id=project_id, user_id=user.id).first()
-        if not project:
-            return None
-        
-        columns = db.query(BoardColumn).filter_by(project_id=project_id).order_by(BoardColumn.position).all()
-        
-        result_columns = []
-        for column in columns:
-            cards = db.query(BoardCard).filter_by(column_id=column.id).order_by(BoardCard.position).all()
-            
+            return []
+
+        project_query = db.query(
+            Project.id, Project.title, Project.description, Project.color,
+            Project.created_at, Project.updated_at
+        ).filter(Project.user_id == user.id)
+        if project_id is not None:
+            project_query = project_query.filter(Project.id == project_id)
+        projects = project_query.order_by(Project.created_at.desc()).all()
+        if not projects:
+            return []
+
+        columns_by_project = {p.id: [] for p in projects}
+        columns_by_id = {}
+        for column in db.query(
+            BoardColumn.id, BoardColumn.project_id, BoardColumn.title,
+            BoardColumn.color, BoardColumn.position
+        ).filter(
+            BoardColumn.project_id.in_(columns_by_project.keys())
+        ).order_by(BoardColumn.project_id, BoardColumn.position):
             column_data = {
                 "id": column.id,
                 "title": column.title,
@@ -1419,47 +1620,120 @@ def get_project_with_details(project_id, external_id):
                 "position": column.position,
                 "cards": []
             }
-            
-            for card in cards:
-                card_data = {
-                    "id": card.id,
-                    "title": card.title,
-                    "description": card.description,
-                    "color": card.color,
-                    "tags": card.tags.split(',') if card.tags else [],
-                    "due_date": card.due_date,
-                    "estimated_minutes": card.estimated_minutes,
-                    "priority": card.priority,
-                    "position": card.position,
-                    "created_at": card.created_at,
-                    "updated_at": card.updated_at
-                }
-                column_data["cards"].append(card_data)
-            
-            result_columns.append(column_data)
-        
-        project_data = {
-            "id": project.id,
-            "title": project.title,
-            "description": project.description,
-            "color": project.color,
-            "created_at": project.created_at,
-            "updated_at": project.updated_at,
-            "columns": result_columns
-        }
-        
-        return project_data
-        
+            columns_by_project[column.project_id].append(column_data)
+            columns_by_id[column.id] = column_data
+
+        if columns_by_id:
+            card_columns = [getattr(BoardCard, f) for f in card_fields]
+            for card in db.query(BoardCard.column_id, *card_columns).filter(
+                BoardCard.column_id.in_(columns_by_id.keys())
+            ).order_by(BoardCard.column_id, BoardCard.position):
+                card_data = {f: getattr(card, f) for f in card_fields}
+                if 'tags' in card_data:
+                    card_data['tags'] = card.tags.split(',') if card.tags else []
+                columns_by_id[card.column_id]["cards"].append(card_data)
+
+        return [
+            {
+                "id": project.id,
+                "title": project.title,
+                "description": project.description,
+                "color": project.color,
+                "created_at": project.created_at,
+                "updated_at": project.updated_at,
+                "columns": columns_by_project[project.id]
+            }
+            for project in projects
+        ]
+
     except Exception as e:
-        print(f"Error getting project details: {e}")
-        return None
+        # Пустой список здесь выглядел бы как «досок нет» — ошибку отдаем наверх
+        logging.error(f"Error loading boards: {e}")
+        raise
     finally:
-        db.close()
+        release_session(db, session_token)
+
+PROJECT_SYNC_FIELDS = ('id', 'title', 'description', 'color', 'created_at', 'updated_at', 'version')
+COLUMN_SYNC_FIELDS = ('id', 'project_id', 'title', 'color', 'position', 'created_at', 'updated_at', 'version')
+
+def get_sync_cursor():
+    db, session_token = acquire_session()
+    try:
+        return db.query(SyncState.value).filter(SyncState.name == 'changes').scalar() or 0
+    finally:
+        release_session(db, session_token)
+
+def get_changes_since(external_id, since=0):
+    """Строки пользователя, измененные после курсора since, и удаления (tombstones).
+
+    Возвращает новый курсор: следующий запрос с ним вернет только более поздние изменения.
+    """
+    db, session_token = acquire_session()
+    try:
+        # Курсор читается первым в той же транзакции: все строки с версией <= cursor
+        # уже видны в этом снимке, а более поздние придут при следующем запросе.
+        cursor = db.query(SyncState.value).filter(SyncState.name == 'changes').scalar() or 0
+        changes = {'cursor': cursor, 'tasks': [], 'projects': [], 'columns': [], 'cards': [], 'deleted': []}
+
+        user = get_user_identity(external_id)
+        if not user or since >= cursor:
+            return changes
+
+        def in_range(model):
+            return (model.version > since, model.version <= cursor)
+
+        task_columns = [getattr(Task, f) for f in TASK_FIELDS]
+        changes['tasks'] = [
+            {f: getattr(row, f) for f in TASK_FIELDS}
+            for row in db.query(*task_columns).filter(Task.user_id == user.id, *in_range(Task)).order_by(Task.version)
+        ]
+
+        project_columns = [getattr(Project, f) for f in PROJECT_SYNC_FIELDS]
+        changes['projects'] = [
+            {f: getattr(row, f) for f in PROJECT_SYNC_FIELDS}
+            for row in db.query(*project_columns).filter(
+                Project.user_id == user.id, *in_range(Project)
+            ).order_by(Project.version)
+        ]
+
+        column_columns = [getattr(BoardColumn, f) for f in COLUMN_SYNC_FIELDS]
+        changes['columns'] = [
+            {f: getattr(row, f) for f in COLUMN_SYNC_FIELDS}
+            for row in db.query(*column_columns).join(Project, BoardColumn.project_id == Project.id).filter(
+                Project.user_id == user.id, *in_range(BoardColumn)
+            ).order_by(BoardColumn.version)
+        ]
+
+        card_columns = [getattr(BoardCard, f) for f in BOARD_CARD_FIELDS]
+        for row in db.query(BoardCard.column_id, *card_columns).join(
+            BoardColumn, BoardCard.column_id == BoardColumn.id
+        ).join(Project, BoardColumn.project_id == Project.id).filter(
+            Project.user_id == user.id, *in_range(BoardCard)
+        ).order_by(BoardCard.version):
+            card_data = {f: getattr(row, f) for f in BOARD_CARD_FIELDS}
+            card_data['column_id'] = row.column_id
+            card_data['tags'] = row.tags.split(',') if row.tags else []
+            changes['cards'].append(card_data)
+
+        changes['deleted'] = [
+            {'entity': row.entity, 'id': row.entity_id, 'version': row.version}
+            for row in db.query(SyncTombstone.entity, SyncTombstone.entity_id, SyncTombstone.version).filter(
+                SyncTombstone.user_id == user.id, *in_range(SyncTombstone)
+            ).order_by(SyncTombstone.version)
+        ]
+
+        return changes
+    finally:
+        release_session(db, session_token)
+
+def get_project_with_details(project_id, external_id):
+    boards = load_boards(external_id, project_id=project_id)
+    return boards[0] if boards else None
 
 def update_card_position(card_id, external_id, new_column_id=None, new_position=None):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return False
         
@@ -1483,7 +1757,7 @@ def update_card_position(card_id, external_id, new_column_id=None, new_position=
             card.position = new_position
         
         card.updated_at = datetime.datetime.utcnow()
-        db.commit()
+        finish_write(db, session_token)
         return True
         
     except Exception as e:
@@ -1491,12 +1765,213 @@ def update_card_position(card_id, external_id, new_column_id=None, new_position=
         print(f"Error updating card position: {e}")
         return False
     finally:
-        db.close()
+        release_session(db, session_token)
+
+def _rebalance_column_cards(db, user_id, column_id):
+    version = next_sync_version(db.connection())
+    ids = db.execute(text(rebalance_positions_sql("board_cards", "column_id", "column_id = :column_id")), {
+        "gap": POSITION_GAP, "version": version, "column_id": column_id
+    }).scalars().all()
+    record_sync_events(db, user_id, 'card', 'updated', ids, version)
+    print(f"🔢 Позиции карточек колонки {column_id} перенумерованы ({len(ids)} шт.)")
+
+def move_card(card_id, external_id, column_id=None, after_id=None, before_id=None):
+    """Поставить карточку между after_id и before_id в колонке column_id (по умолчанию — текущей).
+
+    Без соседей карточка уходит в конец колонки; если задан один сосед, второй —
+    ближайшая к нему карточка колонки. Пишется одна строка; только если
+    промежуток между соседями исчерпан, колонка один раз перенумеровывается.
+    Возвращает карточку или None, если карточка или колонка не найдены;
+    ValueError — если соседи не из этой колонки или перепутаны местами.
+    """
+    db, session_token = acquire_session()
+    try:
+        user = get_user_identity(external_id)
+        if not user:
+            return None
+
+        card = db.query(BoardCard).join(BoardColumn).join(Project).filter(
+            BoardCard.id == card_id,
+            Project.user_id == user.id
+        ).first()
+        if not card:
+            return None
+
+        target_column_id = column_id if column_id is not None else card.column_id
+        if target_column_id != card.column_id:
+            target_column = db.query(BoardColumn.id).join(Project).filter(
+                BoardColumn.id == target_column_id,
+                Project.user_id == user.id
+            ).first()
+            if not target_column:
+                return None
+
+        neighbour_ids = [i for i in (after_id, before_id) if i is not None and i != card.id]
+
+        def neighbour_bounds():
+            """Позиции соседей; недостающий сосед — ближайшая карточка колонки с нужной стороны"""
+            positions = dict(db.query(BoardCard.id, BoardCard.position).filter(
+                BoardCard.column_id == target_column_id,
+                BoardCard.id.in_(neighbour_ids)
+            ).all())
+            if len(positions) != len(neighbour_ids):
+                raise ValueError("Соседние карточки должны быть в целевой колонке")
+            low, high = positions.get(after_id), positions.get(before_id)
+            others = db.query(BoardCard.position).filter(
+                BoardCard.column_id == target_column_id,
+                BoardCard.id != card.id
+            )
+            if high is None and low is not None:
+                high = others.filter(BoardCard.position > low).order_by(BoardCard.position).limit(1).scalar()
+            elif low is None and high is not None:
+                low = others.filter(BoardCard.position < high).order_by(BoardCard.position.desc()).limit(1).scalar()
+            return low, high
+
+        if neighbour_ids:
+            low, high = neighbour_bounds()
+            if low is not None and high is not None and low >= high:
+                raise ValueError("after_id должна стоять выше before_id")
+
+            position = position_between(low, high)
+            if position is None:
+                _rebalance_column_cards(db, user.id, target_column_id)
+                position = position_between(*neighbour_bounds())
+        else:
+            position = append_position(BoardCard, BoardCard.column_id, target_column_id)
+
+        card.column_id = target_column_id
+        card.position = position
+        card.updated_at = datetime.datetime.utcnow()
+        finish_write(db, session_token)
+        db.refresh(card)
+        return card
+
+    except ValueError:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        print(f"Error moving card: {e}")
+        return None
+    finally:
+        release_session(db, session_token)
+
+def _parse_moves(moves, keys):
+    try:
+        return [{key: int(move[key]) for key in keys if move.get(key) is not None} for move in moves]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Неверный формат перестановок: нужны целые id и position")
+
+def reorder_cards_bulk(external_id, moves, column_id=None):
+    """Применить перестановки [{id, position, column_id?}] одним UPDATE ... CASE.
+
+    Карточки без своего column_id переносятся в column_id. Владелец всех карточек
+    и колонок проверяется одним запросом. Возвращает число карточек или None,
+    если что-то из перечисленного чужое; ошибки БД пробрасываются.
+    """
+    moves = _parse_moves(moves, ('id', 'position', 'column_id'))
+    if any('id' not in m or 'position' not in m for m in moves):
+        raise ValueError("Каждый элемент должен содержать id и position")
+    if column_id is not None:
+        moves = [{'column_id': column_id, **m} for m in moves]
+    if not moves and column_id is None:
+        return 0
+
+    db, session_token = acquire_session()
+    try:
+        user = get_user_identity(external_id)
+        if not user:
+            return None
+
+        card_ids = {m['id'] for m in moves}
+        column_ids = {m['column_id'] for m in moves if 'column_id' in m}
+        if column_id is not None:
+            column_ids.add(column_id)
+
+        owned_cards = db.query(literal('card'), BoardCard.id).join(BoardColumn).join(Project).filter(
+            BoardCard.id.in_(card_ids),
+            Project.user_id == user.id
+        )
+        owned_columns = db.query(literal('column'), BoardColumn.id).join(Project).filter(
+            BoardColumn.id.in_(column_ids),
+            Project.user_id == user.id
+        )
+        owned = set(owned_cards.union_all(owned_columns).all())
+        if len(owned) != len(card_ids) + len(column_ids):
+            return None
+        if not moves:
+            return 0
+
+        version = next_sync_version(db.connection())
+        values = {
+            'position': case({m['id']: m['position'] for m in moves}, value=BoardCard.id),
+            'version': version,
+            'updated_at': datetime.datetime.utcnow()
+        }
+        new_columns = {m['id']: m['column_id'] for m in moves if 'column_id' in m}
+        if new_columns:
+            values['column_id'] = case(new_columns, value=BoardCard.id, else_=BoardCard.column_id)
+
+        db.execute(
+            update(BoardCard).where(BoardCard.id.in_(card_ids)).values(**values),
+            execution_options={'synchronize_session': False}
+        )
+        record_sync_events(db, user.id, 'card', 'updated', sorted(card_ids), version)
+        finish_write(db, session_token)
+        return len(card_ids)
+
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        release_session(db, session_token)
+
+def reorder_columns_bulk(project_id, external_id, moves):
+    """Применить перестановки колонок проекта [{id, position}] одним UPDATE ... CASE"""
+    moves = _parse_moves(moves, ('id', 'position'))
+    if any(len(m) != 2 for m in moves):
+        raise ValueError("Каждый элемент должен содержать id и position")
+    if not moves:
+        return 0
+
+    db, session_token = acquire_session()
+    try:
+        user = get_user_identity(external_id)
+        if not user:
+            return None
+
+        column_ids = {m['id'] for m in moves}
+        owned = db.query(func.count(BoardColumn.id)).join(Project).filter(
+            BoardColumn.id.in_(column_ids),
+            BoardColumn.project_id == project_id,
+            Project.user_id == user.id
+        ).scalar()
+        if owned != len(column_ids):
+            return None
+
+        version = next_sync_version(db.connection())
+        db.execute(
+            update(BoardColumn).where(BoardColumn.id.in_(column_ids)).values(
+                position=case({m['id']: m['position'] for m in moves}, value=BoardColumn.id),
+                version=version,
+                updated_at=datetime.datetime.utcnow()
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        record_sync_events(db, user.id, 'column', 'updated', sorted(column_ids), version)
+        finish_write(db, session_token)
+        return len(column_ids)
+
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        release_session(db, session_token)
 
 def delete_card(card_id, external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return False
         
@@ -1508,7 +1983,7 @@ def delete_card(card_id, external_id):
             return False
         
         db.delete(card)
-        db.commit()
+        finish_write(db, session_token)
         return True
         
     except Exception as e:
@@ -1516,12 +1991,12 @@ def delete_card(card_id, external_id):
         print(f"Error deleting card: {e}")
         return False
     finally:
-        db.close()
+        release_session(db, session_token)
 
 def delete_project(project_id, external_id):
-    db = SessionLocal()
+    db, session_token = acquire_session()
     try:
-        user = get_user_by_external_id(external_id)
+        user = get_user_identity(external_id)
         if not user:
             return False
         
@@ -1530,7 +2005,7 @@ def delete_project(project_id, external_id):
             return False
         
         db.delete(project)
-        db.commit()
+        finish_write(db, session_token)
         return True
         
     except Exception as e:
@@ -1538,4 +2013,4 @@ def delete_project(project_id, external_id):
         print(f"Error deleting project: {e}")
         return False
     finally:
-        db.close()
\ No newline at end of file
+        release_session(db, session_token)
\ No newline at end of file
@@ -0,0 +1,94 @@
+import os
+import sys
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import ASYNC_SQLITE_URL, SQLITE_PROFILE_ENABLED, create_async_sqlite_engine, Task
+from services import (
+    normalize_user_id, parse_date, day_bounds, user_identity_select, tasks_select, subtasks_select,
+    task_progress_select, task_progress_map
+)
+from user_cache import UserIdentity, user_identity_cache
+
+# Асинхронный путь чтения поверх aiosqlite: обработчики, которые только читают,
+# делают await вместо того, чтобы занимать поток db_pool. Запросы строятся теми же
+# функциями, что и в services.py, поэтому результаты у обоих путей одинаковые.
+# Запись по-прежнему идет через services и единицу работы.
+async_engine = create_async_sqlite_engine(ASYNC_SQLITE_URL, profile=SQLITE_PROFILE_ENABLED)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+async def _identity(db, external_id):
+    external_id = normalize_user_id(external_id)
+    identity = user_identity_cache.get(external_id)
+    if identity:
+        return identity
+
+    row = (await db.execute(user_identity_select(external_id))).first()
+    if not row:
+        return None
+    identity = UserIdentity(*row)
+    user_identity_cache.put(identity)
+    return identity
+
+async def get_user_identity(external_id):
+    async with AsyncSessionLocal() as db:
+        return await _identity(db, external_id)
+
+async def list_tasks(external_id, target_date=None):
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await _identity(db, external_id)
+            if not user:
+                return []
+
+            if isinstance(target_date, str):
+                target_date = parse_date(target_date)
+            bounds = day_bounds(target_date) if target_date else ()
+
+            return (await db.scalars(tasks_select(user.id, *bounds))).all()
+        except Exception as e:
+            print(f"Error listing tasks: {e}")
+            return []
+
+async def list_tasks_by_date_range(external_id, start_date, end_date):
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await _identity(db, external_id)
+            if not user:
+                return []
+
+            return (await db.scalars(tasks_select(user.id, *day_bounds(start_date, end_date)))).all()
+        except Exception as e:
+            print(f"Error listing tasks by date range: {e}")
+            return []
+
+async def get_task_by_id(task_id):
+    async with AsyncSessionLocal() as db:
+        try:
+            return await db.get(Task, task_id)
+        except Exception as e:
+            print(f"Error getting task: {e}")
+            return None
+
+async def list_subtasks(parent_task_id):
+    async with AsyncSessionLocal() as db:
+        try:
+            return (await db.scalars(subtasks_select(parent_task_id))).all()
+        except Exception as e:
+            print(f"💥 Ошибка получения подзадач: {e}")
+            return []
+
+async def get_task_progress_bulk(parent_ids):
+    parent_ids = {pid for pid in parent_ids if pid is not None}
+    if not parent_ids:
+        return {}
+
+    async with AsyncSessionLocal() as db:
+        try:
+            rows = (await db.execute(task_progress_select(parent_ids))).all()
+            return task_progress_map(parent_ids, rows)
+        except Exception as e:
+            print(f"💥 Ошибка получения прогресса: {e}")
+            return {pid: (0, 0, 0) for pid in parent_ids}
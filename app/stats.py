@@ -0,0 +1,182 @@
+import datetime
+import os
+import sys
+
+from sqlalchemy import func, case, text
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import (
+    acquire_session, release_session, engine, init_db, Task, BoardColumn, BoardCard,
+    DailyUserStats, UserStreak, DAILY_STATS_COLUMNS
+)
+from migrations import REBUILD_DAILY_USER_STATS_SQL, REBUILD_USER_STREAKS_SQL
+
+# Агрегаты считаются в SQLite (GROUP BY / SUM(CASE ...)), а не перебором
+# объектов в Python: память и время не растут с историей пользователя.
+
+def _count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+def _sum_if(condition, column):
+    return func.coalesce(func.sum(case((condition, column), else_=0)), 0)
+
+def _summary(row):
+    (total, completed, high, medium, low, total_difficulty, completed_difficulty,
+     total_minutes, completed_minutes) = row
+
+    return {
+        'total_tasks': total,
+        'completed_tasks': completed,
+        'pending_tasks': total - completed,
+        'completion_rate': round(completed / total * 100, 1) if total else 0,
+        'difficulty_stats': {'high': high, 'medium': medium, 'low': low},
+        'total_difficulty': total_difficulty,
+        'completed_difficulty': completed_difficulty,
+        'total_minutes': total_minutes,
+        'completed_minutes': completed_minutes
+    }
+
+def get_task_summary(user_id, start=None, end=None):
+    """Счетчики задач пользователя, опционально только созданных в [start, end)"""
+    if user_id is None:
+        return _summary((0,) * 9)
+
+    db, session_token = acquire_session()
+    try:
+        is_done = Task.status == 'done'
+        query = db.query(
+            func.count(Task.id),
+            _count_if(is_done),
+            _count_if(Task.difficulty >= 4),
+            _count_if(Task.difficulty == 3),
+            _count_if(Task.difficulty <= 2),
+            func.coalesce(func.sum(Task.difficulty), 0),
+            _sum_if(is_done, Task.difficulty),
+            func.coalesce(func.sum(Task.estimated_minutes), 0),
+            _sum_if(is_done, Task.estimated_minutes)
+        ).filter(Task.user_id == user_id)
+
+        if start is not None:
+            query = query.filter(Task.created_at >= start)
+        if end is not None:
+            query = query.filter(Task.created_at < end)
+
+        return _summary(query.one())
+    finally:
+        release_session(db, session_token)
+
+def get_day_summary(user_id, day=None):
+    """Счетчики задач, созданных в день day (по умолчанию сегодня), — одна строка daily_user_stats"""
+    day = day or datetime.datetime.utcnow().date()
+    row = None
+
+    if user_id is not None:
+        db, session_token = acquire_session()
+        try:
+            row = db.query(*(getattr(DailyUserStats, c) for c in DAILY_STATS_COLUMNS)).filter(
+                DailyUserStats.user_id == user_id,
+                DailyUserStats.day == day
+            ).first()
+        finally:
+            release_session(db, session_token)
+
+    (total, completed, total_minutes, completed_minutes,
+     total_difficulty, completed_difficulty) = row or (0,) * len(DAILY_STATS_COLUMNS)
+
+    return {
+        'total_tasks': total,
+        'completed_tasks': completed,
+        'pending_tasks': total - completed,
+        'completion_rate': round(completed / total * 100, 1) if total else 0,
+        'total_minutes': total_minutes,
+        'completed_minutes': completed_minutes,
+        'total_difficulty': total_difficulty,
+        'completed_difficulty': completed_difficulty
+    }
+
+def get_streak(user_id, today=None):
+    """Текущая и лучшая серия из user_streaks — поиск одной строки по первичному ключу"""
+    row = None
+    if user_id is not None:
+        db, session_token = acquire_session()
+        try:
+            row = db.query(
+                UserStreak.current_streak, UserStreak.longest_streak, UserStreak.last_active_day
+            ).filter(UserStreak.user_id == user_id).first()
+        finally:
+            release_session(db, session_token)
+
+    if not row:
+        return {'current_streak': 0, 'longest_streak': 0, 'last_active_day': None}
+
+    today = today or datetime.datetime.utcnow().date()
+    # Серия засчитывается, только если сегодня уже что-то выполнено
+    return {
+        'current_streak': row.current_streak if row.last_active_day == today else 0,
+        'longest_streak': row.longest_streak,
+        'last_active_day': row.last_active_day
+    }
+
+def rebuild_daily_user_stats():
+    """Полный пересчет daily_user_stats из таблицы tasks"""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM daily_user_stats"))
+        conn.execute(text(REBUILD_DAILY_USER_STATS_SQL))
+        return conn.execute(text("SELECT COUNT(*) FROM daily_user_stats")).scalar()
+
+def recompute_user_streaks():
+    """Пересчет user_streaks по tasks.completed_at, например после отмены выполнения задач"""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM user_streaks"))
+        conn.execute(text(REBUILD_USER_STREAKS_SQL))
+        return conn.execute(text("SELECT COUNT(*) FROM user_streaks")).scalar()
+
+def get_project_summary(project_id):
+    db, session_token = acquire_session()
+    try:
+        priority_rows = db.query(
+            BoardCard.priority,
+            func.count(BoardCard.id),
+            func.coalesce(func.sum(BoardCard.estimated_minutes), 0)
+        ).join(BoardColumn, BoardCard.column_id == BoardColumn.id).filter(
+            BoardColumn.project_id == project_id
+        ).group_by(BoardCard.priority).all()
+
+        column_rows = db.query(
+            BoardColumn.title,
+            func.count(BoardCard.id)
+        ).outerjoin(BoardCard, BoardCard.column_id == BoardColumn.id).filter(
+            BoardColumn.project_id == project_id
+        ).group_by(BoardColumn.id, BoardColumn.title).order_by(BoardColumn.position).all()
+
+        priority_stats = {priority: 0 for priority in range(1, 6)}
+        total_cards = 0
+        total_minutes = 0
+        for priority, count, minutes in priority_rows:
+            if priority in priority_stats:
+                priority_stats[priority] = count
+            total_cards += count
+            total_minutes += minutes or 0
+
+        return {
+            'total_cards': total_cards,
+            'priority_stats': priority_stats,
+            'column_stats': {title: count for title, count in column_rows},
+            'total_estimated_minutes': total_minutes
+        }
+    finally:
+        release_session(db, session_token)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Обслуживание агрегатов статистики")
+    parser.add_argument("command", choices=["backfill-daily", "recompute-streaks"])
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "backfill-daily":
+        print(f"✅ daily_user_stats пересчитана: {rebuild_daily_user_stats()} строк")
+    elif args.command == "recompute-streaks":
+        print(f"✅ user_streaks пересчитана: {recompute_user_streaks()} пользователей")
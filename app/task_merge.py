@@ -0,0 +1,92 @@
+import datetime
+import os
+import sys
+
+from sqlalchemy import text
+
+sys.path.append(os.path.dirname(__file__))
+
+from models import SYNC_EVENTS_KEY, DAILY_STATS_COLUMNS, next_sync_version
+from migrations import daily_user_stats_sql, user_streaks_sql
+
+# Слияние задач двух аккаунтов набором запросов, без цикла по задачам.
+# Оригинал и все его копии в других аккаунтах имеют общий корень
+# COALESCE(origin_id, id), поэтому повторная синхронизация в любую сторону
+# ничего не дублирует: копируются только задачи, корня которых у получателя нет.
+
+# Корни задач получателя: подзапрос материализуется один раз, проверка каждой
+# исходной задачи — поиск по временному индексу, а не проход по задачам получателя
+_TARGET_ROOTS = "SELECT COALESCE(origin_id, id) AS root, id FROM tasks WHERE user_id = :target"
+
+_COPY_MISSING_SQL = (
+    "INSERT INTO tasks (user_id, title, description, difficulty, status, estimated_minutes, "
+    "created_at, task_date, completed_at, updated_at, version, is_parent, origin_id) "
+    "SELECT :target, s.title, s.description, s.difficulty, s.status, s.estimated_minutes, "
+    "s.created_at, s.task_date, s.completed_at, :now, :version, s.is_parent, COALESCE(s.origin_id, s.id) "
+    "FROM tasks s "
+    "WHERE s.user_id = :source "
+    "AND COALESCE(s.origin_id, s.id) NOT IN (SELECT COALESCE(origin_id, id) FROM tasks WHERE user_id = :target) "
+    # Копии, сделанные до появления origin_id, совпадали по названию и статусу
+    "AND NOT EXISTS (SELECT 1 FROM tasks t WHERE t.user_id = :target AND t.title = s.title "
+    "AND t.status = s.status AND t.origin_id IS NULL) "
+    "ORDER BY s.id "
+    "RETURNING id"
+)
+
+# Родитель копии — задача получателя с тем же корнем, что у родителя исходной задачи
+_LINK_PARENTS_SQL = (
+    "UPDATE tasks SET parent_id = links.parent_id FROM ("
+    "SELECT COALESCE(s.origin_id, s.id) AS root, tr.id AS parent_id "
+    "FROM tasks s "
+    "JOIN tasks sp ON sp.id = s.parent_id "
+    f"JOIN ({_TARGET_ROOTS}) tr ON tr.root = COALESCE(sp.origin_id, sp.id) "
+    "WHERE s.user_id = :source"
+    ") AS links "
+    "WHERE tasks.user_id = :target AND tasks.id >= :first_id AND tasks.origin_id = links.root"
+)
+
+_ADD_DAILY_STATS_SQL = (
+    daily_user_stats_sql("user_id = :target AND id >= :first_id")
+    + " ON CONFLICT (user_id, day) DO UPDATE SET "
+    + ", ".join(f"{c} = {c} + excluded.{c}" for c in DAILY_STATS_COLUMNS)
+)
+
+def merge_user_tasks(db, source_id, target_id):
+    """Скопировать в аккаунт target_id задачи source_id, которых у него еще нет.
+
+    Работает в транзакции сессии db; возвращает счетчики copied, linked и skipped.
+    """
+    params = {"source": source_id, "target": target_id}
+    total = db.execute(text("SELECT COUNT(*) FROM tasks WHERE user_id = :source"), params).scalar()
+
+    version = next_sync_version(db.connection())
+    new_ids = db.execute(text(_COPY_MISSING_SQL), {
+        **params, "version": version, "now": datetime.datetime.utcnow()
+    }).scalars().all()
+    if not new_ids:
+        return {"copied": 0, "linked": 0, "skipped": total}
+
+    # Новые строки получили rowid больше всех существующих
+    params["first_id"] = min(new_ids)
+    db.execute(text(_LINK_PARENTS_SQL), params)
+    linked = db.execute(text(
+        "SELECT COUNT(*) FROM tasks WHERE user_id = :target AND id >= :first_id AND parent_id IS NOT NULL"
+    ), params).scalar()
+
+    # INSERT ... SELECT идет в обход событий маппера: агрегаты обновляем сами
+    db.execute(text(_ADD_DAILY_STATS_SQL), params)
+    has_completed = db.execute(text(
+        "SELECT 1 FROM tasks WHERE user_id = :target AND id >= :first_id AND completed_at IS NOT NULL LIMIT 1"
+    ), params).scalar()
+    if has_completed:
+        db.execute(text("DELETE FROM user_streaks WHERE user_id = :target"), params)
+        db.execute(text(user_streaks_sql("user_id = :target")), params)
+
+    db.info.setdefault(SYNC_EVENTS_KEY, []).append((target_id, {
+        'type': 'task.merged',
+        'entity': 'task',
+        'count': len(new_ids),
+        'version': version
+    }))
+
+    return {"copied": len(new_ids), "linked": linked, "skipped": total - len(new_ids)}
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Только поля, которые не меняются после создания пользователя:
+# имя, энергия и уровень всегда читаются из базы.
+UserIdentity = namedtuple('UserIdentity', ['id', 'external_id', 'created_at'])
+
+# Пользователь, вставленный в незакоммиченной транзакции, попадает в кэш только после
+# коммита; если транзакция не закоммичена, его external_id сбрасывается из кэша
+NEW_IDENTITIES_KEY = 'new_user_identities'
+
+class UserIdentityCache:
+    """LRU-кэш external_id -> UserIdentity с ограничением по размеру и времени жизни"""
+
+    def __init__(self, max_size=None, ttl_seconds=None):
+        self.max_size = max_size or int(os.getenv('USER_CACHE_SIZE', '10000'))
+        self.ttl = ttl_seconds or float(os.getenv('USER_CACHE_TTL_SECONDS', '3600'))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, external_id):
+        with self._lock:
+            cached = self._entries.get(external_id)
+            if cached and cached[1] > time.monotonic():
+                self._entries.move_to_end(external_id)
+                self._stats['hits'] += 1
+                return cached[0]
+            if cached:
+                del self._entries[external_id]
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, identity):
+        with self._lock:
+            self._entries[identity.external_id] = (identity, time.monotonic() + self.ttl)
+            self._entries.move_to_end(identity.external_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def put_after_commit(self, session, identity):
+        """Закэшировать identity, когда session закоммитит вставку пользователя"""
+        session.info.setdefault(NEW_IDENTITIES_KEY, []).append(identity)
+
+    def invalidate(self, external_id):
+        with self._lock:
+            if self._entries.pop(external_id, None):
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups * 100, 1) if lookups else 0
+        return stats
+
+user_identity_cache = UserIdentityCache()
+
+@event.listens_for(Session, 'after_commit')
+def _publish_new_identities(session):
+    for identity in session.info.pop(NEW_IDENTITIES_KEY, ()):
+        user_identity_cache.put(identity)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_new_identities(session, transaction):
+    # После коммита список уже пуст; остаток — откат или закрытие сессии без коммита
+    if transaction.parent is None:
+        for identity in session.info.pop(NEW_IDENTITIES_KEY, ()):
+            user_identity_cache.invalidate(identity.external_id)
@@ -0,0 +1,112 @@
+"""Конкурентная нагрузка на SQLite: поток бота пишет, потоки API читают.
+
+Сравнивает движок без профиля (rollback journal) и с профилем из models.py
+(WAL, synchronous=NORMAL, mmap, cache, busy_timeout).
+
+    python benchmarks/sqlite_concurrency.py --duration 10 --readers 4
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, User, Task, create_sqlite_engine
+
+
+def seed(Session, tasks_count):
+    db = Session()
+    try:
+        user = User(external_id="bench_user", name="bench")
+        db.add(user)
+        db.flush()
+        now = datetime.datetime.utcnow()
+        db.add_all([
+            Task(user_id=user.id, title=f"Задача {i}", task_date=now, created_at=now)
+            for i in range(tasks_count)
+        ])
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+
+def run_case(profile, duration, readers, tasks_count):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = create_sqlite_engine(f"sqlite:///{path}", profile=profile)
+    Session = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    Base.metadata.create_all(bind=engine)
+    user_id = seed(Session, tasks_count)
+
+    stop = threading.Event()
+    counters = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def bump(key):
+        with lock:
+            counters[key] += 1
+
+    def writer():
+        while not stop.is_set():
+            db = Session()
+            try:
+                db.add(Task(user_id=user_id, title="Новая задача"))
+                db.commit()
+                bump("writes")
+            except Exception:
+                db.rollback()
+                bump("errors")
+            finally:
+                db.close()
+
+    def reader():
+        while not stop.is_set():
+            db = Session()
+            try:
+                db.query(Task).filter_by(user_id=user_id).order_by(
+                    Task.task_date.desc(), Task.created_at.desc()
+                ).limit(50).all()
+                bump("reads")
+            except Exception:
+                bump("errors")
+            finally:
+                db.close()
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    return {key: value / duration for key, value in counters.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'профиль':<12}{'чтений/с':>12}{'записей/с':>12}{'ошибок/с':>12}")
+    for label, profile in (("baseline", False), ("wal", True)):
+        result = run_case(profile, args.duration, args.readers, args.tasks)
+        print(f"{label:<12}{result['reads']:>12.1f}{result['writes']:>12.1f}{result['errors']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
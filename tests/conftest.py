@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+import models
+
+# Тесты работают с отдельной базой во временном каталоге, а не с data/taskbot.db
+_db_path = os.path.join(tempfile.mkdtemp(prefix='taskbot-tests-'), 'taskbot.db')
+models.engine = models.create_sqlite_engine(f"sqlite:///{_db_path}")
+models.SessionLocal.configure(bind=models.engine)
+models.init_db()
+
+import services_async
+
+services_async.async_engine = models.create_async_sqlite_engine(f"sqlite+aiosqlite:///{_db_path}")
+services_async.AsyncSessionLocal.configure(bind=services_async.async_engine)
+
+
+@pytest.fixture(scope='session')
+def client():
+    from fastapi.testclient import TestClient
+    import api
+
+    return TestClient(api.app)
@@ -0,0 +1,67 @@
+"""Обработчики, возвращающие ORM-объекты, отдают их поля целиком.
+
+Единица работы коммитит сессию запроса до сериализации ответа; если бы коммит
+сбрасывал атрибуты, FastAPI отдал бы вместо задачи пустой объект {}.
+"""
+import datetime
+
+USER = 'max_501'
+
+
+def create_task(client, title):
+    response = client.post('/tasks/create', params={'external_id': USER}, json={'title': title})
+    assert response.status_code == 200
+    return response.json()['task']
+
+
+def test_create_task_returns_fields(client):
+    task = create_task(client, 'Купить молоко')
+    assert task['title'] == 'Купить молоко'
+    assert task['id'] and task['status'] == 'pending'
+
+
+def test_update_task_returns_fields(client):
+    task = create_task(client, 'Черновик')
+    response = client.put(f"/tasks/{task['id']}", params={'external_id': USER}, json={'title': 'Чистовик'})
+    assert response.status_code == 200
+    assert response.json()['task']['title'] == 'Чистовик'
+
+
+def test_task_lists_return_fields(client):
+    task = create_task(client, 'Задача на сегодня')
+    today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    by_date = client.get('/tasks/list-by-date', params={'external_id': USER, 'date': today}).json()
+    assert task['id'] in {t['id'] for t in by_date['tasks']}
+    assert all(t.get('title') for t in by_date['tasks'])
+
+    by_range = client.post('/tasks/list-by-date-range', params={'external_id': USER},
+                           json={'start_date': today, 'end_date': today}).json()
+    assert all(t.get('title') for t in by_range['tasks'])
+
+    bot_tasks = client.get('/user/bot-tasks', params={'max_user_id': USER.replace('max_', '')}).json()
+    assert task['id'] in {t['id'] for t in bot_tasks['tasks']}
+    assert all(t.get('title') for t in bot_tasks['tasks'])
+
+
+def test_subtasks_return_fields(client):
+    parent = create_task(client, 'Родитель')
+    response = client.post(f"/tasks/{parent['id']}/subtasks", params={'external_id': USER}, json={'title': 'Шаг 1'})
+    assert response.status_code == 200
+    assert response.json()['subtask']['title'] == 'Шаг 1'
+
+    subtasks = client.get(f"/tasks/{parent['id']}/subtasks", params={'external_id': USER}).json()['subtasks']
+    assert [s['title'] for s in subtasks] == ['Шаг 1']
+
+
+def test_kanban_create_returns_fields(client):
+    project = client.post('/kanban/projects', params={'external_id': USER}, json={'title': 'Доска'}).json()['project']
+    assert project['title'] == 'Доска' and project['columns']
+
+    column = client.post(f"/kanban/projects/{project['id']}/columns", params={'external_id': USER},
+                         json={'title': 'Ревью'}).json()['column']
+    assert column['title'] == 'Ревью'
+
+    card = client.post(f"/kanban/columns/{column['id']}/cards", params={'external_id': USER},
+                       json={'title': 'Карточка'}).json()['card']
+    assert card['title'] == 'Карточка'
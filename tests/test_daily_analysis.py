@@ -0,0 +1,28 @@
+"""Анализ дня: числа из daily_user_stats, в промпт — несколько названий задач за сегодня."""
+import services
+from models import unit_of_work
+
+USER = 'max_505'
+
+
+def test_analysis_uses_rollup_and_limited_titles(monkeypatch):
+    captured = {}
+
+    def fake_insights(daily_data):
+        captured.update(daily_data)
+        return None
+
+    monkeypatch.setattr(services, 'get_ai_daily_insights', fake_insights)
+    with unit_of_work():
+        ids = [services.add_task_for_user(USER, f'Задача {i}').id for i in range(8)]
+    with unit_of_work():
+        services.complete_task(USER, ids[0])
+
+    with unit_of_work():
+        user = services.get_or_create_user(USER)
+        result = services.ai_enhanced_daily_analysis(user, for_react=True)
+
+    assert result['stats'] == {'done': 1, 'pending': 7, 'total': 8, 'completion_rate': 12}
+    assert captured['completed_count'] == 1 and captured['pending_count'] == 7
+    assert captured['completed_tasks'] == ['Задача 0']
+    assert len(captured['pending_tasks']) == services.AI_ANALYSIS_TITLES_LIMIT
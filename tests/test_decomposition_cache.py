@@ -0,0 +1,28 @@
+"""Кэш разложений работает в своей сессии и не трогает транзакцию вызывающего."""
+from decomposition_cache import DecompositionCache
+from models import Task, SessionLocal, unit_of_work
+import services
+
+USER = 'max_506'
+
+
+def test_cache_error_keeps_caller_writes():
+    cache = DecompositionCache(memory_size=0)
+    with unit_of_work() as db:
+        user = services.get_user_identity(USER, create=True)
+        db.add(Task(user_id=user.id, title='Пишется до ошибки кэша'))
+        db.flush()
+        cache.put('Сломанный кэш', [object()])  # не сериализуется в JSON
+        assert cache.get('Сломанный кэш') is None
+
+    with SessionLocal() as db:
+        assert db.query(Task).filter_by(title='Пишется до ошибки кэша').count() == 1
+
+
+def test_cache_hit_leaves_caller_session_idle():
+    cache = DecompositionCache(memory_size=0)
+    cache.put('Собрать чемодан', ['Достать чемодан', 'Сложить вещи'])
+    with unit_of_work() as db:
+        assert cache.get('Собрать чемодан') == ['Достать чемодан', 'Сложить вещи']
+        assert not db.in_transaction()
+    assert cache.stats()['db_hits'] == 1
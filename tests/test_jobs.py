@@ -0,0 +1,50 @@
+"""Статусы фоновых заданий разложения задач."""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import services
+from jobs import DecompositionJobQueue
+
+USER = 'max_503'
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setattr(services.decomposition_cache, 'get', lambda title: None)
+    monkeypatch.setattr(services.decomposition_cache, 'put', lambda title, steps: None)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield DecompositionJobQueue(executor)
+
+
+def run_job(queue, title):
+    job = queue.submit(title, USER)
+    job.future.result()
+    return job
+
+
+def test_steps_from_gigachat(queue, monkeypatch):
+    monkeypatch.setattr(services.gigachat_client, 'decompose_task', lambda title: ['Шаг один', 'Шаг два'])
+    job = run_job(queue, 'Убрать квартиру')
+    assert job.status == 'done'
+    assert job.steps == ['Шаг один', 'Шаг два'] and job.fallback is False
+    assert [t.title for t in services.list_subtasks(job.parent_task_id)] == ['Шаг один', 'Шаг два']
+
+
+def test_fallback_is_flagged(queue, monkeypatch):
+    monkeypatch.setattr(services.gigachat_client, 'decompose_task', lambda title: None)
+    job = run_job(queue, 'Помыть окна')
+    assert job.status == 'done'
+    assert job.fallback is True and job.to_dict()['fallback'] is True
+
+
+def test_database_error_fails_job(queue, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError('disk I/O error')
+
+    monkeypatch.setattr(services.gigachat_client, 'decompose_task', lambda title: ['Шаг один', 'Шаг два'])
+    monkeypatch.setattr(services, 'add_subtasks_bulk', broken)
+    job = run_job(queue, 'Сломанная задача')
+    assert job.status == 'failed'
+    assert job.error == 'disk I/O error' and job.parent_task_id is None
+    assert 'Сломанная задача' not in [t.title for t in services.list_tasks(USER)]
@@ -0,0 +1,51 @@
+"""Перемещение карточек: новая позиция всегда между реальными соседями."""
+import pytest
+
+import services
+from models import BoardCard, BoardColumn, SessionLocal, unit_of_work
+
+USER = 'max_504'
+
+
+@pytest.fixture
+def column():
+    with unit_of_work() as db:
+        services.get_user_identity(USER, create=True)
+        project = services.create_project(USER, 'Доска перемещений')
+        return db.query(BoardColumn.id).filter_by(project_id=project.id).order_by(BoardColumn.position).first()[0]
+
+
+def card_order(column_id):
+    with SessionLocal() as db:
+        return [c.title for c in db.query(BoardCard).filter_by(column_id=column_id).order_by(BoardCard.position, BoardCard.id)]
+
+
+def make_card(column_id, title):
+    with unit_of_work():
+        return services.create_card(column_id, USER, title).id
+
+
+def move(card_id, **kwargs):
+    with unit_of_work():
+        services.move_card(card_id, USER, **kwargs)
+
+
+def test_after_only_lands_before_successor(column):
+    a, b, c = (make_card(column, t) for t in 'ABC')
+    move(c, after_id=a)
+    assert card_order(column) == ['A', 'C', 'B']
+
+
+def test_before_only_lands_after_predecessor(column):
+    a, b, c = (make_card(column, t) for t in 'ABC')
+    move(a, before_id=c)
+    assert card_order(column) == ['B', 'A', 'C']
+
+
+def test_repeated_after_moves_rebalance(column):
+    first = make_card(column, 'A')
+    make_card(column, 'B')
+    # Каждое перемещение делит промежуток после A пополам — рано или поздно он кончится
+    for i in range(15):
+        move(make_card(column, f'N{i}'), after_id=first)
+    assert card_order(column) == ['A'] + [f'N{i}' for i in reversed(range(15))] + ['B']
@@ -0,0 +1,37 @@
+"""Асинхронный путь чтения возвращает то же, что и синхронный services."""
+import asyncio
+import datetime
+
+import services
+import services_async
+from models import unit_of_work
+
+USER = 'max_502'
+
+
+def test_async_reads_match_sync(client):
+    parent = client.post('/tasks/create', params={'external_id': USER}, json={'title': 'Проект'}).json()['task']
+    client.post('/tasks/create', params={'external_id': USER}, json={'title': 'Отдельная'})
+    for title in ('Шаг 1', 'Шаг 2'):
+        client.post(f"/tasks/{parent['id']}/subtasks", params={'external_id': USER}, json={'title': title})
+    today = datetime.datetime.utcnow()
+
+    with unit_of_work():
+        sync_tasks = [t.id for t in services.list_tasks(USER)]
+        sync_today = [t.id for t in services.list_tasks(USER, today)]
+        sync_range = [t.id for t in services.list_tasks_by_date_range(USER, today, today)]
+        sync_subtasks = [t.title for t in services.list_subtasks(parent['id'])]
+        sync_progress = services.get_task_progress_bulk([parent['id']])
+
+    async def read():
+        return (
+            [t.id for t in await services_async.list_tasks(USER)],
+            [t.id for t in await services_async.list_tasks(USER, today)],
+            [t.id for t in await services_async.list_tasks_by_date_range(USER, today, today)],
+            [t.title for t in await services_async.list_subtasks(parent['id'])],
+            await services_async.get_task_progress_bulk([parent['id']]),
+        )
+
+    assert asyncio.run(read()) == (sync_tasks, sync_today, sync_range, sync_subtasks, sync_progress)
+    assert sync_subtasks == ['Шаг 1', 'Шаг 2'] and sync_progress[parent['id']] == (0, 2, 0)
+    assert asyncio.run(services_async.get_user_identity('unknown_user')) is None
@@ -0,0 +1,22 @@
+"""Счетчик синхронизации не выдает версию 0, даже если строки sync_state нет."""
+from sqlalchemy import text
+
+import services
+from models import SessionLocal, engine, unit_of_work
+
+USER = 'max_508'
+
+
+def test_missing_counter_row_is_seeded():
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM sync_state WHERE name = 'changes'"))
+
+    with unit_of_work():
+        task = services.add_task_for_user(USER, 'Версия после пустого счетчика')
+        task_id, version = task.id, task.version
+
+    with SessionLocal() as db:
+        counter = db.execute(text("SELECT value FROM sync_state WHERE name = 'changes'")).scalar()
+    assert version >= 1 and counter == version
+    changes = services.get_changes_since(USER, 0)
+    assert task_id in [t['id'] for t in changes['tasks']]
@@ -0,0 +1,40 @@
+"""Сервисы не коммитят сами: запись фиксирует владелец единицы работы одним коммитом."""
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import services
+from models import Task, SessionLocal, unit_of_work
+
+USER = 'max_507'
+
+
+@pytest.fixture
+def commits():
+    counter = []
+
+    def on_commit(session):
+        counter.append(session)
+
+    event.listen(Session, 'after_commit', on_commit)
+    yield counter
+    event.remove(Session, 'after_commit', on_commit)
+
+
+def test_subtask_request_commits_once(client, commits):
+    parent = client.post('/tasks/create', params={'external_id': USER}, json={'title': 'Родитель'}).json()['task']
+    commits.clear()
+    response = client.post(f"/tasks/{parent['id']}/subtasks", params={'external_id': USER}, json={'title': 'Шаг'})
+    assert response.status_code == 200
+    assert len(commits) == 1
+
+
+def test_failed_unit_of_work_keeps_nothing():
+    with pytest.raises(RuntimeError):
+        with unit_of_work():
+            parent = services.add_task_for_user(USER, 'Откатится целиком')
+            services.add_subtask(USER, parent.id, 'Откатится вместе с родителем')
+            raise RuntimeError('ошибка после записи')
+
+    with SessionLocal() as db:
+        assert db.query(Task).filter(Task.title.like('Откатится%')).count() == 0
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import config from "./config";
 
 const API = config.URL_BOT; // ПЕРЕМЕННАЯ В CONFIG.JS
@@ -1495,6 +1495,24 @@ function DailyAnalysis({ tasks, currentUser }) {
   );
 }
 
+// Подписка на SSE-поток /events/stream; onChange вызывается не чаще раза в 300 мс
+function subscribeToChanges(externalId, entities, onChange) {
+  if (typeof EventSource === "undefined") return undefined;
+
+  const source = new EventSource(`${API}/events/stream?external_id=${encodeURIComponent(externalId)}`);
+  let timer = null;
+  source.onmessage = (e) => {
+    const event = JSON.parse(e.data);
+    if (event.type !== "resync" && !entities.includes(event.entity)) return;
+    clearTimeout(timer);
+    timer = setTimeout(onChange, 300);
+  };
+  return () => {
+    clearTimeout(timer);
+    source.close();
+  };
+}
+
 // Канбан доска
 function KanbanBoard({ currentUser }) {
   const [projects, setProjects] = useState([]);
@@ -1511,6 +1529,11 @@ function KanbanBoard({ currentUser }) {
     loadProjects();
   }, [currentUser]);
 
+  useEffect(() => {
+    if (!currentUser) return;
+    return subscribeToChanges(currentUser.id, ["project", "column", "card"], () => loadProjects());
+  }, [currentUser]);
+
   const loadProjects = async () => {
     if (!currentUser) return;
     
@@ -1608,16 +1631,18 @@ function KanbanBoard({ currentUser }) {
     }
   };
 
-  const updateCardPosition = async (cardId, newColumnId, newPosition) => {
+  // Сервер сам вычисляет позицию между соседями и меняет только эту карточку
+  const moveCard = async (cardId, newColumnId, afterId = null, beforeId = null) => {
     try {
-      const response = await fetch(`${API}/kanban/cards/${cardId}?external_id=${currentUser.id}`, {
+      const response = await fetch(`${API}/kanban/cards/${cardId}/move?external_id=${currentUser.id}`, {
         method: "PUT",
         headers: {
           "Content-Type": "application/json",
         },
         body: JSON.stringify({
           column_id: newColumnId,
-          position: newPosition
+          after_id: afterId,
+          before_id: beforeId
         }),
       });
 
@@ -1685,11 +1710,9 @@ function KanbanBoard({ currentUser }) {
     
     if (draggedCard && draggedCard.sourceColumnId !== targetColumn.id) {
       const targetColumnCards = targetColumn.cards || [];
-      const newPosition = targetColumnCards.length > 0 
-        ? Math.max(...targetColumnCards.map(c => c.position)) + 1 
-        : 0;
+      const lastCard = targetColumnCards[targetColumnCards.length - 1];
       
-      await updateCardPosition(draggedCard.id, targetColumn.id, newPosition);
+      await moveCard(draggedCard.id, targetColumn.id, lastCard ? lastCard.id : null);
     }
     
     setDraggedCard(null);
@@ -2327,17 +2350,26 @@ export default function App() {
   const [loading, setLoading] = useState(false);
   const [activeTab, setActiveTab] = useState('tasks');
   const [authState, setAuthState] = useState('checking'); 
+  const syncCursor = useRef(null);
 
   useEffect(() => {
     checkMaxEnvironment();
   }, []);
 
+  // Курсор синхронизации принадлежит пользователю: после смены аккаунта — полная загрузка
   useEffect(() => {
-    if (currentUser && tasks.length === 0) {
+    syncCursor.current = null;
+    if (currentUser) {
       loadTasks();
     }
   }, [currentUser]);
 
+  // Изменения из бота и других вкладок приходят через SSE, без периодических перезагрузок
+  useEffect(() => {
+    if (!currentUser) return;
+    return subscribeToChanges(currentUser.id, ["task"], () => loadTasks());
+  }, [currentUser]);
+
   const checkMaxEnvironment = () => {
     if (window.WebApp && window.WebApp.initDataUnsafe) {
       setAuthState('auto-login');
@@ -2346,18 +2378,63 @@ export default function App() {
     }
   };
 
+  // После первой полной загрузки подтягиваем только изменения через /sync/changes
+  const syncTasks = async () => {
+    const params = new URLSearchParams({ external_id: currentUser.id, since: String(syncCursor.current) });
+    const response = await fetch(`${API}/sync/changes?${params}`);
+    if (!response.ok) {
+      console.error("Failed to sync tasks:", response.status);
+      return false;
+    }
+    const data = await response.json();
+    const deleted = new Set((data.deleted || []).filter(d => d.entity === "task").map(d => d.id));
+    const changed = new Map((data.tasks || []).map(t => [t.id, t]));
+    setTasks(prev => {
+      const merged = prev
+        .filter(t => !deleted.has(t.id))
+        .map(t => changed.has(t.id) ? changed.get(t.id) : t);
+      const known = new Set(merged.map(t => t.id));
+      changed.forEach((task, id) => {
+        if (!known.has(id) && !deleted.has(id)) merged.push(task);
+      });
+      return merged;
+    });
+    syncCursor.current = data.cursor;
+    return true;
+  };
+
   const loadTasks = async () => {
     if (!currentUser) return;
+
+    if (syncCursor.current !== null) {
+      try {
+        if (await syncTasks()) return;
+      } catch (error) {
+        console.error("Error syncing tasks:", error);
+      }
+    }
     
     setLoading(true);
     try {
-      const response = await fetch(`${API}/tasks/list?external_id=${currentUser.id}`);
-      if (response.ok) {
+      const fields = "id,user_id,title,description,difficulty,status,estimated_minutes,created_at,task_date,completed_at,parent_id,is_parent,updated_at,version";
+      const loaded = [];
+      let cursor = null;
+      let firstSyncCursor = null;
+      do {
+        const params = new URLSearchParams({ external_id: currentUser.id, limit: "500", fields });
+        if (cursor) params.set("cursor", cursor);
+        const response = await fetch(`${API}/tasks/list?${params}`);
+        if (!response.ok) {
+          console.error("Failed to load tasks:", response.status);
+          return;
+        }
         const data = await response.json();
-        setTasks(data.tasks || data || []);
-      } else {
-        console.error("Failed to load tasks:", response.status);
-      }
+        if (firstSyncCursor === null) firstSyncCursor = data.sync_cursor ?? null;
+        loaded.push(...(data.tasks || []));
+        cursor = data.next_cursor;
+      } while (cursor);
+      setTasks(loaded);
+      syncCursor.current = firstSyncCursor;
     } catch (error) {
       console.error("Error loading tasks:", error);
     } finally {
@@ -2403,6 +2480,24 @@ export default function App() {
 
       console.log("Creating task with data:", taskData, "isParentTask:", isParentTask);
 
+      const waitForDecomposeJob = async (jobId) => {
+        let parentShown = false;
+        for (let attempt = 0; attempt < 60; attempt++) {
+          const jobResponse = await fetch(`${API}/tasks/decompose/${jobId}?external_id=${currentUser.id}`);
+          if (!jobResponse.ok) return;
+          const job = await jobResponse.json();
+          if (job.status === "done") return;
+          if (job.status === "failed") {
+            throw new Error(job.error || "не удалось разложить задачу");
+          }
+          if (job.parent_task_id && !parentShown) {
+            parentShown = true;
+            await loadTasks();
+          }
+          await new Promise((resolve) => setTimeout(resolve, 1000));
+        }
+      };
+
       let response;
       
       if (isParentTask) {
@@ -2426,6 +2521,9 @@ export default function App() {
       if (response.ok) {
         const result = await response.json();
         console.log("Task created successfully:", result);
+        if (result.job_id) {
+          await waitForDecomposeJob(result.job_id);
+        }
         await loadTasks(); 
       } else {
         const errorText = await response.text();